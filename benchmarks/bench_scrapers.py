@@ -0,0 +1,273 @@
+"""
+Benchmarks the scraper parsers against the pages saved in fixtures/.
+
+For each page it reports the time and peak memory of the scraper's parser
+next to the previous scraper code (a full html.parser parse followed by
+the same find calls, kept below as legacy_*), checks that both give the
+same result, and checks the result against fixtures/expected.json, so a
+selector that stops matching shows up as a failure. Exits 1 if any check
+fails.
+
+    python benchmarks/bench_scrapers.py [--runs N]
+    python benchmarks/bench_scrapers.py --live
+    python benchmarks/bench_scrapers.py --refresh --update-expected
+
+Only pages captured from the live sites are benchmarked: --refresh
+downloads them into fixtures/ and records where and when in
+fixtures/sources.json, and --update-expected then records the parsed
+results as the baseline. A page not listed in sources.json is reported
+as not captured. --live parses the live pages instead (needs network)
+and checks that each parser finds something and agrees with the legacy
+code; this is the check that catches a change on the real sites.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import importlib.util
+from datetime import datetime
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, "fixtures")
+EXPECTED = os.path.join(FIXTURES, "expected.json")
+SOURCES = os.path.join(FIXTURES, "sources.json")
+HEADERS = {"user-agent": "Mozilla/5.0 (X11; Linux x86_64)"}
+
+# bot/parsers.py is loaded by path: importing it through the bot package
+# would run bot/__init__.py, which needs the bot's secrets and MongoDB.
+_spec = importlib.util.spec_from_file_location(
+    "parsers", os.path.join(ROOT, os.pardir, "bot", "parsers.py")
+)
+parsers = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(parsers)
+
+
+# The parsing done by bot/scrapers.py before bot/parsers.py, unchanged
+# apart from taking the page HTML instead of fetching it.
+def legacy_sermons(html: str) -> list:
+    soup = BeautifulSoup(html, "html.parser")
+    sermons_section = soup.find_all("article")
+    sermons = []
+
+    for sermon in sermons_section:
+        try:
+            image = sermon.find("img").get("src")
+            title = (
+                sermon.find("h3", {"class": "cmsmasters_sermon_title entry-title"})
+                .find("a")
+                .text
+            )
+            link = (
+                sermon.find("h3", {"class": "cmsmasters_sermon_title entry-title"})
+                .find("a")
+                .get("href")
+            )
+            download = sermon.find(
+                "a",
+                {
+                    "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_download"
+                },
+            ).get("href")
+            video = sermon.find(
+                "a",
+                {
+                    "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_video"
+                },
+            ).get("href")
+
+            if video.startswith("//"):
+                video = "https:" + video
+
+            sermons.append(
+                {
+                    "title": title,
+                    "download": download,
+                    "video": video,
+                    "link": link,
+                    "image": image,
+                }
+            )
+        except:
+            sermons.append(
+                {
+                    "title": title,
+                    "download": download,
+                    "link": link,
+                    "image": image,
+                    "video": None,
+                }
+            )
+    return sermons
+
+
+def legacy_t30(html: str) -> dict:
+    soup = BeautifulSoup(html, "html.parser")
+
+    title = soup.find("h3", {"class": "entry-title td-module-title"}).find("a").text
+    link = (
+        soup.find("h3", {"class": "entry-title td-module-title"}).find("a").get("href")
+    )
+    image = soup.find("div", {"class": "td-module-thumb"}).find("img").get("src")
+    excerpt = soup.find("div", {"class": "td-excerpt"}).text.strip()
+
+    return {"title": title, "link": link, "image": image, "excerpt": excerpt}
+
+
+def legacy_church_locations(html: str) -> dict:
+    soup = BeautifulSoup(html, "html.parser")
+
+    titles_spans = soup.find_all("span", {"class": "elementskit-tab-title"})
+    locations = {}
+    for span in titles_spans:
+        locations[span.get_text()] = []
+
+    return locations
+
+
+# (name, fixture, live URL, parser, legacy parser)
+CASES = [
+    (
+        "sermons",
+        "media_ccing.html",
+        "https://media.ccing.org/",
+        parsers.parse_sermons,
+        legacy_sermons,
+    ),
+    ("t30", "t30.html", "http://t30.org", parsers.parse_t30, legacy_t30),
+    (
+        "church_locations",
+        "ccing_campus.html",
+        "https://ccing.org/campus/",
+        parsers.parse_church_locations,
+        legacy_church_locations,
+    ),
+]
+
+
+def comparable(name: str, result):
+    # The devotional's date is the day of the parse, not part of the page
+    if name == "t30":
+        return {k: v for k, v in result.items() if k != "date"}
+    return result
+
+
+def measure(fn, html: str, runs: int) -> tuple:
+    """
+    Return: (mean milliseconds per call, peak KiB of one call, last result)
+    """
+    result = fn(html)
+    started = time.perf_counter()
+    for _ in range(runs):
+        result = fn(html)
+    elapsed = (time.perf_counter() - started) / runs * 1000
+
+    tracemalloc.start()
+    fn(html)
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def download(url: str) -> str:
+    import requests
+
+    r = requests.get(url, headers=HEADERS, timeout=30)
+    r.raise_for_status()
+    return r.text
+
+
+def refresh_fixtures() -> None:
+    with open(SOURCES, encoding="utf-8") as f:
+        sources = json.load(f)
+    for name, fixture, url, _, _ in CASES:
+        with open(os.path.join(FIXTURES, fixture), "w", encoding="utf-8") as f:
+            f.write(download(url))
+        sources[fixture] = {
+            "url": url,
+            "captured": datetime.now().isoformat(timespec="seconds"),
+        }
+        print(f"saved {url} to fixtures/{fixture}")
+    with open(SOURCES, "w", encoding="utf-8") as f:
+        json.dump(sources, f, indent=2)
+
+
+def main() -> int:
+    args = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    args.add_argument("--runs", type=int, default=50)
+    args.add_argument("--live", action="store_true")
+    args.add_argument("--refresh", action="store_true")
+    args.add_argument("--update-expected", action="store_true")
+    args = args.parse_args()
+
+    if args.refresh:
+        refresh_fixtures()
+    with open(EXPECTED, encoding="utf-8") as f:
+        expected = json.load(f)
+    with open(SOURCES, encoding="utf-8") as f:
+        sources = json.load(f)
+
+    print(f"parser backend: {parsers.PARSER}, {args.runs} runs per page")
+    print(
+        f"\n{'page':<18}{'size KiB':>9}{'legacy ms':>11}{'legacy KiB':>12}"
+        f"{'scraper ms':>12}{'scraper KiB':>13}{'speedup':>9}  check"
+    )
+    failures = checked = 0
+    for name, fixture, url, parse, legacy in CASES:
+        if args.live:
+            html = download(url)
+        elif fixture not in sources:
+            print(f"{name:<18}not captured: fixtures/{fixture} has not been saved")
+            continue
+        else:
+            with open(os.path.join(FIXTURES, fixture), encoding="utf-8") as f:
+                html = f.read()
+        legacy_ms, legacy_kib, legacy_result = measure(legacy, html, args.runs)
+        ms, kib, result = measure(parse, html, args.runs)
+        checked += 1
+
+        result = comparable(name, result)
+        if result != legacy_result:
+            check = "FAILED (differs from legacy)"
+        elif not result:
+            check = "FAILED (nothing parsed)"
+        elif args.live:
+            check = "ok"
+        elif args.update_expected:
+            expected[name] = result
+            check = "updated"
+        elif name not in expected:
+            check = "FAILED (no expected result, run --update-expected)"
+        elif result == expected[name]:
+            check = "ok"
+        else:
+            check = "FAILED"
+        failures += check.startswith("FAILED")
+        print(
+            f"{name:<18}{len(html) / 1024:>9.1f}{legacy_ms:>11.2f}{legacy_kib:>12.0f}"
+            f"{ms:>12.2f}{kib:>13.0f}{legacy_ms / ms:>8.1f}x  {check}"
+        )
+
+    if not args.live:
+        for fixture, source in sources.items():
+            print(
+                f"fixtures/{fixture}: saved from {source['url']} on {source['captured']}"
+            )
+    if not checked:
+        print(
+            "\nNo pages checked. Run with --refresh --update-expected where the "
+            "sites are reachable to save them, or with --live."
+        )
+        return 1
+
+    if args.update_expected:
+        with open(EXPECTED, "w", encoding="utf-8") as f:
+            json.dump(expected, f, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
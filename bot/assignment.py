@@ -0,0 +1,179 @@
+import time
+import threading
+from datetime import datetime, timedelta
+from . import db, logger
+from .conversation_manager import ConversationManager
+
+
+class AssignmentScheduler:
+    """
+    Decides which counselors are offered a counseling request, and when.
+
+    Eligible counselors, including those already in conversations, are
+    ranked by their number of active conversations, then by whether the
+    request's topic is one of theirs (over global access), then by how
+    quickly they have claimed past offers. The FIRST_WAVE best candidates
+    are offered the request at once. The request stores `escalate_at`, and
+    if nobody has claimed it by then `escalate_due` (run every minute by
+    the scheduler, so a restart loses nothing) offers it again to every
+    eligible counselor, the first wave included.
+
+    Time from request to claim (queue wait) and per-counselor response
+    times are tracked for `stats`.
+    """
+
+    FIRST_WAVE = 3
+    ESCALATE_AFTER = 120
+    # Weight of the latest claim in a counselor's average response time
+    RESPONSE_SMOOTHING = 0.3
+
+    def __init__(self) -> None:
+        # request_message_id -> {chat_id: time offered}, for response times
+        self._offers = {}
+        self._response_times = {}
+        self._waits = []
+        self._lock = threading.Lock()
+
+    def rank(self, candidates, topic_counselors=()) -> list:
+        """
+        Return: candidate chat_ids, best first
+        """
+        candidates = list(candidates)
+        load = ConversationManager.active_conversation_counts(candidates)
+        topic_counselors = set(topic_counselors)
+        with self._lock:
+            response_times = dict(self._response_times)
+        default = self.ESCALATE_AFTER
+
+        return sorted(
+            candidates,
+            key=lambda chat_id: (
+                load.get(chat_id, 0),
+                chat_id not in topic_counselors,
+                response_times.get(chat_id, default),
+            ),
+        )
+
+    def offer(self, request: dict, candidates, topic_counselors, send) -> list:
+        """
+        Offers a request to the best candidates and records when to
+        escalate it.
+
+        Keyword arguments:
+        request -- dict: the counseling request document
+        candidates -- chat_ids of every eligible counselor
+        topic_counselors -- chat_ids of counselors assigned the topic
+        send -- callable(request, chat_ids) returning the chat_ids reached
+
+        Return: chat_ids offered the request in the first wave
+        """
+        first = self.rank(candidates, topic_counselors)[: self.FIRST_WAVE]
+        self._send_wave(request, first, send)
+        db.counseling_requests.update_one(
+            {"request_message_id": request["request_message_id"]},
+            {
+                "$set": {
+                    "escalate_at": datetime.now()
+                    + timedelta(seconds=self.ESCALATE_AFTER)
+                }
+            },
+        )
+        return first
+
+    def _send_wave(self, request: dict, chat_ids: list, send) -> None:
+        if not chat_ids:
+            return
+        reached = send(request, chat_ids)
+        now = time.monotonic()
+        with self._lock:
+            offers = self._offers.setdefault(request["request_message_id"], {})
+            for chat_id in reached:
+                offers.setdefault(chat_id, now)
+            # Forget the oldest requests; unclaimed ones are never popped
+            while len(self._offers) > 1000:
+                del self._offers[next(iter(self._offers))]
+
+    def escalate_due(self, candidates_for, send) -> int:
+        """
+        Offers every request whose `escalate_at` has passed unclaimed to all
+        its eligible counselors. Each request is taken with an atomic
+        update, so schedulers running this in several processes escalate
+        it once.
+
+        Keyword arguments:
+        candidates_for -- callable(request) returning (candidates,
+            topic_counselors) as passed to `offer`
+        send -- callable(request, chat_ids) returning the chat_ids reached
+
+        Return: the number of requests escalated
+        """
+        escalated = 0
+        while True:
+            now = datetime.now()
+            request = db.counseling_requests.find_one_and_update(
+                {
+                    "status": "pending",
+                    "counselor_chat_id": None,
+                    "escalate_at": {"$lte": now},
+                },
+                {"$unset": {"escalate_at": ""}, "$set": {"escalated_at": now}},
+            )
+            if request is None:
+                return escalated
+            candidates, topic_counselors = candidates_for(request)
+            ranked = self.rank(candidates, topic_counselors)
+            logger.info(
+                f"ASSIGNMENT: request {request['request_message_id']} unclaimed "
+                f"after {self.ESCALATE_AFTER}s, offering to {len(ranked)} counselors"
+            )
+            self._send_wave(request, ranked, send)
+            escalated += 1
+
+    def record_claim(self, request: dict, counselor_id: int) -> None:
+        """
+        Records a counselor claiming a request for the wait and response
+        time metrics, and stores the wait on the request.
+        """
+        request_id = request["request_message_id"]
+        with self._lock:
+            offered = self._offers.pop(request_id, {}).get(counselor_id)
+            if offered is not None:
+                elapsed = time.monotonic() - offered
+                previous = self._response_times.get(counselor_id, elapsed)
+                self._response_times[counselor_id] = (
+                    self.RESPONSE_SMOOTHING * elapsed
+                    + (1 - self.RESPONSE_SMOOTHING) * previous
+                )
+
+        created = request.get("created")
+        if created is None:
+            return
+        wait = (datetime.now() - created).total_seconds()
+        with self._lock:
+            self._waits.append(wait)
+            del self._waits[:-1000]
+        db.counseling_requests.update_one(
+            {"request_message_id": request_id},
+            {"$set": {"claimed_at": datetime.now(), "wait_seconds": wait}},
+        )
+
+    def stats(self) -> dict:
+        """
+        Return: dict with claimed (last 1000 claims), wait_avg_s, wait_max_s,
+            response_s (average response time per counselor) and load
+            (active conversations per counselor with any)
+        """
+        with self._lock:
+            waits = list(self._waits)
+            response_times = dict(self._response_times)
+        load = ConversationManager.active_conversation_counts()
+        return {
+            "claimed": len(waits),
+            "wait_avg_s": round(sum(waits) / len(waits), 1) if waits else 0.0,
+            "wait_max_s": round(max(waits), 1) if waits else 0.0,
+            "response_s": {k: round(v, 1) for k, v in response_times.items()},
+            "load": load,
+        }
+
+
+assignment_scheduler = AssignmentScheduler()
@@ -0,0 +1,194 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from telegram.error import (
+    BadRequest,
+    NetworkError,
+    RetryAfter,
+    TimedOut,
+    Unauthorized,
+)
+from . import logger
+from .database import set_user_active
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket used to pace calls to the Telegram Bot API.
+
+    `acquire` blocks until a token is available. `pause` empties the bucket
+    and stops handing out tokens for a while, which is how a RetryAfter
+    (HTTP 429) from Telegram is applied to every sender sharing the bucket.
+
+    A priority acquire (interactive sends such as counseling offers) does
+    not queue behind bulk senders: it takes its token at once, borrowing
+    against the bucket if it is empty, and the bulk senders wait out the
+    debt. Only a pause delays it, so the shared budget is still respected.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority: bool = False) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._updated:
+                    self._tokens = min(
+                        self.capacity, self._tokens + (now - self._updated) * self.rate
+                    )
+                    self._updated = now
+                    if self._tokens >= 1 or priority:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                else:
+                    # paused: _updated is the time the pause ends
+                    delay = self._updated - now
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._tokens = 0
+            self._updated = max(self._updated, time.monotonic() + seconds)
+
+
+# Telegram allows ~30 messages per second per bot; stay a little under it.
+# The bucket is shared so concurrent broadcasts in one process split the budget.
+telegram_rate_limiter = TokenBucket(rate=25)
+
+
+class BroadcastEngine:
+    """
+    Sends messages to many chats at the highest rate Telegram will sustain.
+
+    Sends are paced by a shared TokenBucket and by a per-chat minimum
+    interval. RetryAfter pauses the whole bucket for the requested time and
+    the send is retried, network errors are retried with exponential
+    backoff, and only Unauthorized (bot blocked, user deactivated) or a
+    "chat not found" BadRequest marks the recipient inactive.
+
+    `priority=True` is for small, time-sensitive sends: they take tokens
+    ahead of any broadcast running on the same bucket.
+    """
+
+    def __init__(
+        self,
+        rate_limiter: TokenBucket = telegram_rate_limiter,
+        max_workers: int = 20,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        per_chat_interval: float = 1.0,
+        priority: bool = False,
+    ) -> None:
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.per_chat_interval = per_chat_interval
+        self._last_sent = {}
+        self._lock = threading.Lock()
+
+    def _wait_for_chat(self, chat_id: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            ready = self._last_sent.get(chat_id, 0) + self.per_chat_interval
+            self._last_sent[chat_id] = max(now, ready)
+        if ready > now:
+            time.sleep(ready - now)
+
+    def _deliver(self, chat_id: int, send_function, args: tuple) -> tuple:
+        """
+        Sends one message, retrying throttled and transient failures.
+
+        Return: (chat_id, status, retries) where status is "success",
+            "blocked" or "failure"
+        """
+        retries = 0
+        while True:
+            self._wait_for_chat(chat_id)
+            self.rate_limiter.acquire(self.priority)
+            try:
+                send_function(chat_id, *args)
+                return chat_id, "success", retries
+            except RetryAfter as e:
+                logger.warning(f"BROADCAST: throttled, retrying in {e.retry_after}s")
+                self.rate_limiter.pause(e.retry_after)
+                if retries >= self.max_retries:
+                    return chat_id, "failure", retries
+            except Unauthorized:
+                set_user_active(chat_id, False)
+                return chat_id, "blocked", retries
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    set_user_active(chat_id, False)
+                    return chat_id, "blocked", retries
+                logger.error(f"BROADCAST: could not send to {chat_id}: {e}")
+                return chat_id, "failure", retries
+            except (TimedOut, NetworkError) as e:
+                if retries >= self.max_retries:
+                    logger.error(f"BROADCAST: giving up on {chat_id}: {e}")
+                    return chat_id, "failure", retries
+                time.sleep(self.backoff * 2**retries)
+            except Exception as e:
+                logger.error(f"BROADCAST: could not send to {chat_id}: {e}")
+                return chat_id, "failure", retries
+            retries += 1
+
+    def run(self, messages, send_function, on_result=None) -> dict:
+        """
+        Sends a batch of messages and returns delivery statistics.
+
+        Keyword arguments:
+        messages -- iterable of (chat_id, args) pairs; args is the tuple
+            passed to send_function after the chat_id
+        send_function -- function from MessageHelper to send each message
+        on_result -- optional callable(chat_id, status) invoked from the
+            calling thread as each send finishes
+
+        Return: dict with total, success, failure, blocked, retries,
+            elapsed (seconds) and rate (messages per second) keys
+        """
+        stats = {"total": 0, "success": 0, "failure": 0, "blocked": 0, "retries": 0}
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+
+            def collect(done):
+                for future in done:
+                    chat_id, status, retries = future.result()
+                    stats[status] += 1
+                    stats["retries"] += retries
+                    if on_result is not None:
+                        on_result(chat_id, status)
+
+            # Keep a bounded number of sends in flight so `messages` can be a
+            # lazy iterable of any size.
+            for chat_id, args in messages:
+                stats["total"] += 1
+                if len(in_flight) >= self.max_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(
+                    executor.submit(self._deliver, chat_id, send_function, args)
+                )
+            done, _ = wait(in_flight)
+            collect(done)
+
+        stats["elapsed"] = round(time.monotonic() - started, 2)
+        stats["rate"] = (
+            round(stats["success"] / stats["elapsed"], 2) if stats["elapsed"] else 0.0
+        )
+        logger.info(
+            "BROADCAST: {success}/{total} delivered, {blocked} blocked, "
+            "{failure} failed, {retries} retries in {elapsed}s ({rate} msg/s)".format(
+                **stats
+            )
+        )
+        return stats
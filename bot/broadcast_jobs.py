@@ -0,0 +1,355 @@
+import os
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from . import db, logger
+from .broadcast import BroadcastEngine
+from .helpers import MessageHelper
+from .database import stream_recipients
+
+# Maps the stored broadcast kind to the function that sends it.
+SEND_FUNCTIONS = {
+    "text": MessageHelper.send_text,
+    "photo": MessageHelper.send_photo,
+    "video": MessageHelper.send_video,
+    "animation": MessageHelper.send_animation,
+}
+
+# Indexes backing the job queries, as (collection, keys, options).
+INDEXES = [
+    ("broadcast_jobs", [("status", ASCENDING)], {}),
+    (
+        "broadcast_recipients",
+        [("job_id", ASCENDING), ("chat_id", ASCENDING)],
+        {"unique": True},
+    ),
+    ("broadcast_recipients", [("job_id", ASCENDING), ("status", ASCENDING)], {}),
+]
+
+# BroadcastEngine status -> status stored on the recipient document.
+RECIPIENT_STATUS = {"success": "delivered", "blocked": "blocked", "failure": "failed"}
+
+
+class BroadcastJobManager:
+    """
+    Persists broadcasts as jobs so they survive restarts.
+
+    A job lives in `broadcast_jobs` and its recipients are snapshotted into
+    `broadcast_recipients` (one document per chat_id, status "pending")
+    when the job is created. Running a job streams the pending recipients
+    through BroadcastEngine and checkpoints their status in bulk, so a job
+    interrupted by a restart resumes with only the undelivered chat_ids.
+    At most CHECKPOINT_BATCH recipients can be sent twice after a crash.
+
+    Whoever creates or runs a job owns it through the job's `worker` and
+    `heartbeat` fields, renewed every STALE_AFTER/3 while it works. A job
+    whose owner stopped heartbeating, in "creating" or "running", is
+    orphaned and can be claimed by resume_jobs.
+    """
+
+    CHECKPOINT_BATCH = 100
+    INSERT_BATCH = 1000
+    # A creating or running job whose heartbeat is older than this is
+    # considered orphaned.
+    STALE_AFTER = timedelta(minutes=5)
+
+    @staticmethod
+    def worker_id() -> str:
+        # Unique per owner, not per process: the handler, the startup
+        # resume thread and the scheduler can all run in one process
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def heartbeat(job_id, worker: str) -> bool:
+        """
+        Renews the owner's heartbeat.
+
+        Return: False if another worker has taken the job over
+        """
+        result = db.broadcast_jobs.update_one(
+            {"_id": job_id, "worker": worker},
+            {"$set": {"heartbeat": datetime.now()}},
+        )
+        return result.matched_count == 1
+
+    @staticmethod
+    def _keep_alive(job_id, worker: str, stop: threading.Event, state: dict):
+        # Renews the heartbeat even while the engine is blocked, e.g. on a
+        # long flood-wait, so a slow job is not mistaken for an orphan
+        interval = BroadcastJobManager.STALE_AFTER.total_seconds() / 3
+        while not stop.wait(interval):
+            try:
+                if not BroadcastJobManager.heartbeat(job_id, worker):
+                    logger.warning(f"BROADCAST JOB {job_id}: lost ownership")
+                    state["owned"] = False
+                    return
+            except Exception:
+                logger.exception(f"BROADCAST JOB {job_id}: heartbeat failed")
+
+    @staticmethod
+    def _snapshot(job_id, audience: dict, worker: str) -> int | None:
+        """
+        Inserts the job's recipients as pending, heartbeating per batch.
+
+        Return: the number of recipients, or None if ownership was lost
+        """
+
+        def insert(batch) -> int:
+            try:
+                db.broadcast_recipients.insert_many(batch, ordered=False)
+                return len(batch)
+            except BulkWriteError as e:
+                # A creator that lost the job may still be inserting the
+                # same recipients; the unique index drops the duplicates
+                logger.warning(f"BROADCAST JOB {job_id}: skipped duplicate recipients")
+                return e.details["nInserted"]
+
+        total = 0
+        batch = []
+        for user in stream_recipients(audience):
+            batch.append(
+                {"job_id": job_id, "chat_id": user["chat_id"], "status": "pending"}
+            )
+            if len(batch) >= BroadcastJobManager.INSERT_BATCH:
+                total += insert(batch)
+                batch = []
+                if not BroadcastJobManager.heartbeat(job_id, worker):
+                    logger.warning(f"BROADCAST JOB {job_id}: lost while creating")
+                    return None
+        if batch:
+            total += insert(batch)
+        return total
+
+    @staticmethod
+    def create_job(
+        kind: str,
+        content: str,
+        caption: str | None = None,
+        audience: dict | None = None,
+        created_by: int | None = None,
+        worker: str | None = None,
+    ):
+        """
+        Creates a broadcast job and snapshots its recipients.
+
+        Keyword arguments:
+        kind -- str: one of "text", "photo", "video", "animation"
+        content -- str: the text, or the Telegram file_id of the media
+        caption -- str: caption for media broadcasts
+        audience -- dict: users query selecting the recipients
+        created_by -- int: chat_id of the admin who started the broadcast
+        worker -- str: owner that will run the job itself; the job is then
+            left "running" under that owner instead of "pending", so no
+            other worker can claim it in between
+
+        Return: the ObjectId of the new job, or None if it was taken over
+            while creating
+        """
+        audience = audience if audience is not None else {"active": True}
+        owner = worker or BroadcastJobManager.worker_id()
+
+        job_id = db.broadcast_jobs.insert_one(
+            {
+                "kind": kind,
+                "content": content,
+                "caption": caption,
+                "audience": audience,
+                "created_by": created_by,
+                "created": datetime.now(),
+                "status": "creating",
+                "worker": owner,
+                "heartbeat": datetime.now(),
+                "total": 0,
+                "counts": {"delivered": 0, "blocked": 0, "failed": 0},
+            }
+        ).inserted_id
+
+        if not BroadcastJobManager._finish_creating(job_id, audience, owner, worker):
+            return None
+        return job_id
+
+    @staticmethod
+    def _finish_creating(
+        job_id, audience: dict, owner: str, worker: str | None
+    ) -> bool:
+        total = BroadcastJobManager._snapshot(job_id, audience, owner)
+        if total is None:
+            return False
+        update = {"status": "running" if worker else "pending", "total": total}
+        if not worker:
+            update["worker"] = None
+        result = db.broadcast_jobs.update_one(
+            {"_id": job_id, "worker": owner}, {"$set": update}
+        )
+        if result.matched_count == 0:
+            logger.warning(f"BROADCAST JOB {job_id}: lost while creating")
+            return False
+        logger.info(f"BROADCAST JOB {job_id}: created for {total} recipients")
+        return True
+
+    @staticmethod
+    def recover_creating(job_id, worker: str) -> bool:
+        """
+        Takes over a job whose creator died mid-snapshot and snapshots its
+        recipients again from scratch, leaving it "running" under `worker`.
+
+        Return: False if the job is not an orphaned "creating" job
+        """
+        now = datetime.now()
+        job = db.broadcast_jobs.find_one_and_update(
+            {
+                "_id": job_id,
+                "status": "creating",
+                "heartbeat": {"$lt": now - BroadcastJobManager.STALE_AFTER},
+            },
+            {"$set": {"worker": worker, "heartbeat": now}},
+        )
+        if job is None:
+            return False
+        logger.warning(f"BROADCAST JOB {job_id}: recreating orphaned snapshot")
+        db.broadcast_recipients.delete_many({"job_id": job_id})
+        return BroadcastJobManager._finish_creating(
+            job_id, job["audience"], worker, worker
+        )
+
+    @staticmethod
+    def claim_job(job_id, worker: str) -> dict | None:
+        """
+        Atomically takes ownership of a pending or orphaned job.
+
+        Return: the job document, or None if another worker owns it
+        """
+        now = datetime.now()
+        return db.broadcast_jobs.find_one_and_update(
+            {
+                "_id": job_id,
+                "$or": [
+                    {"status": "pending"},
+                    {
+                        "status": "running",
+                        "heartbeat": {"$lt": now - BroadcastJobManager.STALE_AFTER},
+                    },
+                ],
+            },
+            {"$set": {"status": "running", "worker": worker, "heartbeat": now}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    def run_job(job_id, worker: str | None = None) -> dict | None:
+        """
+        Sends a job to its remaining pending recipients.
+
+        Keyword arguments:
+        job_id -- ObjectId: the job to run
+        worker -- str: the owner, if the caller already owns the job (see
+            create_job); otherwise the job is claimed first
+
+        Return: delivery statistics from BroadcastEngine.run, or None if
+            the job could not be claimed
+        """
+        if worker is None:
+            worker = BroadcastJobManager.worker_id()
+            job = BroadcastJobManager.claim_job(job_id, worker)
+        else:
+            job = db.broadcast_jobs.find_one(
+                {"_id": job_id, "worker": worker, "status": "running"}
+            )
+        if job is None:
+            return None
+
+        send_function = SEND_FUNCTIONS[job["kind"]]
+        args = (
+            (job["content"],)
+            if job["kind"] == "text"
+            else (job["content"], job["caption"] or "")
+        )
+        pending_updates = []
+        counts = {}
+        state = {"owned": True}
+
+        def checkpoint():
+            if not pending_updates:
+                return
+            db.broadcast_recipients.bulk_write(pending_updates, ordered=False)
+            heartbeat = db.broadcast_jobs.update_one(
+                {"_id": job_id, "worker": worker},
+                {"$set": {"heartbeat": datetime.now()}, "$inc": dict(counts)},
+            )
+            pending_updates.clear()
+            counts.clear()
+            if heartbeat.matched_count == 0:
+                logger.warning(f"BROADCAST JOB {job_id}: lost ownership, stopping")
+                state["owned"] = False
+
+        def on_result(chat_id, status):
+            status = RECIPIENT_STATUS[status]
+            pending_updates.append(
+                UpdateOne(
+                    {"job_id": job_id, "chat_id": chat_id},
+                    {"$set": {"status": status, "sent_at": datetime.now()}},
+                )
+            )
+            counts[f"counts.{status}"] = counts.get(f"counts.{status}", 0) + 1
+            if len(pending_updates) >= BroadcastJobManager.CHECKPOINT_BATCH:
+                checkpoint()
+
+        def messages():
+            recipients = db.broadcast_recipients.find(
+                {"job_id": job_id, "status": "pending"}, {"chat_id": 1, "_id": 0}
+            )
+            for recipient in recipients:
+                if not state["owned"]:
+                    break
+                yield recipient["chat_id"], args
+
+        stop = threading.Event()
+        keep_alive = threading.Thread(
+            target=BroadcastJobManager._keep_alive,
+            args=(job_id, worker, stop, state),
+            daemon=True,
+        )
+        keep_alive.start()
+        try:
+            stats = BroadcastEngine().run(messages(), send_function, on_result)
+            checkpoint()
+        finally:
+            stop.set()
+            keep_alive.join()
+
+        if state["owned"]:
+            db.broadcast_jobs.update_one(
+                {"_id": job_id, "worker": worker},
+                {"$set": {"status": "completed", "completed": datetime.now()}},
+            )
+        return stats
+
+    @staticmethod
+    def resume_jobs() -> None:
+        """
+        Runs every unfinished job, e.g. after a restart: pending jobs, and
+        jobs whose owner stopped heartbeating while creating or running.
+        """
+        stale = datetime.now() - BroadcastJobManager.STALE_AFTER
+        for job in db.broadcast_jobs.find(
+            {
+                "$or": [
+                    {"status": "pending"},
+                    {
+                        "status": {"$in": ["creating", "running"]},
+                        "heartbeat": {"$lt": stale},
+                    },
+                ]
+            },
+            {"_id": 1, "status": 1},
+        ):
+            logger.info(f"BROADCAST JOB {job['_id']}: resuming")
+            if job["status"] == "creating":
+                worker = BroadcastJobManager.worker_id()
+                if BroadcastJobManager.recover_creating(job["_id"], worker):
+                    BroadcastJobManager.run_job(job["_id"], worker)
+            else:
+                BroadcastJobManager.run_job(job["_id"])
@@ -1,9 +1,9 @@
 import os
 import json
-from . import bot, db, config
+import threading
+from . import bot, db, config, logger
 from .models import BotUser
 from .helpers import (
-    BroadcastHandlers,
     MessageHelper,
     PromptHelper,
     create_buttons_from_data,
@@ -18,11 +18,26 @@ from .database import (
     get_user_last_command,
     get_countries,
     get_church_locations,
+    get_user,
+    update_user,
+    is_admin,
+    search_db_title,
+    user_cache,
+    stream_recipients,
 )
-from datetime import date, datetime
+from datetime import datetime
 from bson.int64 import Int64
 from chat.chat_callback_handlers import end_conversation_prompt
-from .scrapers import WebScrapers
+from .fetcher import fetcher
+from .devotional_cache import devotional_cache
+from .broadcast import BroadcastEngine
+from .broadcast_jobs import BroadcastJobManager
+from .router import route_stats
+from .counselor_index import counselor_index
+from .session_state import sessions
+from .assignment import assignment_scheduler
+from .workers import update_workers, relay_lanes
+from .conversation_manager import ConversationManager, message_buffer
 from .keyboards import validate_user_keyboard
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
 
@@ -50,9 +65,7 @@ def start(update, context):
     # Send welcome message
     send_welcome_message(chat_id, first_name, context.bot)
 
-    db.users.update_one(
-        {"chat_id": chat_id}, {"$set": {"last_command": "first_time_location_set"}}
-    )
+    update_user(chat_id, {"$set": {"last_command": "first_time_location_set"}})
 
 
 def send_welcome_message(chat_id, first_name, bot):
@@ -121,8 +134,8 @@ def bc_setup(update, context):
     Unified function to set up broadcast for different types of messages.
     """
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "admin": True})
-    if not user:
+    user = get_user(chat_id)
+    if not user or not user.get("admin"):
         return
 
     # Send a message to the admin to select the type of broadcast
@@ -133,7 +146,7 @@ def bc_setup(update, context):
 
 def find_user(update, context):
     chat_id = update.effective_chat.id
-    if db.users.find_one({"chat_id": chat_id, "admin": True}):
+    if is_admin(chat_id):
         context.bot.send_message(chat_id=chat_id, text=config["messages"]["find_user"])
         set_user_last_command(chat_id, "find_user")
     else:
@@ -201,7 +214,7 @@ def handle_find_user_callback(update, context):
     chat_id = update.effective_chat.id
     query_data = update.callback_query.data.split("=")
     user_id = query_data[-1]
-    user = db.users.find_one({"chat_id": int(user_id)})
+    user = get_user(int(user_id))
     if query_data[1] == "loc":
         action = "location"
         church_locations = list(db.church_locations.find({}, {"_id": 0}))
@@ -251,14 +264,15 @@ def handle_update_user(update, context):
             update = {"$set": {"admin": False}}
     elif last_command[1] == "remove location":
         update = {"$pull": {"locations": msg}}
-    elif last_command[1] == "location" and db.users.find_one(
-        {"chat_id": int(user_id), "role": "counselor"}
+    elif (
+        last_command[1] == "location"
+        and (get_user(int(user_id)) or {}).get("role") == "counselor"
     ):
         update = {"$addToSet": {"locations": msg}, "$set": {"location": msg}}
     else:
         update = {"$set": {last_command[1]: msg}}
 
-    db.users.update_one({"chat_id": int(user_id)}, update)
+    update_user(int(user_id), update)
     context.bot.send_message(
         chat_id=chat_id,
         text=config["messages"]["update_user_done"].format(last_command[1], update),
@@ -272,43 +286,61 @@ def handle_broadcast(update, context):
     """
     chat_id = update.effective_chat.id
     message = update.message
-    user = db.users.find_one({"chat_id": chat_id, "admin": True})
-    if not user or user.get("last_command") != "broadcast":
+    user = get_user(chat_id)
+    if not user or not user.get("admin") or user.get("last_command") != "broadcast":
         return
 
     # Reset last_command after broadcast
     set_user_last_command(chat_id, None)
 
-    # Fetch all users to broadcast to
-    users = db.users.distinct("chat_id", {"active": True})
-
-    print(f"FOund {len(users)} users to broadcast to")
-    print("Sample user id", users[0])
-
-    print("Message:", message)
-
     if message.text:
-        BroadcastHandlers.broadcast_message(
-            users, message.text, MessageHelper.send_text
-        )
+        kind, content = "text", message.text
     elif message.photo:
-        photo = message.photo[-1].file_id
-        caption = message.caption or ""
-        BroadcastHandlers.broadcast_message(
-            users, photo, MessageHelper.send_photo, caption
-        )
+        kind, content = "photo", message.photo[-1].file_id
     elif message.video:
-        video = message.video.file_id
-        caption = message.caption or ""
-        BroadcastHandlers.broadcast_message(
-            users, video, MessageHelper.send_video, caption
-        )
+        kind, content = "video", message.video.file_id
     elif message.animation:
-        animation = message.animation.file_id
-        caption = message.caption or ""
-        BroadcastHandlers.broadcast_message(
-            users, animation, MessageHelper.send_animation, caption
+        kind, content = "animation", message.animation.file_id
+    else:
+        return
+
+    # Sending takes minutes at the paced rate, so it runs on its own thread
+    # instead of holding up the dispatcher
+    threading.Thread(
+        target=send_broadcast,
+        args=(context.bot, chat_id, kind, content, message.caption or ""),
+        daemon=True,
+    ).start()
+    context.bot.send_message(
+        chat_id=chat_id, text=config["messages"]["broadcast_started"]
+    )
+
+
+def send_broadcast(sender, chat_id: int, kind: str, content: str, caption: str):
+    """
+    Creates and sends a broadcast job, then sends the admin its summary.
+
+    The job is persisted so it can be resumed if the bot restarts mid-send.
+    This thread owns the job from creation to completion, so the resume
+    thread and job cannot claim it while it is being sent here.
+    """
+    try:
+        worker = BroadcastJobManager.worker_id()
+        job_id = BroadcastJobManager.create_job(
+            kind, content, caption=caption, created_by=chat_id, worker=worker
         )
+        if job_id is None:
+            return
+        result = BroadcastJobManager.run_job(job_id, worker)
+        if result is None:
+            return
+        sender.send_message(
+            chat_id=chat_id,
+            text=config["messages"]["finished_broadcast"].format(**result),
+        )
+    except Exception:
+        # The job, if created, is resumed once its heartbeat goes stale
+        logger.exception(f"BROADCAST: broadcast by {chat_id} failed")
 
 
 def blog_posts(update, context):
@@ -334,7 +366,7 @@ def broadcast_message_handler(update, context):
     to all users
     """
     chat_id = update.effective_chat.id
-    if db.users.find_one({"chat_id": chat_id, "admin": True}):
+    if is_admin(chat_id):
         context.bot.send_message(
             chat_id=chat_id,
             text=config["messages"]["broadcast"],
@@ -354,11 +386,13 @@ def cancel(update, context):
     This function helps you cancel any existing action
     """
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
     keyboard = validate_user_keyboard(chat_id)
 
+    session = sessions.get(chat_id)
+
     if user["last_command"] is not None:
-        if user["last_command"].startswith("in-conversation-with"):
+        if session is not None and not session.transferring:
             end_conversation_prompt(update, context)
         elif user["last_command"].startswith("counselor_request") or user[
             "last_command"
@@ -374,22 +408,13 @@ def cancel(update, context):
                 )
 
             set_user_last_command(chat_id, None)
-        elif user["last_command"].split("=")[0] == "transfer_req":
+        elif session is not None:
             # cancel a counseling transfer request
             context.bot.send_message(
                 chat_id=chat_id,
                 text=config["messages"]["counselor_transfer_cancel"],
             )
-            db.users.update_one(
-                {"chat_id": chat_id},
-                {
-                    "$set": {
-                        "last_command": user["last_command"].replace(
-                            "transfer_req=", ""
-                        )
-                    }
-                },
-            )
+            sessions.resume(session)
         elif user["last_command"] == "verify_counselor":
             context.bot.send_message(
                 chat_id=chat_id,
@@ -466,7 +491,7 @@ def feedback(update, context):
                 resize_keyboard=True,
             ),
         )
-        db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
+        update_user(chat_id, {"$set": {"last_command": None}})
 
 
 def feedback_cb_handler(update, context):
@@ -478,9 +503,7 @@ def feedback_cb_handler(update, context):
         chat_id=chat_id,
         text=config["messages"]["feedback_handler"],
     )
-    db.users.update_one(
-        {"chat_id": chat_id}, {"$set": {"last_command": "feedback=" + q_head[1]}}
-    )
+    update_user(chat_id, {"$set": {"last_command": "feedback=" + q_head[1]}})
 
 
 def get_sermon(update, context):
@@ -503,26 +526,158 @@ def get_sermon(update, context):
     )
 
 
+# Sermon search results are listed this many per page.
+SERMON_RESULTS_PAGE = 5
+# Result messages whose query is remembered for their buttons, per user
+SERMON_SEARCHES_KEPT = 10
+
+
+def send_sermon(chat_id: int, sermon: dict) -> None:
+    """
+    Sends the card (image, title and links) for a single sermon.
+    """
+    if sermon["video"] is not None:
+        buttons = [
+            [InlineKeyboardButton("Download Sermon", url=sermon["download"])],
+            [InlineKeyboardButton("Watch Video", url=sermon["video"])],
+        ]
+    else:
+        buttons = [[InlineKeyboardButton("Download Sermon", url=sermon["link"])]]
+    MessageHelper.send_photo(
+        chat_id,
+        sermon["image"],
+        caption=sermon["title"],
+        reply_markup=InlineKeyboardMarkup(buttons),
+    )
+
+
+def sermon_search_page(title: str, start_index: int = 0) -> tuple:
+    """
+    Searches for sermons and builds the result keyboard for one page.
+
+    Only one result past the page is fetched, which is enough for
+    create_buttons_from_data to decide whether to add 'View More'.
+
+    Args:
+        title (str): The user's search text.
+        start_index (int): Index of the first result on the page.
+
+    Returns:
+        tuple: (list of sermon documents, InlineKeyboardMarkup)
+    """
+    sermons = search_db_title(title, limit=start_index + SERMON_RESULTS_PAGE + 1)
+    titles = [sermon["title"] for sermon in sermons]
+    buttons = create_buttons_from_data(
+        titles, "ss", SERMON_RESULTS_PAGE, 1, start_index=start_index
+    )
+    return sermons, buttons
+
+
+def remember_sermon_search(chat_id: int, message_id: int, title: str) -> None:
+    """
+    Records the query behind a results message, so its buttons re-run the
+    search that produced them rather than the user's latest one.
+    """
+    update_user(
+        chat_id,
+        {
+            "$push": {
+                "sermon_searches": {
+                    "$each": [{"message_id": message_id, "query": title}],
+                    "$slice": -SERMON_SEARCHES_KEPT,
+                }
+            }
+        },
+    )
+
+
+def sermon_search_query(chat_id: int, message_id: int) -> str | None:
+    """
+    Return: the query of the results message, or None once it has aged out
+    """
+    user = get_user(chat_id)
+    for search in (user or {}).get("sermon_searches", []):
+        if search["message_id"] == message_id:
+            return search["query"]
+    return None
+
+
+def sermon_search(update, context):
+    """
+    This lists the sermons matching the title the user typed.
+    """
+    chat_id = update.effective_chat.id
+    title = update.message.text.strip()
+    sermons, buttons = sermon_search_page(title)
+    if len(sermons) == 0:
+        context.bot.send_message(
+            chat_id=chat_id, text=config["messages"]["empty"].format(title)
+        )
+    else:
+        # The query is kept per message so page and selection callbacks
+        # can re-run it
+        message = context.bot.send_message(
+            chat_id=chat_id,
+            text=config["messages"]["sermon_results"].format(title),
+            reply_markup=buttons,
+        )
+        remember_sermon_search(chat_id, message.message_id, title)
+
+
+def sermon_search_callback_handler(update, context):
+    """
+    This handles the 'View More' and selection buttons of sermon search results.
+    """
+    chat_id = update.effective_chat.id
+    query_data = update.callback_query.data.split("=")
+    title = sermon_search_query(chat_id, update.callback_query.message.message_id)
+    if not title:
+        context.bot.send_message(
+            chat_id=chat_id, text=config["messages"]["sermon_search_expired"]
+        )
+        return
+
+    if query_data[1] == "more":
+        _, buttons = sermon_search_page(title, int(query_data[2]))
+        message = context.bot.send_message(
+            chat_id=chat_id,
+            text=config["messages"]["sermon_results"].format(title),
+            reply_markup=buttons,
+        )
+        remember_sermon_search(chat_id, message.message_id, title)
+    else:
+        index = int(query_data[1])
+        sermons = search_db_title(title, limit=index + 1)
+        if len(sermons) <= index:
+            context.bot.send_message(
+                chat_id=chat_id, text=config["messages"]["sermon_search_expired"]
+            )
+        else:
+            send_sermon(chat_id, sermons[index])
+
+
 def get_devotional(update, context):
     """
     This get the devotional for the particular day
     """
     chat_id = update.effective_chat.id
-    if not db.devotionals.find_one({"date": str(date.today())}):
-        d = WebScrapers.t30()
-        db.devotionals.insert_one(d)
-    else:
-        d = db.devotionals.find_one({"date": str(date.today())})
+    d = devotional_cache.get()
+    if d is None:
+        context.bot.send_message(
+            chat_id=chat_id, text=config["messages"]["devotional_unavailable"]
+        )
+        update_user(chat_id, {"$set": {"last_command": None}})
+        return
     button = [[InlineKeyboardButton("Read more", url=d["link"])]]
-    context.bot.send_photo(
-        chat_id=chat_id,
-        photo=d["image"],
+    MessageHelper.send_photo(
+        chat_id,
+        d["image"],
         caption=config["messages"]["t30_caption"].format(
             d["title"], d["excerpt"].split("\n")[0]
         ),
         reply_markup=InlineKeyboardMarkup(button),
     )
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
+    update_user(chat_id, {"$set": {"last_command": None}})
 
 
 def helps(update, context):
@@ -537,7 +692,7 @@ def helps(update, context):
         parse_mode="Markdown",
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
     )
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
+    update_user(chat_id, {"$set": {"last_command": None}})
 
 
 def latest_sermon(update, context):
@@ -551,21 +706,21 @@ def latest_sermon(update, context):
             [InlineKeyboardButton("Download Sermon", url=sermon["download"])],
             [InlineKeyboardButton("Watch Video", url=sermon["video"])],
         ]
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=sermon["image"],
+        MessageHelper.send_photo(
+            chat_id,
+            sermon["image"],
             caption=sermon["title"],
             reply_markup=InlineKeyboardMarkup(buttons),
         )
     else:
         button = [[InlineKeyboardButton("Download Sermon", url=sermon["link"])]]
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=sermon["image"],
+        MessageHelper.send_photo(
+            chat_id,
+            sermon["image"],
             caption=sermon["title"],
             reply_markup=InlineKeyboardMarkup(button),
         )
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
+    update_user(chat_id, {"$set": {"last_command": None}})
 
 
 def map_loc(update, context):
@@ -606,9 +761,9 @@ def membership_school(update, context):
                 )
             ]
         ]
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=open("img/membership.jpg", "rb"),
+        MessageHelper.send_photo(
+            chat_id,
+            "img/membership.jpg",
             caption=config["messages"]["membership"],
             reply_markup=InlineKeyboardMarkup(button),
         )
@@ -621,7 +776,7 @@ def mute(update, context):
     """
     chat_id = update.effective_chat.id
     context.bot.send_message(chat_id=chat_id, text=config["messages"]["mute"])
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"mute": True}})
+    update_user(chat_id, {"$set": {"mute": True}})
 
 
 def unmute(update, context):
@@ -630,10 +785,13 @@ def unmute(update, context):
     """
     chat_id = update.effective_chat.id
     context.bot.send_message(chat_id=chat_id, text=config["messages"]["unmute"])
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"mute": False}})
+    update_user(chat_id, {"$set": {"mute": False}})
 
 
-def notify_new_sermon(chat_id, sermons):
+def new_sermon_keyboard(sermons) -> InlineKeyboardMarkup:
+    """
+    Builds the inline keyboard listing newly added sermon titles.
+    """
     try:
         buttons = [
             [InlineKeyboardButton(i, callback_data="s=" + i.split("-")[2])]
@@ -641,15 +799,37 @@ def notify_new_sermon(chat_id, sermons):
         ]
     except:
         buttons = [[InlineKeyboardButton(i, callback_data="s=" + i)] for i in sermons]
-    user = db.users.find_one({"chat_id": chat_id})
-    try:
-        bot.send_message(
-            chat_id=chat_id,
-            text=config["messages"]["new_sermon"].format(user["first_name"]),
-            reply_markup=InlineKeyboardMarkup(buttons),
+    return InlineKeyboardMarkup(buttons)
+
+
+def notify_new_sermon(sermons, query: dict | None = None) -> dict:
+    """
+    Notifies users about newly added sermons.
+
+    The keyboard is built once and first names come from the same
+    projected cursor that yields the recipients, so each user costs one
+    paced Telegram call and no database round-trip.
+
+    Args:
+        sermons (list): Titles of the new sermons.
+        query (dict): Users query selecting the recipients, all users by default.
+
+    Returns:
+        dict: Delivery statistics from BroadcastEngine.run.
+    """
+    keyboard = new_sermon_keyboard(sermons)
+    users = stream_recipients(query or {}, ["first_name"])
+    messages = (
+        (
+            user["chat_id"],
+            (
+                config["messages"]["new_sermon"].format(user.get("first_name")),
+                keyboard,
+            ),
         )
-    except:
-        set_user_active(chat_id, False)
+        for user in users
+    )
+    return BroadcastEngine().run(messages, MessageHelper.send_text)
 
 
 def unknown(update, context):
@@ -657,7 +837,7 @@ def unknown(update, context):
     This handles unrecognized commands.
     """
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
     keyboard = validate_user_keyboard(chat_id)
     context.bot.send_message(
         chat_id=chat_id,
@@ -685,7 +865,7 @@ def set_church_location(update, context):
     chat_id = update.effective_chat.id
     countries = get_countries()
 
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
     rows, cols = 4, 1
     buttons = create_buttons_from_data(countries, "loc", rows, cols)
 
@@ -756,17 +936,17 @@ def handle_branch_selection_callback(update, context):
         )
     else:
         branch = find_text_for_callback(update.callback_query)
-        db.users.update_one({"chat_id": chat_id}, {"$set": {"location": branch}})
+        update_user(chat_id, {"$set": {"location": branch}})
         context.bot.send_message(
             chat_id=chat_id,
             text=config["messages"]["lc_done"].format(branch),
         )
 
-        user = db.users.find_one({"chat_id": chat_id})
+        user = get_user(chat_id)
         if user["last_command"] == "first_time_location_set":
             PromptHelper.birthday_prompt(chat_id)
-            db.users.update_one(
-                {"chat_id": chat_id},
+            update_user(
+                chat_id,
                 {"$set": {"last_command": "first_time_birthday_set"}},
             )
         if user["last_command"] and user["last_command"].startswith(
@@ -788,7 +968,7 @@ def stats(update, context):
     """
     chat_id = update.effective_chat.id
 
-    if db.users.find_one({"chat_id": chat_id, "admin": True}):
+    if is_admin(chat_id):
         total_users = db.users.count_documents({})
         active_users = db.users.count_documents({"active": True})
         mute_users = db.users.count_documents({"mute": True})
@@ -827,6 +1007,17 @@ def stats(update, context):
             ),
             parse_mode="Markdown",
         )
+        logger.info(f"USER CACHE: {user_cache.stats()}")
+        logger.info(f"ROUTES: {route_stats()}")
+        logger.info(f"UPDATE WORKERS: {update_workers.stats()}")
+        logger.info(f"RELAY LANES: {relay_lanes.stats()}")
+        logger.info(f"COUNSELOR ASSIGNMENT: {assignment_scheduler.stats()}")
+        logger.info(f"HTTP FETCH: {fetcher.stats()}")
+        logger.info(f"DEVOTIONAL CACHE: {devotional_cache.stats()}")
+        logger.info(
+            f"RELAY WRITES: {message_buffer.pending()} pending, "
+            f"{message_buffer.flushed} flushed, {message_buffer.failures} failures"
+        )
         set_user_last_command(chat_id, None)
     else:
         unknown(update, context)
@@ -834,14 +1025,12 @@ def stats(update, context):
 
 def check_user_in_conversation(chat_id):
     """
-    This function validates the last command of the user.
+    This function checks whether the user is in a counseling conversation,
+    on either side.
     """
-    user = db.users.find_one({"chat_id": chat_id})
-    if user["last_command"]:
-        if user["last_command"].startswith("in-conversation"):
-            return True
-    else:
-        return False
+    return sessions.get(
+        chat_id
+    ) is not None or ConversationManager.is_counselor_in_conversation(chat_id)
 
 
 def notify_in_conversation(chat_id):
@@ -861,7 +1050,7 @@ def counselor_dashboard(update, context):
     Displays the counselor's dashboard or prompts for counselor verification.
     """
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
 
     if not user or user.get("role") != "counselor":
         # Prompt for counselor verification
@@ -869,9 +1058,7 @@ def counselor_dashboard(update, context):
             chat_id=chat_id,
             text=config["messages"]["not_counselor_prompt"],
         )
-        db.users.update_one(
-            {"chat_id": chat_id}, {"$set": {"last_command": "verify_counselor"}}
-        )
+        update_user(chat_id, {"$set": {"last_command": "verify_counselor"}})
         return
 
     total_pending_requests = db.counseling_requests.count_documents(
@@ -927,7 +1114,7 @@ def handle_counselor_verification(update, context):
     chat_id = Int64(update.effective_chat.id)
     password = update.message.text.strip()
     if password == os.getenv("COUNSELOR_PASSWORD"):
-        db.users.update_one({"chat_id": chat_id}, {"$set": {"role": "counselor"}})
+        update_user(chat_id, {"$set": {"role": "counselor"}})
         keyboard = validate_user_keyboard(chat_id)
         context.bot.send_message(
             chat_id=chat_id,
@@ -947,16 +1134,14 @@ def handle_counselor_topic_update(update, context):
     Handles the update of counseling topics for a counselor.
     """
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
 
     if not user or user.get("role") != "counselor":
         context.bot.send_message(
             chat_id=chat_id,
             text=config["messages"]["not_counselor_prompt"],
         )
-        db.users.update_one(
-            {"chat_id": chat_id}, {"$set": {"last_command": "verify_counselor"}}
-        )
+        update_user(chat_id, {"$set": {"last_command": "verify_counselor"}})
         return
 
     # Fetch and display all topics
@@ -969,9 +1154,7 @@ def handle_counselor_topic_update(update, context):
 
     message += "\n" + config["messages"]["topic_selection_instruction"]
 
-    db.users.update_one(
-        {"chat_id": chat_id}, {"$set": {"last_command": "select_topics"}}
-    )
+    update_user(chat_id, {"$set": {"last_command": "select_topics"}})
 
     context.bot.send_message(chat_id=chat_id, text=message)
 
@@ -981,7 +1164,7 @@ def handle_topic_selection(update, context):
     Adds selected topics to the counselor's current assignments.
     """
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
 
     if not user or user.get("role") != "counselor":
         context.bot.send_message(
@@ -1018,8 +1201,9 @@ def handle_topic_selection(update, context):
         db.counseling_topics.update_one(
             {"topic": topic_name}, {"$addToSet": {"counselors": chat_id}}
         )
+    counselor_index.add_topics(chat_id, selected_topics)
 
-    db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
+    update_user(chat_id, {"$set": {"last_command": None}})
     context.bot.send_message(
         chat_id=chat_id,
         text=config["messages"]["topics_updated_confirmation"].format(
@@ -1,7 +1,61 @@
+import os
+import threading
 from datetime import datetime
-from bot import db
+from bot import db, logger
+from bot.database import get_user, update_user
+from bot.session_state import sessions
 from bson.int64 import Int64
 from typing import List, Dict, Optional
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# Indexes backing the conversation queries, as (collection, keys, options).
+INDEXES = [
+    (
+        "conversations",
+        [
+            ("counselor_id", ASCENDING),
+            ("status", ASCENDING),
+            ("last_message_time", DESCENDING),
+        ],
+        {},
+    ),
+    ("conversations", [("user_chat_id", ASCENDING), ("status", ASCENDING)], {}),
+    ("conversations", [("request_message_id", ASCENDING), ("status", ASCENDING)], {}),
+    ("conversations", [("from", ASCENDING)], {}),
+    (
+        "conversations",
+        [
+            ("counselor_id", ASCENDING),
+            ("user_chat_id", ASCENDING),
+            ("active", ASCENDING),
+        ],
+        {},
+    ),
+    (
+        "conversation_messages",
+        [("conversation_id", ASCENDING), ("seq", ASCENDING)],
+        {"unique": True},
+    ),
+]
+
+# Representative query shapes, as (collection, filter, sort).
+QUERY_SHAPES = [
+    (
+        "conversations",
+        {"counselor_id": 0, "status": "active"},
+        [("last_message_time", DESCENDING)],
+    ),
+    ("conversations", {"user_chat_id": 0, "status": "active"}, None),
+    ("conversations", {"request_message_id": 0, "status": "active"}, None),
+    ("conversations", {"from": 0}, None),
+    ("conversations", {"counselor_id": 0, "user_chat_id": 0, "active": True}, None),
+    (
+        "conversation_messages",
+        {"conversation_id": 0, "seq": {"$lt": 10}},
+        [("seq", DESCENDING)],
+    ),
+]
 
 
 class ConversationManager:
@@ -39,13 +93,13 @@ class ConversationManager:
                 "last_message_time": datetime.now(),
                 "user_name": user_name,
                 "topic": topic,
-                "messages": [],
+                "message_count": 0,
             }
 
             db.conversations.insert_one(conversation_doc)
 
             # Update counselor mode and preserve existing last_command
-            counselor = db.users.find_one({"chat_id": counselor_id})
+            counselor = get_user(counselor_id)
             current_last_command = counselor.get("last_command")
 
             update_doc = {
@@ -54,25 +108,16 @@ class ConversationManager:
             }
 
             # Store pre-conversation command if counselor had one
-            if current_last_command and not current_last_command.startswith(
-                "in-conversation-with"
-            ):
+            if current_last_command and sessions.get(counselor_id) is None:
                 update_doc["$set"]["pre_conversation_command"] = current_last_command
                 update_doc["$set"]["last_command"] = f"in-conversation-multi"
             elif not current_last_command:
                 update_doc["$set"]["last_command"] = f"in-conversation-multi"
 
-            db.users.update_one({"chat_id": counselor_id}, update_doc)
+            update_user(counselor_id, update_doc)
 
             # Set user's conversation state (users still use single conversation model)
-            db.users.update_one(
-                {"chat_id": user_chat_id},
-                {
-                    "$set": {
-                        "last_command": f"in-conversation-with={counselor_id}=pastor={request_message_id}"
-                    }
-                },
-            )
+            sessions.start(user_chat_id, counselor_id, "pastor", request_message_id)
 
             return True
 
@@ -91,9 +136,40 @@ class ConversationManager:
 
         return conversations
 
+    @staticmethod
+    def active_conversation_counts(
+        counselor_ids: Optional[List[int]] = None,
+    ) -> Dict[int, int]:
+        """
+        Count active conversations per counselor with one aggregation.
+
+        Multi-conversation records are active while `status` is "active",
+        single-conversation ones while `active` is True; both are cleared
+        when the conversation ends.
+
+        Keyword arguments:
+        counselor_ids -- list: counselors to count, or None for every
+            counselor with an active conversation
+
+        Return: dict of counselor chat_id to count
+        """
+        match = {"$or": [{"status": "active"}, {"active": True}]}
+        if counselor_ids is not None:
+            match["counselor_id"] = {"$in": list(counselor_ids)}
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": "$counselor_id", "count": {"$sum": 1}}},
+        ]
+        counts = {counselor_id: 0 for counselor_id in counselor_ids or ()}
+        for doc in db.conversations.aggregate(pipeline):
+            counts[doc["_id"]] = doc["count"]
+        return counts
+
     @staticmethod
     def end_conversation(counselor_id: int, user_chat_id: int, request_message_id: int):
         """End a specific conversation"""
+        # Buffered relay messages are matched on the active conversation
+        message_buffer.flush()
         # Update conversation status
         db.conversations.update_one(
             {
@@ -105,13 +181,13 @@ class ConversationManager:
         )
 
         # Remove from counselor's active conversations
-        db.users.update_one(
-            {"chat_id": counselor_id},
+        update_user(
+            counselor_id,
             {"$pull": {"conversations": request_message_id}},
         )
 
         # Clear user's conversation state
-        db.users.update_one({"chat_id": user_chat_id}, {"$set": {"last_command": None}})
+        sessions.end(user_chat_id)
 
         # Check if counselor has any remaining conversations
         remaining = db.conversations.count_documents(
@@ -120,7 +196,7 @@ class ConversationManager:
 
         if remaining == 0:
             # No more conversations - restore pre-conversation state
-            counselor = db.users.find_one({"chat_id": counselor_id})
+            counselor = get_user(counselor_id)
             pre_conversation_command = counselor.get("pre_conversation_command")
 
             update_doc = {"$unset": {"conversation_mode": "", "conversations": ""}}
@@ -132,7 +208,7 @@ class ConversationManager:
             else:
                 update_doc["$unset"]["last_command"] = ""
 
-            db.users.update_one({"chat_id": counselor_id}, update_doc)
+            update_user(counselor_id, update_doc)
 
     @staticmethod
     def route_message(counselor_id: int, message_text: str) -> Optional[Dict]:
@@ -162,7 +238,7 @@ class ConversationManager:
     @staticmethod
     def is_counselor_in_conversation(counselor_id: int) -> bool:
         """Check if counselor is in any active conversations"""
-        user = db.users.find_one({"chat_id": counselor_id})
+        user = get_user(counselor_id)
         return user and user.get("conversation_mode") == "multi_conversation"
 
     @staticmethod
@@ -193,3 +269,271 @@ class ConversationManager:
         return db.conversations.find_one(
             {"request_message_id": request_message_id, "status": "active"}
         )
+
+
+class ConversationMessages:
+    """
+    Relayed counseling messages, one document each in `conversation_messages`.
+
+    Documents are keyed by (conversation_id, seq). Sequence numbers are
+    reserved by incrementing the conversation's `message_count`, so an
+    append never grows the conversation document. Conversations created
+    before this collection existed keep their first messages in the
+    embedded `messages` array; those count as seq 1..n and new messages
+    continue from n + 1, so readers can page across both.
+    """
+
+    @staticmethod
+    def reserve(conversation_filter: Dict, count: int = 1) -> Optional[Dict]:
+        """
+        Reserves `count` sequence numbers on the matching conversation.
+
+        Return: {"_id", "message_count"} of the conversation after the
+            increment, or None if no conversation matches
+        """
+        return db.conversations.find_one_and_update(
+            conversation_filter,
+            [
+                {
+                    "$set": {
+                        "message_count": {
+                            "$add": [
+                                {
+                                    "$ifNull": [
+                                        "$message_count",
+                                        {"$size": {"$ifNull": ["$messages", []]}},
+                                    ]
+                                },
+                                count,
+                            ]
+                        },
+                        "last_updated": datetime.now(),
+                    }
+                }
+            ],
+            projection={"_id": 1, "message_count": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    def append_many(conversation_filter: Dict, messages: List[Dict]) -> int:
+        """
+        Appends messages to a conversation with a single insert_many.
+
+        Keyword arguments:
+        conversation_filter -- dict: selects the conversation
+        messages -- list of dicts with message, created, from and to keys
+
+        Return: number of messages stored (0 if no conversation matched)
+        """
+        if not messages:
+            return 0
+        conversation = ConversationMessages.reserve(conversation_filter, len(messages))
+        if conversation is None:
+            return 0
+        first_seq = conversation["message_count"] - len(messages) + 1
+        db.conversation_messages.insert_many(
+            [
+                dict(message, conversation_id=conversation["_id"], seq=first_seq + i)
+                for i, message in enumerate(messages)
+            ]
+        )
+        return len(messages)
+
+    @staticmethod
+    def recent(
+        conversation: Dict, limit: int = 10, before_seq: int = None
+    ) -> List[Dict]:
+        """
+        Returns up to `limit` messages of a conversation, oldest first.
+
+        Keyword arguments:
+        conversation -- dict: the conversation document (needs _id, and
+            `messages` for conversations stored in the old format)
+        limit -- int: page size
+        before_seq -- int: return the page before this sequence number;
+            the newest page if None
+
+        Return: list of message documents; pass the first one's `seq` as
+            `before_seq` to read the previous page
+        """
+        query = {"conversation_id": conversation["_id"]}
+        if before_seq is not None:
+            query["seq"] = {"$lt": before_seq}
+        page = list(
+            db.conversation_messages.find(query, {"_id": 0})
+            .sort("seq", DESCENDING)
+            .limit(limit)
+        )
+        page.reverse()
+
+        # Older conversations: fill the page from the embedded array
+        legacy = conversation.get("messages") or []
+        if len(page) < limit and legacy:
+            end = (
+                len(legacy) if before_seq is None else min(len(legacy), before_seq - 1)
+            )
+            start = max(0, end - (limit - len(page)))
+            page = [
+                dict(message, seq=start + i + 1)
+                for i, message in enumerate(legacy[start:end])
+            ] + page
+        return page
+
+    @staticmethod
+    def count(conversation: Dict) -> int:
+        """Returns the number of messages in a conversation"""
+        if "message_count" in conversation:
+            return conversation["message_count"]
+        return len(conversation.get("messages") or [])
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer for relayed conversation messages.
+
+    `append` queues a message and returns at once; a background thread
+    flushes the queue every `flush_interval` seconds, or sooner once
+    `max_batch` messages are waiting. A flush reserves sequence numbers once
+    per conversation and inserts every message with a single bulk_write.
+
+    `flush_interval` is the durability knob: it bounds how many seconds of
+    relayed messages a crash can lose. With 0 every append is written
+    before it returns, as before.
+    """
+
+    def __init__(self, max_batch: int = 100, flush_interval: float = 0.5) -> None:
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = []
+        # Messages that already have a seq but failed to insert
+        self._retry = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+        self.flushed = 0
+        self.failures = 0
+
+    def pending(self) -> int:
+        """Returns the number of messages not yet written to the database"""
+        with self._lock:
+            return len(self._queue) + len(self._retry)
+
+    def append(self, conversation_filter: Dict, message: Dict) -> None:
+        """Queues a message for the conversation matching the filter"""
+        if self.flush_interval <= 0 or self._closed:
+            ConversationMessages.append_many(conversation_filter, [message])
+            return
+        with self._lock:
+            self._queue.append((conversation_filter, message))
+            full = len(self._queue) >= self.max_batch
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="message-write-behind", daemon=True
+                )
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes every queued message.
+
+        Return: number of messages written
+        """
+        with self._flush_lock:
+            with self._lock:
+                queue, self._queue = self._queue, []
+                documents, self._retry = self._retry, []
+
+            # Group by conversation, keeping arrival order within each
+            grouped = {}
+            for conversation_filter, message in queue:
+                key = tuple(sorted(conversation_filter.items()))
+                grouped.setdefault(key, (conversation_filter, []))[1].append(message)
+
+            for conversation_filter, messages in grouped.values():
+                try:
+                    conversation = ConversationMessages.reserve(
+                        conversation_filter, len(messages)
+                    )
+                except PyMongoError as e:
+                    logger.error(f"CONVERSATIONS: could not reserve seq: {e}")
+                    self._requeue(conversation_filter, messages)
+                    continue
+                if conversation is None:
+                    logger.warning(
+                        f"CONVERSATIONS: dropping {len(messages)} messages, "
+                        f"no conversation matches {conversation_filter}"
+                    )
+                    continue
+                first_seq = conversation["message_count"] - len(messages) + 1
+                documents.extend(
+                    dict(
+                        message, conversation_id=conversation["_id"], seq=first_seq + i
+                    )
+                    for i, message in enumerate(messages)
+                )
+
+            if not documents:
+                return 0
+            try:
+                db.conversation_messages.bulk_write(
+                    [InsertOne(document) for document in documents], ordered=False
+                )
+                written = len(documents)
+            except BulkWriteError as e:
+                # Duplicate keys were written by an earlier attempt
+                failed = [
+                    documents[error["index"]]
+                    for error in e.details["writeErrors"]
+                    if error["code"] != 11000
+                ]
+                written = len(documents) - len(e.details["writeErrors"])
+                self._retry_documents(failed, e)
+            except PyMongoError as e:
+                written = 0
+                self._retry_documents(documents, e)
+
+            self.flushed += written
+            return written
+
+    def _requeue(self, conversation_filter: Dict, messages: List[Dict]) -> None:
+        self.failures += 1
+        with self._lock:
+            self._queue[:0] = [(conversation_filter, m) for m in messages]
+
+    def _retry_documents(self, documents: List[Dict], error: Exception) -> None:
+        if not documents:
+            return
+        self.failures += 1
+        logger.error(
+            f"CONVERSATIONS: could not write {len(documents)} messages, "
+            f"will retry: {error}"
+        )
+        with self._lock:
+            self._retry[:0] = documents
+
+    def close(self) -> None:
+        """Flushes pending messages and stops buffering"""
+        self._closed = True
+        self._wake.set()
+        self.flush()
+        if self.pending():
+            logger.error(f"CONVERSATIONS: {self.pending()} messages not written")
+
+
+# Buffer for relayed messages. RELAY_FLUSH_MS bounds how long a message can
+# wait before it is written; 0 writes each message before the relay returns.
+message_buffer = MessageWriteBuffer(
+    max_batch=int(os.getenv("RELAY_FLUSH_BATCH") or 100),
+    flush_interval=int(os.getenv("RELAY_FLUSH_MS") or 500) / 1000,
+)
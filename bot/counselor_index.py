@@ -0,0 +1,187 @@
+import time
+import threading
+from . import db, logger
+from .database import get_user, user_update_listeners
+from .session_state import sessions
+
+# User fields the index is derived from.
+ROUTING_FIELDS = {
+    "role",
+    "global",
+    "location",
+    "locations",
+    "first_name",
+    "last_command",
+    "session",
+}
+
+
+def _is_busy(user: dict) -> bool:
+    # Only a counselor with a conversation session is busy; conversation_mode
+    # is a preference for taking several conversations, not a state
+    return sessions.from_user(user) is not None
+
+
+class CounselorIndex:
+    """
+    An in-memory routing index of counselors.
+
+    Keeps topic -> counselors, location -> counselors, the global
+    counselors and the counselors currently in a conversation, so routing a
+    request is a few set operations instead of several MongoDB queries.
+    The index loads on first use and reloads every `refresh_interval`
+    seconds to pick up changes made elsewhere (another process, the
+    database directly). Changes made by this process are applied
+    incrementally: topic assignments through `add_topics`, and user
+    updates through the `update_user` listener.
+    """
+
+    def __init__(self, refresh_interval: float = 300) -> None:
+        self.refresh_interval = refresh_interval
+        self._by_topic = {}
+        self._topics_of = {}
+        self._by_location = {}
+        self._global = set()
+        self._busy = set()
+        self._names = {}
+        self._loaded = None
+        self._lock = threading.RLock()
+
+    def rebuild(self) -> None:
+        """
+        Reloads every counselor and topic assignment from the database.
+        """
+        topics = list(
+            db.counseling_topics.find({}, {"_id": 0, "topic": 1, "counselors": 1})
+        )
+        counselors = list(
+            db.users.find(
+                {"role": "counselor"},
+                {"_id": 0, "chat_id": 1, **{field: 1 for field in ROUTING_FIELDS}},
+            )
+        )
+        with self._lock:
+            self._by_topic, self._topics_of, self._by_location = {}, {}, {}
+            self._global, self._busy, self._names = set(), set(), {}
+            for doc in topics:
+                for chat_id in doc.get("counselors") or []:
+                    self._add_topic(chat_id, doc["topic"])
+            for user in counselors:
+                self._add_counselor(user)
+            self._loaded = time.monotonic()
+        logger.info(
+            f"COUNSELOR INDEX: {len(counselors)} counselors, {len(topics)} topics"
+        )
+
+    def _ensure_loaded(self) -> None:
+        if (
+            self._loaded is None
+            or time.monotonic() - self._loaded > self.refresh_interval
+        ):
+            self.rebuild()
+
+    def _add_topic(self, chat_id: int, topic: str) -> None:
+        self._by_topic.setdefault(topic, set()).add(chat_id)
+        self._topics_of.setdefault(chat_id, set()).add(topic)
+
+    def _add_counselor(self, user: dict) -> None:
+        chat_id = user["chat_id"]
+        self._names[chat_id] = user.get("first_name", "")
+        if user.get("global"):
+            self._global.add(chat_id)
+        for location in set(user.get("locations") or []) | {user.get("location")}:
+            if location:
+                self._by_location.setdefault(location, set()).add(chat_id)
+        if _is_busy(user):
+            self._busy.add(chat_id)
+
+    def _remove_counselor(self, chat_id: int) -> None:
+        self._names.pop(chat_id, None)
+        self._global.discard(chat_id)
+        self._busy.discard(chat_id)
+        for members in self._by_location.values():
+            members.discard(chat_id)
+
+    def refresh_counselor(self, chat_id: int) -> None:
+        """
+        Re-reads one user (from the user cache) and updates their entries.
+        """
+        user = get_user(chat_id)
+        with self._lock:
+            if self._loaded is None:
+                return
+            self._remove_counselor(chat_id)
+            if user and user.get("role") == "counselor":
+                self._add_counselor(user)
+
+    def on_user_update(self, chat_id: int, update: dict) -> None:
+        fields = {
+            field.split(".")[0] for changes in update.values() for field in changes
+        }
+        if not fields & ROUTING_FIELDS:
+            return
+        if chat_id in self._names or "role" in fields:
+            self.refresh_counselor(chat_id)
+
+    def add_topics(self, chat_id: int, topics: list) -> None:
+        """
+        Records topics assigned to a counselor in `counseling_topics`.
+        """
+        with self._lock:
+            if self._loaded is None:
+                return
+            for topic in topics:
+                self._add_topic(chat_id, topic)
+
+    def eligible(
+        self,
+        topic: str,
+        exclude=(),
+        location: str | None = None,
+        available_only: bool = False,
+    ) -> set:
+        """
+        Returns the counselors who can take a request on a topic.
+
+        Keyword arguments:
+        topic -- str: the counseling topic
+        exclude -- chat_ids to leave out, e.g. the requester
+        location -- str: only counselors serving this location
+        available_only -- bool: leave out counselors in a conversation
+
+        Return: set of counselor chat_ids (topic counselors and globals)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            counselors = (self._by_topic.get(topic, set()) | self._global) & set(
+                self._names
+            )
+            if location is not None:
+                counselors &= self._by_location.get(location, set())
+            if available_only:
+                counselors -= self._busy
+            return counselors - set(exclude)
+
+    def topic_counselors(self, topic: str) -> set:
+        """
+        Return: counselors assigned the topic itself (not via global access)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._by_topic.get(topic, ())) & set(self._names)
+
+    def topics_for(self, chat_id: int) -> list:
+        """
+        Return: the topics assigned to a counselor
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(self._topics_of.get(chat_id, ()))
+
+    def name(self, chat_id: int) -> str:
+        self._ensure_loaded()
+        return self._names.get(chat_id, "")
+
+
+counselor_index = CounselorIndex()
+user_update_listeners.append(counselor_index.on_user_update)
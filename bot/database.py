@@ -1,6 +1,154 @@
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from . import db, logger
 from .models import BotUser
 from .bot_types import Result
+from .user_cache import UserCache
+from .sermon_search import sermon_index
+
+# Indexes backing the queries in this module, as (collection, keys, options).
+# They are created at startup by bot.indexes.IndexManager.ensure_indexes.
+INDEXES = [
+    ("users", [("chat_id", ASCENDING)], {"unique": True}),
+    # stream_recipients pages on chat_id after an equality filter
+    ("users", [("active", ASCENDING), ("chat_id", ASCENDING)], {}),
+    ("users", [("mute", ASCENDING), ("chat_id", ASCENDING)], {}),
+    ("users", [("birthday", ASCENDING), ("chat_id", ASCENDING)], {}),
+    ("users", [("location", ASCENDING), ("chat_id", ASCENDING)], {}),
+    ("users", [("role", ASCENDING), ("global", ASCENDING)], {}),
+    ("sermons", [("title", ASCENDING)], {"unique": True}),
+    (
+        "sermons",
+        [("link", ASCENDING)],
+        {"unique": True, "partialFilterExpression": {"link": {"$type": "string"}}},
+    ),
+    # One devotional per day; scripts/unique_devotional_dates.py removes the
+    # duplicates stored before this index was unique
+    ("devotionals", [("date", ASCENDING)], {"unique": True}),
+    ("counseling_topics", [("topic", ASCENDING)], {"unique": True}),
+    ("counseling_topics", [("counselors", ASCENDING)], {}),
+    ("church_locations", [("country", ASCENDING)], {}),
+    ("counseling_requests", [("request_message_id", ASCENDING)], {}),
+    # get_active_counseling_requests / get_ongoing_counseling_requests
+    (
+        "counseling_requests",
+        [
+            ("status", ASCENDING),
+            ("active", ASCENDING),
+            ("counselor_chat_id", ASCENDING),
+            ("created", ASCENDING),
+        ],
+        {},
+    ),
+    ("counseling_requests", [("counselor_chat_id", ASCENDING)], {}),
+    # AssignmentScheduler.escalate_due
+    ("counseling_requests", [("escalate_at", ASCENDING)], {"sparse": True}),
+    ("feedback", [("status", ASCENDING)], {}),
+]
+
+# Representative query shapes, as (collection, filter, sort), checked by
+# IndexManager.report_collscans.
+QUERY_SHAPES = [
+    ("users", {"chat_id": 0}, None),
+    ("users", {"active": True, "chat_id": {"$gt": 0}}, [("chat_id", ASCENDING)]),
+    ("users", {"mute": False, "chat_id": {"$gt": 0}}, [("chat_id", ASCENDING)]),
+    ("users", {"birthday": "1-1"}, [("chat_id", ASCENDING)]),
+    ("users", {"role": "counselor", "global": True}, None),
+    ("sermons", {"title": ""}, None),
+    ("sermons", {"link": ""}, None),
+    ("devotionals", {"date": ""}, None),
+    ("devotionals", {}, [("date", DESCENDING)]),
+    ("devotionals", {"date": {"$lt": ""}}, [("date", DESCENDING)]),
+    ("counseling_topics", {"topic": ""}, None),
+    ("counseling_topics", {"counselors": 0}, None),
+    ("church_locations", {"country": ""}, None),
+    ("counseling_requests", {"request_message_id": 0}, None),
+    (
+        "counseling_requests",
+        {"active": True, "status": "pending", "counselor_chat_id": None},
+        [("created", ASCENDING)],
+    ),
+    (
+        "counseling_requests",
+        {"active": True, "status": "ongoing", "counselor_chat_id": {"$ne": None}},
+        [("created", ASCENDING)],
+    ),
+    ("counseling_requests", {"counselor_chat_id": 0}, None),
+    ("feedback", {"status": "pending"}, None),
+]
+
+# Per-process cache of user documents shared by the message handlers.
+user_cache = UserCache(maxsize=10000, ttl=300)
+
+# Callables (chat_id, update) run after every update_user, used by
+# in-memory indexes that derive state from user documents.
+user_update_listeners = []
+
+
+def get_user(chat_id: int) -> dict | None:
+    """
+    This gets a user document, reading through the per-process user cache.
+
+    Keyword arguments:
+    chat_id -- int: identifies a specific user
+
+    Return: user document or None if the user does not exist
+    """
+    user = user_cache.get(chat_id)
+    if user is None:
+        generation = user_cache.generation()
+        user = db.users.find_one({"chat_id": chat_id})
+        if user is not None:
+            user_cache.set(chat_id, user, generation)
+    return user
+
+
+def update_user(chat_id: int, update: dict) -> None:
+    """
+    This applies an update to a single user and keeps the user cache in step.
+
+    `$set` updates are written through to the cached document; any other
+    operator invalidates the cached copy.
+
+    Keyword arguments:
+    chat_id -- int: identifies a specific user
+    update -- dict: a MongoDB update document
+    """
+    db.users.update_one({"chat_id": chat_id}, update)
+    if set(update) == {"$set"}:
+        user_cache.update(chat_id, update["$set"])
+    else:
+        user_cache.invalidate(chat_id)
+    for listener in user_update_listeners:
+        listener(chat_id, update)
+
+
+def is_admin(chat_id: int) -> bool:
+    """
+    This checks whether a user is an admin, using the user cache.
+
+    Keyword arguments:
+    chat_id -- int: identifies a specific user
+
+    Return: True or False
+    """
+    user = get_user(chat_id)
+    return bool(user and user.get("admin"))
+
+
+def get_counselor(chat_id: int) -> dict | None:
+    """
+    This gets a user document only if the user has the counselor role.
+
+    Keyword arguments:
+    chat_id -- int: identifies a specific user
+
+    Return: user document or None
+    """
+    user = get_user(chat_id)
+    if user and user.get("role") == "counselor":
+        return user
+    return None
 
 
 def set_user_last_command(chat_id: int, last_command=None) -> bool:
@@ -14,12 +162,7 @@ def set_user_last_command(chat_id: int, last_command=None) -> bool:
     Return: True or False
     """
     try:
-        if not last_command:
-            db.users.update_one({"chat_id": chat_id}, {"$set": {"last_command": None}})
-        else:
-            db.users.update_one(
-                {"chat_id": chat_id}, {"$set": {"last_command": last_command}}
-            )
+        update_user(chat_id, {"$set": {"last_command": last_command or None}})
         return True
     except:
         return False
@@ -35,7 +178,7 @@ def get_user_last_command(chat_id: int) -> str | None:
     Return: last_command
     """
     try:
-        user = db.users.find_one({"chat_id": chat_id})
+        user = get_user(chat_id)
         return user["last_command"]
     except:
         return None
@@ -52,7 +195,7 @@ def set_user_active(chat_id: int, active: bool) -> Result:
     Return: True or False
     """
     try:
-        db.users.update_one({"chat_id": chat_id}, {"$set": {"active": active}})
+        update_user(chat_id, {"$set": {"active": active}})
         return Result.SUCCESS
     except Exception as e:
         return Result.ERROR(e.__str__())
@@ -68,12 +211,13 @@ def add_user_to_db(user: BotUser) -> Result:
     Return: True or False
     """
     try:
-        if not db.users.find_one({"chat_id": user.chat_id}):
+        if not get_user(user.chat_id):
             db.users.insert_one(user.__dict__)
+            user_cache.invalidate(user.chat_id)
             return Result.SUCCESS
         else:
-            db.users.update_one(
-                {"chat_id": user.chat_id},
+            update_user(
+                user.chat_id,
                 {
                     "$set": {
                         "first_name": user.first_name,
@@ -88,42 +232,111 @@ def add_user_to_db(user: BotUser) -> Result:
         return Result.ERROR(e.__str__())
 
 
-def search_db_title(title: str) -> list:
+def stream_recipients(query: dict, fields: list | None = None, batch_size: int = 1000):
     """
-    This takes in a string and searches a MongoDB collection
-    if the title is in the database.
+    This yields users matching a query one page at a time.
+
+    Pages are fetched with keyset pagination on chat_id, so no cursor is
+    held open while messages are being sent and memory stays at one page
+    regardless of how many users match.
 
     Keyword arguments:
-    title -- string containing words to be searched.
-    Return: list of documents containing title
+    query -- dict: users query selecting the recipients
+    fields -- list: extra fields the message template needs
+    batch_size -- int: number of users fetched per round-trip
+
+    Return: generator of dicts containing chat_id and the requested fields
+    """
+    projection = {"_id": 0, "chat_id": 1}
+    for field in fields or []:
+        projection[field] = 1
+
+    last_chat_id = None
+    while True:
+        page_query = query
+        if last_chat_id is not None:
+            page_query = {"$and": [query, {"chat_id": {"$gt": last_chat_id}}]}
+        page = list(
+            db.users.find(page_query, projection).sort("chat_id", 1).limit(batch_size)
+        )
+        yield from page
+        if len(page) < batch_size:
+            return
+        last_chat_id = page[-1]["chat_id"]
+
+
+def search_db_title(title: str, limit: int = 10) -> list:
+    """
+    This takes in a string and searches the sermon title index for it.
+
+    Keyword arguments:
+    title -- string containing words to be searched; each word may be
+        a prefix, e.g. "faith wor" matches "Faith that Works".
+    limit -- int: maximum number of sermons returned
+
+    Return: list of sermon documents, best match first
     """
     try:
-        query = {
-            "title": {"$regex": title, "$options": "i"}
-        }  # Case-insensitive regex search
-        result = list(db.sermons.find(query))
-        return result
-    except:
+        return sermon_index.search(title, limit=limit)
+    except Exception as e:
+        logger.error(f"SERMON SEARCH: search for {title!r} failed: {e}")
         return []
 
 
-def insert_sermon(sermon: dict) -> bool:
+def known_sermons(sermons: list) -> list:
     """
-    This takes in a sermon and checks inserts the sermon into the
-    database if it does not already exist.
+    This checks which scraped sermons are already stored, by title or link.
 
     Keyword arguments:
-    sermon -- dict: contains attributes that define a sermon
+    sermons -- list: scraped sermon dicts
 
-    Return: returns True or None if sermon exists in the database
+    Return: list of booleans, True where the sermon is already stored
     """
+    titles = [sermon["title"] for sermon in sermons]
+    links = [sermon["link"] for sermon in sermons if sermon.get("link")]
+    known_titles, known_links = set(), set()
+    for doc in db.sermons.find(
+        {"$or": [{"title": {"$in": titles}}, {"link": {"$in": links}}]},
+        {"_id": 0, "title": 1, "link": 1},
+    ):
+        known_titles.add(doc.get("title"))
+        known_links.add(doc.get("link"))
+    return [
+        sermon["title"] in known_titles or sermon.get("link") in known_links
+        for sermon in sermons
+    ]
+
+
+def insert_sermons(sermons: list) -> list:
+    """
+    This inserts sermons that are not stored yet with a single bulk write
+    of upserts on title; existing sermons are left untouched.
 
-    if db.sermons.find_one({"title": sermon["title"]}) is not None:
-        return False
-    else:
-        db.sermons.insert_one(sermon)
+    Keyword arguments:
+    sermons -- list: sermon dicts, newest first
+
+    Return: list of the sermons that were inserted, in the given order
+    """
+    if not sermons:
+        return []
+    operations = [
+        UpdateOne({"title": sermon["title"]}, {"$setOnInsert": sermon}, upsert=True)
+        for sermon in sermons
+    ]
+    try:
+        upserted = db.sermons.bulk_write(operations, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        # A sermon whose link is stored under another title is a duplicate
+        errors = e.details.get("writeErrors", [])
+        for error in errors:
+            if error.get("code") != 11000:
+                logger.error(f"SERMON: bulk insert failed: {error.get('errmsg')}")
+        upserted = {doc["index"]: doc["_id"] for doc in e.details.get("upserted", [])}
+    inserted = [sermons[i] for i in sorted(upserted)]
+    for sermon in inserted:
+        sermon_index.add(sermon)
         logger.info("SERMON: Inserted new sermon '{0}' to db".format(sermon["title"]))
-        return True
+    return inserted
 
 
 def update_counseling_topics(topic: str):
@@ -250,3 +463,45 @@ def set_counseling_request_status(request_id: str, status: str):
     db.counseling_requests.update_one(
         {"request_message_id": request_id}, {"$set": {"status": status}}
     )
+
+
+def claim_counseling_request(
+    request_id: int, counselor_id: int, claimable: dict
+) -> dict | None:
+    """
+    This atomically assigns a counseling request to a counselor.
+
+    The check and the assignment are one findOneAndUpdate, so when several
+    counselors tap at once exactly one of them gets the request.
+
+    Keyword arguments:
+    request_id -- int: request_message_id of the request
+    counselor_id -- int: chat_id of the counselor claiming it
+    claimable -- dict: extra conditions the request must meet to be claimed
+
+    Return: the request as it was before the claim, or None if it was not
+        claimable (already taken, or no such request)
+    """
+    return db.counseling_requests.find_one_and_update(
+        {"request_message_id": request_id, **claimable},
+        {"$set": {"counselor_chat_id": counselor_id, "status": "ongoing"}},
+        return_document=ReturnDocument.BEFORE,
+    )
+
+
+def release_counseling_request(request_id: int, counselor_id: int, previous: dict):
+    """
+    This undoes claim_counseling_request, if the counselor still holds it.
+
+    Keyword arguments:
+    previous -- dict: the request returned by claim_counseling_request
+    """
+    db.counseling_requests.update_one(
+        {"request_message_id": request_id, "counselor_chat_id": counselor_id},
+        {
+            "$set": {
+                "counselor_chat_id": previous.get("counselor_chat_id"),
+                "status": previous.get("status"),
+            }
+        },
+    )
@@ -0,0 +1,165 @@
+import time
+import threading
+from datetime import date
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from . import db, logger
+from .scrapers import WebScrapers
+
+
+class DevotionalCache:
+    """
+    Keeps today's devotional in memory.
+
+    The scheduler stores the devotional in `db.devotionals` as the date
+    changes (jobs.py:prefetch_devotional), so the first `get` of the day
+    is one database read and every later one a memory read. `get` never
+    scrapes t30.org itself: until today's devotional has been stored it
+    serves yesterday's (or None on a cold start) and refreshes in the
+    background. Loads are single-flight: concurrent misses wait for the
+    one load in progress instead of each querying the database. After a
+    failed refresh, misses are answered from memory for RETRY_AFTER
+    seconds rather than each starting another scrape.
+
+    A refresh only stores the front page's devotional for today once it
+    differs from the previous day's, so a fetch made before t30.org has
+    published the new day's post is retried rather than stored as today's.
+    """
+
+    RETRY_AFTER = 300
+
+    def __init__(self) -> None:
+        self._current = None
+        self._flight = None
+        self._refreshing = False
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.scrapes = 0
+        self.failures = 0
+
+    def get(self, allow_stale: bool = True) -> dict | None:
+        """
+        Keyword arguments:
+        allow_stale -- bool: return the previous day's devotional while
+            today's is not available yet
+
+        Return: today's devotional (or the previous one, if allowed), or
+            None if none could be loaded
+        """
+        today = str(date.today())
+        current = self._current
+        if current is not None and current["date"] == today:
+            return current
+        stale = current if allow_stale else None
+        if self._refreshing or time.monotonic() < self._retry_at:
+            return stale
+        devotional = self._load(today)
+        if devotional is not None and (allow_stale or devotional["date"] == today):
+            return devotional
+        return stale
+
+    def _load(self, today: str) -> dict | None:
+        """
+        Return: the newest stored devotional, or None if there is none or
+            it could not be read
+        """
+        with self._lock:
+            if self._current is not None and self._current["date"] == today:
+                return self._current
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = {"done": threading.Event(), "result": None}
+        if not leader:
+            flight["done"].wait()
+            return flight["result"]
+
+        try:
+            self.loads += 1
+            devotional = db.devotionals.find_one({}, sort=[("date", DESCENDING)])
+            if devotional is None or devotional["date"] != today:
+                logger.info("DEVOTIONAL: today's devotional not stored yet")
+                self._refresh_in_background()
+            flight["result"] = devotional
+            with self._lock:
+                if devotional is not None:
+                    self._current = devotional
+        except Exception:
+            self._failed()
+            logger.exception("DEVOTIONAL: could not load today's devotional")
+        finally:
+            with self._lock:
+                self._flight = None
+            flight["done"].set()
+        return flight["result"]
+
+    def _failed(self) -> None:
+        self.failures += 1
+        self._retry_at = time.monotonic() + self.RETRY_AFTER
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                if self.refresh() is None:
+                    self._failed()
+            except Exception:
+                self._failed()
+                logger.exception("DEVOTIONAL: background refresh failed")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self) -> dict | None:
+        """
+        Scrapes today's devotional and stores it, once per date.
+
+        The upsert on the unique `date` index keeps a concurrent refresh
+        (the scheduler and the bot) from inserting a second document for
+        the same day.
+
+        Return: the stored devotional, or None if t30.org still shows the
+            previous day's
+        """
+        self.scrapes += 1
+        devotional = WebScrapers.t30()
+        previous = db.devotionals.find_one(
+            {"date": {"$lt": devotional["date"]}}, sort=[("date", DESCENDING)]
+        )
+        if previous is not None and previous["link"] == devotional["link"]:
+            logger.warning(
+                f"DEVOTIONAL: t30.org still shows the devotional of "
+                f"{previous['date']}, not storing it for {devotional['date']}"
+            )
+            return None
+        try:
+            stored = db.devotionals.find_one_and_update(
+                {"date": devotional["date"]},
+                {"$setOnInsert": devotional},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Another process inserted it between our match and insert
+            stored = db.devotionals.find_one({"date": devotional["date"]})
+        with self._lock:
+            self._current = stored
+        logger.info(f"DEVOTIONAL: stored devotional for {stored['date']}")
+        return stored
+
+    def stats(self) -> dict:
+        return {
+            "date": self._current["date"] if self._current else None,
+            "loads": self.loads,
+            "scrapes": self.scrapes,
+            "failures": self.failures,
+        }
+
+
+devotional_cache = DevotionalCache()
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import logger
+
+
+class FetchResult:
+    """
+    A fetched page. `not_modified` is True when the server answered 304 and
+    `text` was read from the on-disk cache.
+    """
+
+    def __init__(self, url: str, status: int, text: str, not_modified: bool) -> None:
+        self.url = url
+        self.status = status
+        self.text = text
+        self.not_modified = not_modified
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HttpFetcher:
+    """
+    The shared HTTP client for the scrapers.
+
+    Every request goes through one pooled `requests.Session` (connections
+    and TLS sessions are reused across scrapes), with a timeout and retries
+    with exponential backoff on connection errors and 429/5xx responses.
+
+    Responses carrying an ETag or Last-Modified header are cached on disk
+    under `cache_dir`, and the next fetch of the same URL is sent as a
+    conditional request. A 304 answer is served from the cache with
+    `not_modified` set, so callers can skip re-parsing an unchanged page.
+    Cache entries are keyed by a hash of the URL and its query parameters;
+    parameters (which may hold API tokens) are never written to disk.
+
+    A caller that skips unchanged pages fetches with `defer_cache=True`
+    and calls `commit` once it has stored what it parsed, so the validators
+    of a page whose processing failed are never saved and the next fetch
+    of it is a full one.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        timeout: tuple = (5, 20),
+        retries: int = 3,
+        backoff: float = 0.5,
+        pool_size: int = 10,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._metrics = {"fetched": 0, "not_modified": 0, "errors": 0}
+        # Cache entries fetched with defer_cache, waiting for commit
+        self._deferred = {}
+
+    def _cache_key(self, url: str, params: dict | None) -> str:
+        key = json.dumps([url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _read_cache(self, key: str) -> dict | None:
+        path = os.path.join(self.cache_dir, key + ".json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"FETCH: unreadable cache entry {path}: {e}")
+            return None
+
+    def _write_cache(self, key: str, entry: dict) -> None:
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, os.path.join(self.cache_dir, key + ".json"))
+        except OSError as e:
+            logger.warning(f"FETCH: could not cache {entry['url']}: {e}")
+
+    def _count(self, metric: str) -> None:
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def fetch(
+        self,
+        url: str,
+        params: dict | None = None,
+        headers: dict | None = None,
+        conditional: bool = True,
+        defer_cache: bool = False,
+    ) -> FetchResult:
+        """
+        GETs a URL, revalidating a cached copy when there is one.
+
+        Keyword arguments:
+        url -- str: the URL to fetch
+        params -- dict: query parameters
+        headers -- dict: extra request headers, e.g. a user-agent
+        conditional -- bool: send If-None-Match/If-Modified-Since from the
+            cache and store validators from the response
+        defer_cache -- bool: hold the validators until `commit` instead of
+            saving them now
+
+        Return: FetchResult
+        Raises: requests.RequestException once retries are exhausted
+        """
+        key = self._cache_key(url, params)
+        cached = self._read_cache(key) if conditional else None
+        headers = dict(headers or {})
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            r = self.session.get(
+                url, params=params, headers=headers, timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            self._count("errors")
+            logger.error(f"FETCH: {url} failed: {e}")
+            raise
+
+        if r.status_code == 304 and cached:
+            self._count("not_modified")
+            logger.info(f"FETCH: {url} not modified")
+            return FetchResult(url, 304, cached["text"], True)
+
+        self._count("fetched")
+        if r.status_code >= 400:
+            logger.warning(f"FETCH: {url} returned {r.status_code}")
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if conditional and r.ok and (etag or last_modified):
+            entry = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "text": r.text,
+            }
+            if defer_cache:
+                with self._lock:
+                    self._deferred[key] = entry
+            else:
+                self._write_cache(key, entry)
+        return FetchResult(url, r.status_code, r.text, False)
+
+    def commit(self, url: str, params: dict | None = None) -> None:
+        """
+        Saves the validators of a page fetched with defer_cache, once the
+        caller has finished with it. Does nothing if there are none.
+        """
+        key = self._cache_key(url, params)
+        with self._lock:
+            entry = self._deferred.pop(key, None)
+        if entry is not None:
+            self._write_cache(key, entry)
+
+    def stats(self) -> dict:
+        """
+        Return: dict with fetched (full responses), not_modified (304s
+            served from the cache) and errors
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+
+# HTTP_CACHE_DIR sets where conditional responses are cached.
+fetcher = HttpFetcher(os.getenv("HTTP_CACHE_DIR") or ".http_cache")
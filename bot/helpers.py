@@ -1,7 +1,13 @@
 from . import db, bot, config
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from .database import set_user_active, get_countries
-from telegram import InlineKeyboardMarkup, CallbackQuery, InlineKeyboardButton
+from .database import set_user_active, get_countries, get_user
+from .broadcast import BroadcastEngine
+from .media_cache import media_cache
+from telegram import (
+    InlineKeyboardMarkup,
+    CallbackQuery,
+    InlineKeyboardButton,
+    Message,
+)
 
 
 def create_day_buttons(month, last_day):
@@ -195,7 +201,7 @@ class PromptHelper:
         chat_id -- identifies a specific user
         Return: None
         """
-        user = db.users.find_one({"chat_id": chat_id})
+        user = get_user(chat_id)
         # Use month numbers instead of names to match callback handler's expectations
         months = [str(i) for i in range(1, 13)]  # "1" through "12"
         # Use month names as display text but month numbers in the data
@@ -246,8 +252,18 @@ class PromptHelper:
 
 
 class MessageHelper:
+    """
+    Thin wrappers over the Telegram send methods used by broadcasts.
+
+    Media given as a local path or URL goes through the media cache, so it
+    is uploaded once and later sends reuse its Telegram file_id. Errors
+    from the Telegram API are not caught here; BroadcastEngine inspects
+    them to tell throttling and network errors apart from users who have
+    blocked the bot.
+    """
+
     @staticmethod
-    def send_text(chat_id: int, message: str) -> bool:
+    def send_text(chat_id: int, message: str, reply_markup=None) -> Message:
         """
         This takes in a user's id and a message string. It sends the
         associated user the message via the Telegram Bot API
@@ -255,19 +271,21 @@ class MessageHelper:
         Keyword arguments:
         chat_id -- identifies a specific user
         message -- str: input message to be sent
+        reply_markup -- optional keyboard to attach to the message
 
-        Return: None or True
+        Return: the sent Message, raises TelegramError if the message was not sent
         """
-        try:
-            bot.send_message(
-                chat_id=chat_id, text=message, disable_web_page_preview="True"
-            )
-            return True
-        except:
-            return False
+        return bot.send_message(
+            chat_id=chat_id,
+            text=message,
+            disable_web_page_preview="True",
+            reply_markup=reply_markup,
+        )
 
     @staticmethod
-    def send_photo(chat_id: int, photo, caption: str = "") -> bool:
+    def send_photo(
+        chat_id: int, photo, caption: str = "", reply_markup=None
+    ) -> Message:
         """
         This takes in an ID, photo and caption. It sends the associated
         user the photo with the given caption via the Telegram Bot API
@@ -276,17 +294,16 @@ class MessageHelper:
         chat_id -- identifies a specific user
         photo -- str: link or path to a picture
         caption -- str: text to associate with the picture
+        reply_markup -- optional keyboard to attach to the picture
 
-        Return: None or True
+        Return: the sent Message, raises TelegramError if the photo was not sent
         """
-        try:
-            bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
-            return True
-        except:
-            return False
+        return media_cache.send(
+            "photo", chat_id, photo, caption=caption, reply_markup=reply_markup
+        )
 
     @staticmethod
-    def send_animation(chat_id: int, animation, caption: str = "") -> bool:
+    def send_animation(chat_id: int, animation, caption: str = "") -> Message:
         """
         This takes in an ID, animation and caption. It sends the associated
         user the animation with the given caption via the Telegram Bot API
@@ -296,13 +313,9 @@ class MessageHelper:
         animation -- str: link or path to the animation
         caption -- str: text to associate with the animation
 
-        Return: None or True
+        Return: the sent Message, raises TelegramError if the animation was not sent
         """
-        try:
-            bot.send_animation(chat_id=chat_id, animation=animation, caption=caption)
-            return True
-        except:
-            return False
+        return media_cache.send("animation", chat_id, animation, caption=caption)
 
     @staticmethod
     def send_video(chat_id, video, caption=""):
@@ -315,13 +328,9 @@ class MessageHelper:
         video -- str: link or path to the video
         caption -- str: text to associate with the video
 
-        Return: None or True
+        Return: the sent Message, raises TelegramError if the video was not sent
         """
-        try:
-            bot.send_video(chat_id=chat_id, video=video, caption=caption)
-            return True
-        except:
-            return False
+        return media_cache.send("video", chat_id, video, caption=caption)
 
 
 class BroadcastHandlers:
@@ -330,42 +339,31 @@ class BroadcastHandlers:
         """
         Generic method for broadcasting messages (text, photo, animation, video) to users.
 
+        Sends are paced to stay within Telegram's rate limits; see
+        BroadcastEngine for the retry and blocked-user handling.
+
         Parameters:
-        users -- list of users to send the message to
+        users -- iterable of chat_ids to send the message to
         content -- the message or media content to send
         send_function -- function from MessageHelper to send the message
         *args -- additional arguments required by the send_function
+
+        Return: dict of delivery statistics from BroadcastEngine.run
         """
+        messages = ((chat_id, (content, *args)) for chat_id in users)
+        return BroadcastEngine().run(messages, send_function)
 
-        # Add counters for success/failure stats
-        success_count = 0
-        failure_count = 0
-
-        def worker(chat_id):
-            try:
-                result = send_function(chat_id, content, *args)
-                return result, None
-            except Exception as e:
-                set_user_active(chat_id, False)
-                return False, e
-
-        # Use more workers for larger broadcasts
-        max_workers = min(20, len(users))
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Map of future to user chat_id
-            future_to_chat_id = {executor.submit(worker, user): user for user in users}
-            for future in as_completed(future_to_chat_id):
-                chat_id = future_to_chat_id[future]
-                success, error = future.result()
-                if error:
-                    failure_count += 1
-                    print(f"Error sending message to {chat_id}: {str(error)}")
-                else:
-                    success_count += 1
-
-        # Return statistics about the broadcast
-        print(
-            f"Broadcast completed: {success_count} successes, {failure_count} failures"
-        )
-        return {"total": len(users), "success": success_count, "failure": failure_count}
+    @staticmethod
+    def broadcast_personalised(messages, send_function):
+        """
+        Sends a different payload to each user through one paced executor.
+
+        Parameters:
+        messages -- iterable of (chat_id, content, *args) tuples, e.g.
+            (chat_id, photo, caption) for MessageHelper.send_photo
+        send_function -- function from MessageHelper to send each message
+
+        Return: dict of delivery statistics from BroadcastEngine.run
+        """
+        payloads = ((message[0], tuple(message[1:])) for message in messages)
+        return BroadcastEngine().run(payloads, send_function)
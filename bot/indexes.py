@@ -0,0 +1,88 @@
+from pymongo.errors import OperationFailure
+from . import db, logger
+from . import database, broadcast_jobs, conversation_manager
+
+# Modules that declare INDEXES and QUERY_SHAPES next to their queries.
+MODULES = [database, conversation_manager, broadcast_jobs]
+
+
+class IndexManager:
+    """
+    Creates the MongoDB indexes declared by the query modules.
+
+    Each module in MODULES lists its indexes as (collection, keys, options)
+    in INDEXES, and representative queries as (collection, filter, sort) in
+    QUERY_SHAPES. `ensure_indexes` is idempotent: create_index is a no-op
+    for an index that already exists with the same keys and options.
+    """
+
+    @staticmethod
+    def declared_indexes() -> list:
+        return [spec for module in MODULES for spec in getattr(module, "INDEXES", [])]
+
+    @staticmethod
+    def declared_query_shapes() -> list:
+        return [
+            shape for module in MODULES for shape in getattr(module, "QUERY_SHAPES", [])
+        ]
+
+    @staticmethod
+    def ensure_indexes() -> dict:
+        """
+        Creates every declared index that does not exist yet.
+
+        An index that cannot be built (e.g. a unique index over duplicate
+        values, or a conflicting existing index) is logged and skipped so
+        the bot still starts.
+
+        Return: dict with ensured and failed index counts
+        """
+        result = {"ensured": 0, "failed": 0}
+        for collection, keys, options in IndexManager.declared_indexes():
+            try:
+                name = db[collection].create_index(keys, **options)
+                result["ensured"] += 1
+                logger.debug(f"INDEXES: {collection}.{name} ensured")
+            except OperationFailure as e:
+                result["failed"] += 1
+                logger.error(f"INDEXES: could not create {collection} {keys}: {e}")
+        logger.info("INDEXES: {ensured} ensured, {failed} failed".format(**result))
+        return result
+
+    @staticmethod
+    def _stages(plan: dict) -> list:
+        """
+        Returns the names of every stage in an explain() plan tree.
+        """
+        stages = [plan["stage"]] if "stage" in plan else []
+        children = list(plan.get("inputStages", []))
+        for key in ("inputStage", "queryPlan"):
+            if key in plan:
+                children.append(plan[key])
+        for child in children:
+            stages.extend(IndexManager._stages(child))
+        return stages
+
+    @staticmethod
+    def report_collscans() -> list:
+        """
+        Explains every declared query shape and logs those whose winning
+        plan still scans the whole collection.
+
+        Return: list of (collection, filter, sort) shapes doing a COLLSCAN
+        """
+        collscans = []
+        for collection, query, sort in IndexManager.declared_query_shapes():
+            cursor = db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            except (OperationFailure, KeyError) as e:
+                logger.warning(f"INDEXES: could not explain {collection} {query}: {e}")
+                continue
+            if "COLLSCAN" in IndexManager._stages(plan):
+                collscans.append((collection, query, sort))
+                logger.warning(f"INDEXES: COLLSCAN for {collection} {query} {sort}")
+        logger.info(f"INDEXES: {len(collscans)} query shapes doing a COLLSCAN")
+        return collscans
@@ -0,0 +1,200 @@
+import os
+import time
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Takes its collection as an argument and imports nothing from the bot
+# package, so scripts/check_job_lease.py can run it against a local mongod
+# without the bot's secrets.
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    """
+    A held job lease. `token` is the fencing token: it increases every
+    time the lease changes hands, so a holder that stalled past its expiry
+    can tell (and be told) that its token is stale.
+    """
+
+    def __init__(self, name: str, occurrence, token: int, holder: str) -> None:
+        self.name = name
+        self.occurrence = occurrence
+        self.token = token
+        self.holder = holder
+        self.lost = threading.Event()
+
+    def valid(self) -> bool:
+        return not self.lost.is_set()
+
+    def check(self) -> None:
+        """
+        Raises LeaseLost if the heartbeat found the lease taken over.
+        """
+        if self.lost.is_set():
+            raise LeaseLost(f"{self.name} token {self.token}")
+
+    def fenced(self, iterable):
+        """
+        Yields from iterable until the lease is lost, so a stalled holder
+        stops sending as soon as its heartbeat fails.
+        """
+        for item in iterable:
+            if self.lost.is_set():
+                logger.warning(
+                    f"JOB LEASE {self.name}: lost token {self.token}, stopping"
+                )
+                return
+            yield item
+
+
+class JobLeaseManager:
+    """
+    Makes each occurrence of a scheduled job run in only one process.
+
+    Every job has one document in `collection`, keyed by job name, holding
+    the current holder, the lease expiry, a fencing token and the last
+    occurrence run. `acquire` is a single findOneAndUpdate that succeeds
+    only if the lease is free or expired and the occurrence has not been
+    completed, so of several schedulers firing the same occurrence exactly
+    one gets it. While the job runs a heartbeat renews the lease every
+    ttl/3 seconds; a renewal rejected because another process took the
+    lease over (after this one stalled past the expiry) marks the lease
+    lost.
+
+    A holder that crashes releases nothing: its lease expires after `ttl`
+    and the occurrence, not marked done, can be acquired again.
+    """
+
+    def __init__(self, collection, ttl: float = 300, holder: str | None = None):
+        self.collection = collection
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+
+    def acquire(self, name: str, occurrence) -> Lease | None:
+        """
+        Return: the Lease, or None if another process holds the lease or
+            has already completed this occurrence
+        """
+        now = datetime.now()
+        try:
+            doc = self.collection.find_one_and_update(
+                {
+                    "_id": name,
+                    "done": {"$ne": occurrence},
+                    "$or": [{"holder": None}, {"expires_at": {"$lt": now}}],
+                },
+                {
+                    "$set": {
+                        "holder": self.holder,
+                        "occurrence": occurrence,
+                        "acquired_at": now,
+                        "expires_at": now + timedelta(seconds=self.ttl),
+                    },
+                    "$inc": {"token": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The document exists and did not match: the lease is held
+            return None
+        return Lease(name, occurrence, doc["token"], self.holder)
+
+    def renew(self, lease: Lease) -> bool:
+        """
+        Extends a held lease; fails once another holder has taken it over.
+        """
+        result = self.collection.update_one(
+            {"_id": lease.name, "token": lease.token, "holder": lease.holder},
+            {"$set": {"expires_at": datetime.now() + timedelta(seconds=self.ttl)}},
+        )
+        if result.matched_count == 0:
+            lease.lost.set()
+        return result.matched_count == 1
+
+    def release(self, lease: Lease, done: bool = True) -> None:
+        """
+        Frees the lease, recording the occurrence as done if it completed.
+        """
+        update = {"holder": None, "expires_at": datetime.now()}
+        if done:
+            update["done"] = lease.occurrence
+        result = self.collection.update_one(
+            {"_id": lease.name, "token": lease.token, "holder": lease.holder},
+            {"$set": update},
+        )
+        if result.matched_count == 0:
+            logger.warning(
+                f"JOB LEASE {lease.name}: token {lease.token} was taken over "
+                "before release"
+            )
+
+    def _heartbeat(self, lease: Lease, stop: threading.Event) -> None:
+        while not stop.wait(self.ttl / 3):
+            try:
+                if not self.renew(lease):
+                    logger.error(
+                        f"JOB LEASE {lease.name}: lost to another holder "
+                        f"(token {lease.token})"
+                    )
+                    return
+            except Exception:
+                logger.exception(f"JOB LEASE {lease.name}: renewal failed")
+
+    def run(self, name: str, occurrence, fn, *args) -> bool:
+        """
+        Runs fn(lease, *args) if this process wins the occurrence.
+
+        Return: True if fn ran to completion here
+        """
+        lease = self.acquire(name, occurrence)
+        if lease is None:
+            logger.info(f"JOB LEASE {name}: occurrence {occurrence} taken elsewhere")
+            return False
+        logger.info(f"JOB LEASE {name}: running {occurrence} (token {lease.token})")
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(lease, stop), daemon=True
+        )
+        heartbeat.start()
+        completed = False
+        try:
+            fn(lease, *args)
+            completed = lease.valid()
+        except LeaseLost:
+            logger.warning(f"JOB LEASE {name}: stopped, lease lost")
+        finally:
+            stop.set()
+            heartbeat.join()
+            # A failed run is not marked done, so a later firing of the
+            # same occurrence (e.g. a misfired scheduler) can retry it
+            self.release(lease, done=completed)
+        return completed
+
+    def exclusive(self, period: float):
+        """
+        Decorates a scheduled job fn(lease) so one process runs it per
+        occurrence. Occurrences are `period`-second buckets of the epoch,
+        so every scheduler firing the same cron slot agrees on the key.
+        """
+
+        def decorate(fn):
+            def job():
+                occurrence = int(time.time() // period)
+                self.run(fn.__name__, occurrence, fn)
+
+            # Not functools.wraps: APScheduler checks the signature it
+            # exposes against the (empty) job arguments
+            job.__name__, job.__doc__ = fn.__name__, fn.__doc__
+            return job
+
+        return decorate
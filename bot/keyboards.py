@@ -1,4 +1,4 @@
-from . import db
+from .database import get_user
 from telegram import KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 
 from telegram import KeyboardButton
@@ -59,7 +59,7 @@ def validate_user_keyboard(chat_id) -> list:
     chat_id -- user's telegram chat_id
     Return: returns correct keyboard for user
     """
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
     if user["admin"] == True:
         return admin_keyboard
     elif user["role"] == "counselor":
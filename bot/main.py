@@ -1,6 +1,13 @@
 import os
+import threading
 from . import dp, updater, PORT, db, config, bot
-from .database import search_db_title, set_user_last_command
+from .database import search_db_title, set_user_last_command, get_user, update_user
+from .broadcast_jobs import BroadcastJobManager
+from .indexes import IndexManager
+from .devotional_cache import devotional_cache
+from .router import command_router, state_router, callback_router
+from .workers import update_workers, relay_lanes
+from .conversation_manager import message_buffer
 from .commands import (
     get_devotional,
     latest_sermon,
@@ -34,39 +41,18 @@ from .commands import (
     handle_location_not_set_first_time,
     handle_location_not_set_for_counseling,
     handle_birthday_not_set,
+    send_sermon,
+    sermon_search,
+    sermon_search_callback_handler,
 )
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CallbackQueryHandler, CommandHandler
 from telegram.ext import Filters
 from telegram.ext import MessageHandler
-from chat.chat_message_handlers import (
-    counseling,
-    handle_counseling,
-    handle_ask_question_or_request_counselor,
-    handle_counselor_request_yes,
-    handle_counseling_info_confirm,
-    handle_counseling_location_confirm,
-    handle_get_faq_callback,
-)
-from chat.chat_callback_handlers import (
-    show_active_requests,
-    show_new_requests,
-    conversation_handler,
-    counselor_transfer_msg_confirm_cb_handler,
-    counselor_transfer_msg_handler,
-    notify_pastors,
-    handle_initial_conversation_cb,
-    end_conversation_cb_handler,
-    end_conversation_quick_cb_handler,
-    handle_counseling_feedback_cb,
-    mark_request_completed_cb,
-    counselor_transfer_callback_handler,
-    counselor_transfer,
-    follow_up_request_cb,
-    continue_conversation_cb,
-    cancel_follow_up_cb,
-    handle_active_requests_verification,
-)
+
+# Importing the chat handlers registers their routes with the routers.
+import chat.chat_message_handlers
+from chat.chat_callback_handlers import notify_pastors, counselor_transfer
 from dotenv import dotenv_values, load_dotenv
 
 load_dotenv()
@@ -83,43 +69,7 @@ def handle_message_commands(update, context):
 
     Return: None
     """
-
-    title = update.message.text.lower()
-
-    if title == "devotional":
-        get_devotional(update, context)
-    elif title == "latest sermon":
-        latest_sermon(update, context)
-    elif title == "get sermon":
-        get_sermon(update, context)
-    elif title == "help":
-        helps(update, context)
-    elif title == "find user":
-        find_user(update, context)
-    elif title == "statistics":
-        stats(update, context)
-    elif title == "broadcast":
-        broadcast_message_handler(update, context)
-    elif title == "map":
-        map_loc(update, context)
-    elif title == "cancel":
-        cancel(update, context)
-    elif title == "reboot camp":
-        reboot_about(update, context)
-    elif title == "counseling":
-        counseling(update, context)
-    elif title == "menu":
-        menu(update, context)
-    elif title == "view active requests":
-        show_active_requests(update, context)
-    elif title == "view new requests":
-        show_new_requests(update, context)
-    elif title == "counselor dashboard":
-        counselor_dashboard(update, context)
-    elif title == "location":
-        set_church_location(update, context)
-    else:
-        unknown(update, context)
+    command_router.dispatch(update.message.text.lower(), update, context)
 
 
 def handle_message_response(update, context):
@@ -127,244 +77,217 @@ def handle_message_response(update, context):
     Handles actions for messages
     """
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
     last_command = user["last_command"]
 
     if last_command == None:
         handle_message_commands(update, context)
-    elif last_command == "first_time_location_set":
-        handle_location_not_set_first_time(update, context)
-    elif last_command == "first_time_birthday_set":
-        handle_birthday_not_set(update, context)
-    elif last_command.startswith("location_counseling"):
-        handle_location_not_set_for_counseling(update, context)
-    elif last_command.startswith("in-conversation-with"):
-        conversation_handler(update, context)
-    elif last_command == "find_user":
-        find_user_message_handler(update, context)
-    elif last_command == "select_topics":
-        handle_topic_selection(update, context)
-    elif last_command == "verify_counselor":
-        handle_counselor_verification(update, context)
-    elif last_command == "verify_active_requests":
-        handle_active_requests_verification(update, context)
-    elif last_command.startswith("update_user"):
-        handle_update_user(update, context)
-    elif last_command == "get_sermon":
-        title = update.message.text.strip()
-        sermons = search_db_title(title)
-        if len(sermons) == 0:
-            context.bot.send_message(
-                chat_id=chat_id, text=config["messages"]["empty"].format(title)
-            )
-        else:
-            for sermon in sermons:
-                if sermon["video"] is not None:
-                    buttons = [
-                        [
-                            InlineKeyboardButton(
-                                "Download Sermon", url=sermon["download"]
-                            )
-                        ],
-                        [InlineKeyboardButton("Watch Video", url=sermon["video"])],
-                    ]
-                    context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=sermon["image"],
-                        caption=sermon["title"],
-                        reply_markup=InlineKeyboardMarkup(buttons),
-                    )
-                else:
-                    button = [
-                        [InlineKeyboardButton("Download Sermon", url=sermon["link"])]
-                    ]
-                    context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=sermon["image"],
-                        caption=sermon["title"],
-                        reply_markup=InlineKeyboardMarkup(button),
-                    )
-        menu(update, context)
-    elif last_command.startswith("broadcast"):
-        handle_broadcast(update, context)
-
-    elif last_command == "map":
+    else:
+        state_router.dispatch(last_command, update, context)
+
+
+def cb_handle(update, context):
+    q_head = update.callback_query.data.split("=")
+    callback_router.dispatch(q_head[0], update, context)
+
+
+def sermon_search_response(update, context):
+    sermon_search(update, context)
+    menu(update, context)
+
+
+def map_response(update, context):
+    chat_id = update.effective_chat.id
+    context.bot.send_message(
+        chat_id=chat_id,
+        text=config["messages"]["map_feedback"],
+        parse_mode="Markdown",
+    )
+    set_user_last_command(chat_id, None)
+
+
+def counseling_note_response(update, context):
+    chat_id = update.effective_chat.id
+    message_id = int(get_user(chat_id)["last_command"].split("=")[-1])
+    text = update.message.text
+    db.counseling_requests.update_one(
+        {"request_message_id": message_id}, {"$set": {"active": True, "note": text}}
+    )
+    req = db.counseling_requests.find_one({"request_message_id": message_id})
+    context.bot.send_message(chat_id=chat_id, text=config["messages"]["cr_done"])
+    done(update, context)
+    # Notify pastors in particular category about new request.
+    notify_pastors(req)
+
+
+def feedback_response(update, context):
+    chat_id = update.effective_chat.id
+    type = get_user(chat_id)["last_command"].split("=")[-1]
+    message = update.message.text
+
+    db.feedback.insert_one(
+        {"type": type, "message": message, "status": "pending", "user": chat_id}
+    )
+    context.bot.send_message(chat_id=chat_id, text=config["messages"]["feedback_done"])
+    set_user_last_command(chat_id, None)
+
+
+def broadcast_cb(update, context):
+    chat_id = update.effective_chat.id
+    q_head = update.callback_query.data.split("=")
+    if q_head[1] == "all":
         context.bot.send_message(
             chat_id=chat_id,
-            text=config["messages"]["map_feedback"],
-            parse_mode="Markdown",
-        )
-        set_user_last_command(chat_id, None)
-    elif last_command.startswith("counselor_request"):
-        topic = last_command.split("=")[-1]
-        handle_counselor_request_yes(update, context, topic)
-    elif last_command.startswith("cr_yes"):
-        message_id = int(last_command.split("=")[-1])
-        text = update.message.text
-        db.counseling_requests.update_one(
-            {"request_message_id": message_id}, {"$set": {"active": True, "note": text}}
-        )
-        req = db.counseling_requests.find_one({"request_message_id": message_id})
-        context.bot.send_message(chat_id=chat_id, text=config["messages"]["cr_done"])
-        done(update, context)
-        # Notify pastors in particular category about new request.
-        notify_pastors(req)
-    elif last_command.startswith("feedback"):
-        type = last_command.split("=")[-1]
-        message = update.message.text
-
-        db.feedback.insert_one(
-            {"type": type, "message": message, "status": "pending", "user": chat_id}
+            text=config["messages"]["bc_prompt"],
         )
-        context.bot.send_message(
-            chat_id=chat_id, text=config["messages"]["feedback_done"]
-        )
-        set_user_last_command(chat_id, None)
-    elif last_command.startswith("transfer_req"):
-        counselor_transfer_msg_handler(update, context)
+        set_user_last_command(chat_id, "broadcast")
 
 
-def cb_handle(update, context):
+def sermon_cb(update, context):
+    """
+    Search db for sermons
+    """
+    sermons = search_db_title(update.callback_query.data[2:], limit=1)
+    if sermons:
+        send_sermon(update.effective_chat.id, sermons[0])
+
+
+def birthday_cb(update, context):
     chat_id = update.effective_chat.id
-    callback = update.callback_query
-    q = callback.data
+    q = update.callback_query.data
     q_head = q.split("=")
-    if q_head[0] == "map":
-        # TODO: refactor map location handling
-        pass
-    elif q_head[0] == "update":
-        handle_find_user_callback(update, context)
-    elif q_head[0] == "counsel":
-        handle_counseling(update, context)
-    elif q_head[0] == "qa_or_c":
-        handle_ask_question_or_request_counselor(update, context)
-    elif q_head[0] == "bc":
-        if q_head[1] == "all":
-            context.bot.send_message(
-                chat_id=chat_id,
-                text=config["messages"]["bc_prompt"],
-            )
-            set_user_last_command(chat_id, "broadcast")
-    # Search db for sermons
-    elif q_head[0] == "s":
-        sermon = search_db_title(q[2:])[0]
-        if sermon["video"] is not None:
-            button = [
-                [InlineKeyboardButton("Download Sermon", url=sermon["download"])],
-                [InlineKeyboardButton("Watch Video", url=sermon["video"])],
-            ]
+    if len(q_head) == 2:
+        month = q_head[1]
+        if month in ["9", "4", "6", "11"]:
+            last_day = 30
+        elif month == "2":
+            last_day = 29  # Assuming leap year to be safe
         else:
-            button = [[InlineKeyboardButton("Download Sermon", url=sermon["link"])]]
-        context.bot.send_photo(
+            last_day = 31
+
+        # Create a proper grid of day buttons (7 days per row)
+        day_buttons = []
+        cols = 7  # 7 columns for days (like a calendar)
+
+        # Generate buttons for each day
+        current_row = []
+        for day in range(1, last_day + 1):
+            current_row.append(
+                InlineKeyboardButton(str(day), callback_data=f"bd={month}={day}")
+            )
+
+            # Start a new row after reaching the column limit
+            if len(current_row) == cols:
+                day_buttons.append(current_row)
+                current_row = []
+
+        # Add any remaining buttons in the last row
+        if current_row:
+            day_buttons.append(current_row)
+
+        context.bot.send_message(
             chat_id=chat_id,
-            photo=sermon["image"],
-            caption=sermon["title"],
-            reply_markup=InlineKeyboardMarkup(button),
+            text=config["messages"]["birthday_day"],
+            reply_markup=InlineKeyboardMarkup(day_buttons),
         )
-    elif q_head[0] == "loc":
-        church_location_callback_handler(update, context)
-    elif q_head[0] == "br":
-        handle_branch_selection_callback(update, context)
-    elif q_head[0] == "bd":
-        if len(q_head) == 2:
-            month = q_head[1]
-            if month in ["9", "4", "6", "11"]:
-                last_day = 30
-            elif month == "2":
-                last_day = 29  # Assuming leap year to be safe
-            else:
-                last_day = 31
-
-            # Create a proper grid of day buttons (7 days per row)
-            day_buttons = []
-            cols = 7  # 7 columns for days (like a calendar)
-
-            # Generate buttons for each day
-            current_row = []
-            for day in range(1, last_day + 1):
-                current_row.append(
-                    InlineKeyboardButton(str(day), callback_data=f"bd={month}={day}")
-                )
-
-                # Start a new row after reaching the column limit
-                if len(current_row) == cols:
-                    day_buttons.append(current_row)
-                    current_row = []
-
-            # Add any remaining buttons in the last row
-            if current_row:
-                day_buttons.append(current_row)
+    else:
+        update_user(
+            chat_id,
+            {"$set": {"birthday": q.split("=")[1] + "-" + q.split("=")[2]}},
+        )
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=config["messages"]["birthday_confirm"].format(
+                q.split("=")[1] + "/" + q.split("=")[2]
+            ),
+        )
+        set_user_last_command(chat_id, None)
 
-            context.bot.send_message(
-                chat_id=chat_id,
-                text=config["messages"]["birthday_day"],
-                reply_markup=InlineKeyboardMarkup(day_buttons),
-            )
-        else:
-            db.users.update_one(
-                {"chat_id": chat_id},
-                {"$set": {"birthday": q.split("=")[1] + "-" + q.split("=")[2]}},
-            )
-            context.bot.send_message(
-                chat_id=chat_id,
-                text=config["messages"]["birthday_confirm"].format(
-                    q.split("=")[1] + "/" + q.split("=")[2]
-                ),
-            )
-            set_user_last_command(chat_id, None)
-    elif q_head[0] == "get-sermon":
-        if q_head[1] == "yes":
-            context.bot.send_message(
-                chat_id=chat_id, text=config["messages"]["get_sermon_1"]
-            )
-            set_user_last_command(chat_id, "get_sermon")
-        else:
-            buttons = []
-            context.bot.send_message(
-                chat_id=chat_id,
-                text=config["messages"]["get_sermon_2"],
-                reply_markup=InlineKeyboardMarkup(buttons),
-            )
-    elif q_head[0] == "confirm_info":
-        handle_counseling_info_confirm(update, context)
-    elif q_head[0] == "confirm_loc":
-        handle_counseling_location_confirm(update, context)
-    elif q_head[0] == "cr-yes":
-        user_local_church = db.users.find_one({"chat_id": chat_id}).get("location")
-        db.counseling_requests.update_one(
-            {"request_message_id": int(q_head[1])},
-            {"$set": {"location": user_local_church}},
+
+def get_sermon_cb(update, context):
+    chat_id = update.effective_chat.id
+    q_head = update.callback_query.data.split("=")
+    if q_head[1] == "yes":
+        context.bot.send_message(
+            chat_id=chat_id, text=config["messages"]["get_sermon_1"]
         )
+        set_user_last_command(chat_id, "get_sermon")
+    else:
+        buttons = []
         context.bot.send_message(
-            chat_id=chat_id, text=config["messages"]["cr_yes_confirm"]
+            chat_id=chat_id,
+            text=config["messages"]["get_sermon_2"],
+            reply_markup=InlineKeyboardMarkup(buttons),
         )
-        set_user_last_command(chat_id, "cr_yes=" + q_head[1])
-    elif q_head[0] == "conv":
-        handle_initial_conversation_cb(update, context)
-    elif q_head[0] == "mark_complete":
-        mark_request_completed_cb(update, context)
-    elif q_head[0] == "follow_up":
-        follow_up_request_cb(update, context)
-    elif q_head[0] == "continue_conv":
-        continue_conversation_cb(update, context)
-    elif q_head[0] == "cancel_follow_up":
-        cancel_follow_up_cb(update, context)
-    elif q_head[0] == "end_conv":
-        end_conversation_cb_handler(update, context)
-    elif q_head[0] == "end_conv_quick":
-        end_conversation_quick_cb_handler(update, context)
-    elif q_head[0] == "faq":
-        handle_get_faq_callback(update, context)
-    elif q_head[0] == "feedback":
-        feedback_cb_handler(update, context)
-    elif q_head[0] == "counseling_feedback":
-        handle_counseling_feedback_cb(update, context)
-    elif q_head[0] == "transfer":
-        counselor_transfer_callback_handler(update, context)
-    elif q_head[0] == "transfer_req_confirm":
-        counselor_transfer_msg_confirm_cb_handler(update, context)
-    elif q_head[0] == "update_topics":
-        handle_counselor_topic_update(update, context)
+
+
+def counseling_note_cb(update, context):
+    chat_id = update.effective_chat.id
+    q_head = update.callback_query.data.split("=")
+    user_local_church = get_user(chat_id).get("location")
+    db.counseling_requests.update_one(
+        {"request_message_id": int(q_head[1])},
+        {"$set": {"location": user_local_church}},
+    )
+    context.bot.send_message(chat_id=chat_id, text=config["messages"]["cr_yes_confirm"])
+    set_user_last_command(chat_id, "cr_yes=" + q_head[1])
+
+
+# Routes for the bot's own handlers; the chat package registers its routes
+# in chat/chat_message_handlers.py and chat/chat_callback_handlers.py.
+for text, handler in {
+    "devotional": get_devotional,
+    "latest sermon": latest_sermon,
+    "get sermon": get_sermon,
+    "help": helps,
+    "find user": find_user,
+    "statistics": stats,
+    "broadcast": broadcast_message_handler,
+    "map": map_loc,
+    "cancel": cancel,
+    "reboot camp": reboot_about,
+    "menu": menu,
+    "counselor dashboard": counselor_dashboard,
+    "location": set_church_location,
+}.items():
+    command_router.register(text, handler)
+command_router.default = unknown
+
+for state, handler in {
+    "first_time_location_set": handle_location_not_set_first_time,
+    "first_time_birthday_set": handle_birthday_not_set,
+    "find_user": find_user_message_handler,
+    "select_topics": handle_topic_selection,
+    "verify_counselor": handle_counselor_verification,
+    "get_sermon": sermon_search_response,
+    "map": map_response,
+}.items():
+    state_router.register(state, handler)
+
+for prefix, handler in {
+    "location_counseling": handle_location_not_set_for_counseling,
+    "update_user": handle_update_user,
+    "broadcast": handle_broadcast,
+    "cr_yes": counseling_note_response,
+    "feedback": feedback_response,
+}.items():
+    state_router.register(prefix, handler, prefix=True)
+
+for head, handler in {
+    # TODO: refactor map location handling ("map" callbacks are ignored)
+    "update": handle_find_user_callback,
+    "bc": broadcast_cb,
+    "s": sermon_cb,
+    "ss": sermon_search_callback_handler,
+    "loc": church_location_callback_handler,
+    "br": handle_branch_selection_callback,
+    "bd": birthday_cb,
+    "get-sermon": get_sermon_cb,
+    "cr-yes": counseling_note_cb,
+    "feedback": feedback_cb_handler,
+    "update_topics": handle_counselor_topic_update,
+}.items():
+    callback_router.register(head, handler)
 
 
 msg_handler = MessageHandler(Filters.all & (~Filters.command), handle_message_response)
@@ -372,14 +295,28 @@ cb_handler = CallbackQueryHandler(cb_handle)
 
 
 def main(deploy: bool = False) -> None:
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("mute", mute))
-    dp.add_handler(CommandHandler("unmute", unmute))
-    dp.add_handler(CommandHandler("cancel", cancel))
-    dp.add_handler(CommandHandler("feedback", feedback))
-    dp.add_handler(CommandHandler("transfer", counselor_transfer))
-    dp.add_handler(msg_handler)
-    dp.add_handler(cb_handler)
+    handlers = [
+        CommandHandler("start", start),
+        CommandHandler("mute", mute),
+        CommandHandler("unmute", unmute),
+        CommandHandler("cancel", cancel),
+        CommandHandler("feedback", feedback),
+        CommandHandler("transfer", counselor_transfer),
+        msg_handler,
+        cb_handler,
+    ]
+    for handler in handlers:
+        # Runs the handler on the update worker pool when UPDATE_WORKERS is set
+        handler.callback = update_workers.wrap(handler.callback)
+        dp.add_handler(handler)
+
+    IndexManager.ensure_indexes()
+    IndexManager.report_collscans()
+
+    # Finish any broadcast interrupted by a restart without blocking startup
+    threading.Thread(target=BroadcastJobManager.resume_jobs, daemon=True).start()
+    # Load today's devotional before the first user asks for it
+    threading.Thread(target=devotional_cache.get, daemon=True).start()
 
     if deploy:
         URL = "https://cci-bot-be313a646eb4.herokuapp.com/"
@@ -391,3 +328,6 @@ def main(deploy: bool = False) -> None:
         updater.start_polling()
 
     updater.idle()
+    update_workers.shutdown(wait=True)
+    relay_lanes.shutdown(wait=True)
+    message_buffer.close()
@@ -0,0 +1,175 @@
+import os
+import hashlib
+import time
+import threading
+import requests
+from datetime import datetime
+from telegram.error import BadRequest
+from . import bot, db, logger
+from .fetcher import fetcher
+
+SEND_METHODS = {
+    "photo": bot.send_photo,
+    "video": bot.send_video,
+    "animation": bot.send_animation,
+}
+
+
+def _file_id(kind: str, message) -> str | None:
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None) or message.document
+    return media.file_id if media else None
+
+
+class MediaCache:
+    """
+    Remembers the Telegram file_id of media the bot has already sent.
+
+    Local files are keyed by path and a SHA-256 of their contents, so
+    editing an image invalidates its entry. Remote media is keyed by URL and
+    a hash of its validators (ETag, Last-Modified, Content-Length from a
+    HEAD request), or of its content when the server sends none, so new
+    media at the same URL gets a new entry. The remote hash is rechecked at
+    most every REVALIDATE_AFTER seconds per URL.
+    Entries live in memory and in the `media_cache` collection so they
+    survive restarts. Concurrent sends of the same uncached media wait for
+    the first upload instead of uploading in parallel.
+    """
+
+    REVALIDATE_AFTER = 600
+
+    def __init__(self) -> None:
+        self._file_ids = {}
+        self._digests = {}
+        self._remote_digests = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_cacheable(source) -> bool:
+        """
+        Returns True for local file paths and http(s) URLs; anything else
+        (a file_id or an open file) is sent as-is.
+        """
+        if not isinstance(source, str):
+            return False
+        return source.startswith(("http://", "https://")) or os.path.isfile(source)
+
+    def _digest(self, path: str) -> str:
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(signature)
+        if digest is None:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            self._digests[signature] = digest
+        return digest
+
+    def _remote_digest(self, url: str) -> str | None:
+        checked = self._remote_digests.get(url)
+        if checked and time.monotonic() - checked[0] < self.REVALIDATE_AFTER:
+            return checked[1]
+        try:
+            r = fetcher.session.head(url, allow_redirects=True, timeout=fetcher.timeout)
+            validators = [
+                r.headers.get(name)
+                for name in ("ETag", "Last-Modified", "Content-Length")
+            ]
+            if r.ok and any(validators[:2]):
+                content = "|".join(v or "" for v in validators).encode()
+            else:
+                r = fetcher.session.get(url, timeout=fetcher.timeout)
+                r.raise_for_status()
+                content = r.content
+        except requests.RequestException as e:
+            # Keyed by URL alone until the source can be checked again
+            logger.warning(f"MEDIA CACHE: could not check {url}: {e}")
+            return checked[1] if checked else None
+        digest = hashlib.sha256(content).hexdigest()
+        self._remote_digests[url] = (time.monotonic(), digest)
+        return digest
+
+    def key(self, kind: str, source: str) -> str:
+        if source.startswith(("http://", "https://")):
+            digest = self._remote_digest(source)
+            return f"{kind}:{source}:{digest}" if digest else f"{kind}:{source}"
+        return f"{kind}:{source}:{self._digest(source)}"
+
+    def get(self, key: str) -> str | None:
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            doc = db.media_cache.find_one({"_id": key}, {"file_id": 1})
+            if doc:
+                file_id = self._file_ids[key] = doc["file_id"]
+        return file_id
+
+    def put(self, key: str, source: str, file_id: str) -> None:
+        self._file_ids[key] = file_id
+        db.media_cache.update_one(
+            {"_id": key},
+            {"$set": {"source": source, "file_id": file_id, "updated": datetime.now()}},
+            upsert=True,
+        )
+
+    def invalidate(self, key: str) -> None:
+        self._file_ids.pop(key, None)
+        db.media_cache.delete_one({"_id": key})
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _upload(self, kind: str, key: str, source: str, chat_id: int, **kwargs):
+        send = SEND_METHODS[kind]
+        if source.startswith(("http://", "https://")):
+            message = send(chat_id, source, **kwargs)
+        else:
+            with open(source, "rb") as f:
+                message = send(chat_id, f, **kwargs)
+        file_id = _file_id(kind, message)
+        if file_id:
+            self.put(key, source, file_id)
+        return message
+
+    def send(self, kind: str, chat_id: int, source, **kwargs):
+        """
+        Sends a photo, video or animation, reusing a cached file_id if any.
+
+        Keyword arguments:
+        kind -- str: "photo", "video" or "animation"
+        chat_id -- int: identifies a specific user
+        source -- local path, URL, file_id or file object
+        kwargs -- passed through to the bot send method
+
+        Return: the sent Message
+        """
+        send = SEND_METHODS[kind]
+        if not self.is_cacheable(source):
+            return send(chat_id, source, **kwargs)
+
+        key = self.key(kind, source)
+        file_id = self.get(key)
+        if file_id is None:
+            with self._key_lock(key):
+                file_id = self.get(key)
+                if file_id is None:
+                    return self._upload(kind, key, source, chat_id, **kwargs)
+
+        try:
+            return send(chat_id, file_id, **kwargs)
+        except BadRequest as e:
+            if "file identifier" not in str(e).lower():
+                raise
+            # Telegram no longer recognises the file_id; upload it again,
+            # unless a concurrent send already replaced it
+            with self._key_lock(key):
+                current = self.get(key)
+                if current is not None and current != file_id:
+                    return send(chat_id, current, **kwargs)
+                logger.warning(f"MEDIA CACHE: dropping stale file_id for {source}: {e}")
+                self.invalidate(key)
+                return self._upload(kind, key, source, chat_id, **kwargs)
+
+
+media_cache = MediaCache()
@@ -0,0 +1,141 @@
+"""
+HTML parsing for the scrapers in bot/scrapers.py.
+
+Each parser builds only the parts of the page it reads: a SoupStrainer
+limits the tree to the matching tags and their children, and lxml is used
+as the parser backend when it is installed. The functions take the page
+HTML and do no I/O, so they run offline against the fixtures in
+benchmarks/fixtures.
+
+This module deliberately imports nothing from the bot package, so the
+benchmark can load it without the Telegram and MongoDB clients that
+bot/__init__.py creates.
+"""
+
+import logging
+from datetime import date
+from bs4 import BeautifulSoup, SoupStrainer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import lxml  # noqa: F401
+
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+SERMON_TITLE = {"class": "cmsmasters_sermon_title entry-title"}
+SERMON_DOWNLOAD = {
+    "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_download"
+}
+SERMON_VIDEO = {
+    "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_video"
+}
+
+
+def has_class(*names):
+    """
+    Returns a SoupStrainer attribute matcher for tags with any of the
+    classes. While parsing, the class attribute is not yet split into a
+    list, so a plain list of classes would only match single-class tags.
+    """
+
+    def match(value) -> bool:
+        if not value:
+            return False
+        classes = value.split() if isinstance(value, str) else value
+        return any(name in classes for name in names)
+
+    return match
+
+
+SERMON_STRAINER = SoupStrainer("article")
+T30_STRAINER = SoupStrainer(
+    ["h3", "div"], class_=has_class("td-module-title", "td-module-thumb", "td-excerpt")
+)
+LOCATIONS_STRAINER = SoupStrainer("span", class_=has_class("elementskit-tab-title"))
+
+
+def make_soup(html: str, strainer: SoupStrainer | None = None) -> BeautifulSoup:
+    """
+    Parses html with the fastest available backend, keeping only the tags
+    matched by `strainer` (and their children) when one is given.
+    """
+    return BeautifulSoup(html, PARSER, parse_only=strainer)
+
+
+def between(html: str, start: str, end: str) -> str:
+    """
+    Returns html from the first `start` to the end of the last `end`, or
+    the whole page if either is missing. Every match of a strainer for
+    tags opening with `start` and closing with `end` lies in that span, so
+    the rest of the page (head, scripts, menus, footer) is not tokenized.
+    """
+    first, last = html.find(start), html.rfind(end)
+    if first == -1 or last < first:
+        return html
+    return html[first : last + len(end)]
+
+
+def parse_sermons(html: str) -> list:
+    """
+    Parses the sermon articles of a media.ccing.org listing page.
+
+    Return: list of dicts with title, download, video, link and image;
+        video is None when an article has no video link
+    """
+    sermons = []
+    html = between(html, "<article", "</article>")
+    for article in make_soup(html, SERMON_STRAINER).find_all("article"):
+        heading = article.find("h3", SERMON_TITLE)
+        anchor = heading.find("a") if heading else None
+        if anchor is None:
+            logger.warning("SCRAPER: sermon article without a title, skipped")
+            continue
+        image = article.find("img")
+        download = article.find("a", SERMON_DOWNLOAD)
+        video = article.find("a", SERMON_VIDEO)
+        video = video.get("href") if video else None
+        if video and video.startswith("//"):
+            video = "https:" + video
+
+        sermons.append(
+            {
+                "title": anchor.text,
+                "download": download.get("href") if download else None,
+                "video": video,
+                "link": anchor.get("href"),
+                "image": image.get("src") if image else None,
+            }
+        )
+    return sermons
+
+
+def parse_t30(html: str) -> dict:
+    """
+    Parses the latest devotional from the t30.org front page.
+
+    Return: dict with title, link, image, date and excerpt
+    """
+    soup = make_soup(html, T30_STRAINER)
+    anchor = soup.find("h3", {"class": "entry-title td-module-title"}).find("a")
+    return {
+        "title": anchor.text,
+        "link": anchor.get("href"),
+        "image": soup.find("div", {"class": "td-module-thumb"}).find("img").get("src"),
+        "date": str(date.today()),
+        "excerpt": soup.find("div", {"class": "td-excerpt"}).text.strip(),
+    }
+
+
+def parse_church_locations(html: str) -> dict:
+    """
+    Parses the campus names from ccing.org/campus.
+
+    Return: dict mapping each campus name to an empty list
+    """
+    return {
+        span.get_text(): []
+        for span in make_soup(html, LOCATIONS_STRAINER).find_all("span")
+    }
@@ -0,0 +1,139 @@
+import time
+import threading
+from . import logger
+
+
+class PrefixTrie:
+    """
+    A character trie mapping string prefixes to values.
+
+    `longest_match` walks the text once, so finding the route for a state
+    such as "update_user=admin=123" costs the length of the matched
+    prefix, not the number of registered prefixes.
+    """
+
+    def __init__(self) -> None:
+        self._root = {}
+
+    def insert(self, prefix: str, value) -> None:
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = (prefix, value)
+
+    def longest_match(self, text: str) -> tuple | None:
+        """
+        Return: (prefix, value) for the longest registered prefix of text,
+            or None if no prefix matches
+        """
+        node = self._root
+        match = node.get(None)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+
+class Router:
+    """
+    Maps a routing key (callback data head, keyboard text or last_command)
+    to its handler.
+
+    Exact keys are looked up in a dict and `startswith` routes in a
+    PrefixTrie, exact keys taking precedence. Every dispatch is timed per
+    route so `stats` gives a latency breakdown of the bot's handlers.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.default = None
+        self._exact = {}
+        self._prefixes = PrefixTrie()
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def register(self, key: str, handler, prefix: bool = False) -> None:
+        """
+        Registers a handler(update, context) for a routing key.
+
+        Keyword arguments:
+        key -- str: the exact key, or the prefix if `prefix` is True
+        handler -- callable taking (update, context)
+        prefix -- bool: match any key starting with `key`
+        """
+        if prefix:
+            self._prefixes.insert(key, handler)
+        else:
+            self._exact[key] = handler
+
+    def resolve(self, key: str) -> tuple:
+        """
+        Return: (route, handler) for the key; route is the registered key or
+            prefix, or None with the default handler if nothing matches
+        """
+        handler = self._exact.get(key)
+        if handler is not None:
+            return key, handler
+        match = self._prefixes.longest_match(key)
+        if match is not None:
+            return match[0] + "*", match[1]
+        return None, self.default
+
+    def dispatch(self, key: str, update, context) -> None:
+        route, handler = self.resolve(key)
+        if handler is None:
+            logger.debug(f"ROUTER {self.name}: no route for {key!r}")
+            return
+        route = route or "<default>"
+        started = time.perf_counter()
+        failed = False
+        try:
+            handler(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record(route, time.perf_counter() - started, failed)
+
+    def _record(self, route: str, elapsed: float, failed: bool) -> None:
+        with self._lock:
+            timing = self._timings.setdefault(
+                route, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            )
+            timing["count"] += 1
+            timing["errors"] += failed
+            timing["total"] += elapsed
+            timing["max"] = max(timing["max"], elapsed)
+
+    def stats(self) -> dict:
+        """
+        Return: {route: {count, errors, avg_ms, max_ms}} for every route
+            dispatched so far
+        """
+        with self._lock:
+            return {
+                route: {
+                    "count": t["count"],
+                    "errors": t["errors"],
+                    "avg_ms": round(t["total"] / t["count"] * 1000, 2),
+                    "max_ms": round(t["max"] * 1000, 2),
+                }
+                for route, t in self._timings.items()
+            }
+
+
+# Keyboard text typed by a user with no pending state.
+command_router = Router("commands")
+# Free-text replies, keyed by the user's last_command.
+state_router = Router("states")
+# Inline keyboard callbacks, keyed by the callback data before the first "=".
+callback_router = Router("callbacks")
+
+
+def route_stats() -> dict:
+    return {
+        router.name: router.stats()
+        for router in (command_router, state_router, callback_router)
+    }
@@ -1,10 +1,7 @@
-import requests
-import json
-import requests
-from bs4 import BeautifulSoup
-from datetime import date as datetime
 from dotenv import load_dotenv
 import os
+from .fetcher import fetcher
+from .parsers import parse_sermons, parse_t30, parse_church_locations
 
 load_dotenv()
 
@@ -23,8 +20,8 @@ class WebScrapers:
             "start_date.range_end": end,
         }
         base_url = "https://www.eventbriteapi.com/v3/organizations/180780002373/events/"
-        r = requests.get(base_url, params=params)
         try:
+            r = fetcher.fetch(base_url, params=params)
             return [
                 {"image": event["logo"]["url"], "link": event["url"]}
                 for event in r.json()["events"]
@@ -33,77 +30,40 @@ class WebScrapers:
             return []
 
     @staticmethod
-    def cci_sermons() -> list:
+    def sermons_url(page: int = 1) -> str:
+        base_url = "https://media.ccing.org/"
+        return base_url + f"page/{page}/" if page > 1 else base_url
+
+    @staticmethod
+    def cci_sermons(skip_unchanged: bool = False, page: int = 1) -> list | None:
         """
         This function scrapes the CCI websites for new sermons
         and returns the latest sermons uploaded on the database
 
         Keyword arguments:
-        None -- does not take in any arguments
+        skip_unchanged -- bool: return None without parsing when the page
+        has not changed since the last committed fetch; the caller must
+        call fetcher.commit(WebScrapers.sermons_url(page)) once the
+        sermons are stored
+        page -- int: archive page, 1 being the newest sermons; a page past
+        the end of the archive returns an empty list
 
         Return: list: returns a list of sermons with each sermon
-        as a dictionary.
+        as a dictionary, or None if the page was unchanged.
         """
 
         headers = {
             "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0.4183.121 Safari/537.36"
         }
 
-        base_url = "https://media.ccing.org/"
-        r = requests.get(base_url, headers=headers)
-        soup = BeautifulSoup(r.text, "html.parser")
-        sermons_section = soup.find_all("article")
-        sermons = []
-
-        for sermon in sermons_section:
-            try:
-                image = sermon.find("img").get("src")
-                title = (
-                    sermon.find("h3", {"class": "cmsmasters_sermon_title entry-title"})
-                    .find("a")
-                    .text
-                )
-                link = (
-                    sermon.find("h3", {"class": "cmsmasters_sermon_title entry-title"})
-                    .find("a")
-                    .get("href")
-                )
-                download = sermon.find(
-                    "a",
-                    {
-                        "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_download"
-                    },
-                ).get("href")
-                video = sermon.find(
-                    "a",
-                    {
-                        "class": "cmsmasters_sermon_media_item cmsmasters_theme_icon_sermon_video"
-                    },
-                ).get("href")
-
-                if video.startswith("//"):
-                    video = "https:" + video
-
-                sermons.append(
-                    {
-                        "title": title,
-                        "download": download,
-                        "video": video,
-                        "link": link,
-                        "image": image,
-                    }
-                )
-            except:
-                sermons.append(
-                    {
-                        "title": title,
-                        "download": download,
-                        "link": link,
-                        "image": image,
-                        "video": None,
-                    }
-                )
-        return sermons
+        r = fetcher.fetch(
+            WebScrapers.sermons_url(page), headers=headers, defer_cache=skip_unchanged
+        )
+        if skip_unchanged and r.not_modified:
+            return None
+        if r.status == 404:
+            return []
+        return parse_sermons(r.text)
 
     @staticmethod
     def t30() -> dict:
@@ -121,28 +81,8 @@ class WebScrapers:
         }
 
         base = "http://t30.org"
-        r = requests.get(base, headers=headers)
-        soup = BeautifulSoup(r.text, "html.parser")
-
-        title = soup.find("h3", {"class": "entry-title td-module-title"}).find("a").text
-        link = (
-            soup.find("h3", {"class": "entry-title td-module-title"})
-            .find("a")
-            .get("href")
-        )
-        image = soup.find("div", {"class": "td-module-thumb"}).find("img").get("src")
-        excerpt = soup.find("div", {"class": "td-excerpt"}).text.strip()
-        date = str(datetime.today())
-
-        d = {
-            "title": title,
-            "link": link,
-            "image": image,
-            "date": date,
-            "excerpt": excerpt,
-        }
-
-        return d
+        r = fetcher.fetch(base, headers=headers)
+        return parse_t30(r.text)
 
     @staticmethod
     def church_locations():
@@ -150,12 +90,5 @@ class WebScrapers:
             "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
         }
         base_url = "https://ccing.org/campus/"
-        r = requests.get(base_url, headers=headers)
-        soup = BeautifulSoup(r.text, "html.parser")
-
-        titles_spans = soup.find_all("span", {"class": "elementskit-tab-title"})
-        locations = {}
-        for span in titles_spans:
-            locations[span.get_text()] = []
-
-        return locations
+        r = fetcher.fetch(base_url, headers=headers)
+        return parse_church_locations(r.text)
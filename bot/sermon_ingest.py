@@ -0,0 +1,81 @@
+import requests
+from . import logger
+from .database import known_sermons, insert_sermons
+from .scrapers import WebScrapers
+from .fetcher import fetcher
+
+
+class SermonIngester:
+    """
+    Walks the media.ccing.org sermon archive, newest page first, and stores
+    the sermons not seen before.
+
+    The daily run stops at the first page holding an already-stored sermon
+    (the high-water mark), so when nothing is new it costs one page fetch
+    (a 304 when the front page is unchanged) and one query. The front
+    page's validators are only saved after the new sermons are stored, so
+    a run that fails part way re-reads the page next time instead of
+    getting a 304 and skipping sermons it never stored. A backfill walks
+    every page to the end of the archive. New sermons are written with one
+    bulk upsert at the end of the walk.
+    """
+
+    MAX_PAGES = 20
+
+    @staticmethod
+    def collect(max_pages: int | None = MAX_PAGES, backfill: bool = False) -> tuple:
+        """
+        Scrapes archive pages until the high-water mark, the end of the
+        archive or `max_pages`.
+
+        Return: (list of sermons not stored yet, newest first; False if a
+            page failed to download and the walk stopped short)
+        """
+        new_sermons, seen = [], set()
+        pages = 0
+        complete = True
+        while max_pages is None or pages < max_pages:
+            try:
+                sermons = WebScrapers.cci_sermons(
+                    skip_unchanged=pages == 0 and not backfill, page=pages + 1
+                )
+            except requests.RequestException:
+                # Logged by the fetcher; keep what was collected so far
+                complete = False
+                break
+            if sermons is None:
+                logger.info("SERMON: sermon page unchanged, skipping")
+                break
+            if not sermons:
+                break
+            pages += 1
+
+            known = known_sermons(sermons)
+            for sermon, is_known in zip(sermons, known):
+                # A sermon can move to the next page between two fetches
+                if not is_known and sermon["title"] not in seen:
+                    seen.add(sermon["title"])
+                    new_sermons.append(sermon)
+            if any(known) and not backfill:
+                break
+        logger.info(f"SERMON: {len(new_sermons)} new sermons in {pages} pages")
+        return new_sermons, complete
+
+    @staticmethod
+    def run(max_pages: int | None = MAX_PAGES, backfill: bool = False) -> list:
+        """
+        Stores the sermons found by `collect`.
+
+        Return: list of the sermons inserted, newest first
+        """
+        sermons, complete = SermonIngester.collect(max_pages, backfill)
+        inserted = insert_sermons(sermons)
+        # Only now may the next run skip an unchanged front page
+        if complete:
+            fetcher.commit(WebScrapers.sermons_url(1))
+        return inserted
+
+
+if __name__ == "__main__":
+    # python -m bot.sermon_ingest: backfill the whole archive
+    SermonIngester.run(max_pages=None, backfill=True)
@@ -0,0 +1,125 @@
+import re
+import time
+import bisect
+import threading
+import unicodedata
+from . import db, logger
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list:
+    """
+    Lower-cases, strips accents and splits text into alphanumeric tokens.
+    """
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_RE.findall(text.lower())
+
+
+class SermonIndex:
+    """
+    An in-process inverted index over sermon titles.
+
+    Each title token maps to the set of sermons containing it, and a
+    sorted vocabulary allows prefix matching with a binary search, so a
+    query costs a handful of set operations regardless of archive size.
+    The index is loaded from `db.sermons` on first use, updated in place
+    by `add`, and reloaded when another process (the scheduler) has
+    changed the collection since the last check.
+    """
+
+    def __init__(self, refresh_interval: float = 60) -> None:
+        self.refresh_interval = refresh_interval
+        self._sermons = []
+        self._postings = {}
+        self._vocabulary = []
+        self._loaded_count = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _index(self, sermon: dict) -> None:
+        doc_id = len(self._sermons)
+        self._sermons.append(sermon)
+        for token in set(tokenize(sermon.get("title"))):
+            if token not in self._postings:
+                self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+            self._postings[token].add(doc_id)
+
+    def rebuild(self) -> None:
+        """
+        Reloads every sermon from the database.
+        """
+        sermons = list(db.sermons.find({}).sort("_id", 1))
+        with self._lock:
+            self._sermons, self._postings, self._vocabulary = [], {}, []
+            for sermon in sermons:
+                self._index(sermon)
+            self._loaded_count = len(sermons)
+            self._checked = time.monotonic()
+        logger.info(f"SERMON SEARCH: indexed {len(sermons)} sermons")
+
+    def add(self, sermon: dict) -> None:
+        """
+        Adds a newly inserted sermon without rebuilding the index.
+        """
+        with self._lock:
+            if self._loaded_count is None:
+                return
+            self._index(sermon)
+            self._loaded_count += 1
+
+    def _refresh_if_stale(self) -> None:
+        if self._loaded_count is None:
+            self.rebuild()
+        elif time.monotonic() - self._checked > self.refresh_interval:
+            self._checked = time.monotonic()
+            if db.sermons.estimated_document_count() != self._loaded_count:
+                self.rebuild()
+
+    def _matches(self, term: str) -> dict:
+        """
+        Returns {doc_id: score} for sermons with a token starting with term;
+        an exact token match scores higher than a prefix match.
+        """
+        scores = {}
+        start = bisect.bisect_left(self._vocabulary, term)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            weight = 2 if token == term else 1
+            for doc_id in self._postings[token]:
+                scores[doc_id] = max(scores.get(doc_id, 0), weight)
+        return scores
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Returns up to `limit` sermons ranked by how well their title matches.
+
+        Sermons matching every query term are preferred; if there are none,
+        sermons matching any term are returned. Ties go to newer sermons.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        self._refresh_if_stale()
+
+        with self._lock:
+            per_term = [self._matches(term) for term in terms]
+            candidates = set.intersection(*(set(m) for m in per_term))
+            if not candidates:
+                candidates = set().union(*per_term)
+
+            phrase = " ".join(terms)
+            ranked = []
+            for doc_id in candidates:
+                score = sum(m.get(doc_id, 0) for m in per_term)
+                if phrase in " ".join(tokenize(self._sermons[doc_id].get("title"))):
+                    score += len(terms)
+                ranked.append((-score, -doc_id))
+            ranked.sort()
+            return [self._sermons[-doc_id] for _, doc_id in ranked[:limit]]
+
+
+sermon_index = SermonIndex()
@@ -0,0 +1,257 @@
+import time
+import threading
+from collections import OrderedDict
+from .database import get_user, update_user, user_update_listeners
+
+# last_command routing keys of a chat in a counseling session. last_command
+# only routes the chat's messages; everything about the session, including
+# whether it is being transferred, lives in `session`.
+IN_CONVERSATION = "in-conversation-with"
+TRANSFER = "transfer_req"
+
+
+class ConversationSession:
+    """
+    A chat's side of a counseling conversation.
+
+    Stored on the user document as the `session` sub-document. This is the
+    only source of the session's data; read it through `sessions.get`
+    rather than from last_command.
+
+    `role` is the role of the other participant, as in the legacy
+    "in-conversation-with={with_chat_id}={role}={request_message_id}"
+    state: "pastor" on the user's side, "user" on the counselor's.
+    """
+
+    def __init__(
+        self,
+        chat_id: int,
+        with_chat_id: int,
+        role: str,
+        request_message_id: int,
+        transfer_to: int | None = None,
+        transferring: bool = False,
+    ) -> None:
+        self.chat_id = chat_id
+        self.with_chat_id = with_chat_id
+        self.role = role
+        self.request_message_id = request_message_id
+        self.transfer_to = transfer_to
+        # In the counselor's transfer flow; transfer_to is set once the
+        # counselor to transfer to has been picked
+        self.transferring = transferring or transfer_to is not None
+
+    @property
+    def is_counselor(self) -> bool:
+        return self.role == "user"
+
+    @property
+    def counselor_id(self) -> int:
+        return self.chat_id if self.is_counselor else self.with_chat_id
+
+    @property
+    def user_chat_id(self) -> int:
+        return self.with_chat_id if self.is_counselor else self.chat_id
+
+    @property
+    def last_command(self) -> str:
+        """
+        Return: the last_command routing key for the session's state
+        """
+        return TRANSFER if self.transferring else IN_CONVERSATION
+
+    def to_dict(self) -> dict:
+        return {
+            "with": self.with_chat_id,
+            "role": self.role,
+            "request_message_id": self.request_message_id,
+            "transfer_to": self.transfer_to,
+            "transferring": self.transferring,
+        }
+
+    @staticmethod
+    def from_dict(chat_id: int, doc: dict):
+        return ConversationSession(
+            chat_id,
+            doc["with"],
+            doc["role"],
+            doc["request_message_id"],
+            doc.get("transfer_to"),
+            doc.get("transferring", False),
+        )
+
+    @staticmethod
+    def from_last_command(chat_id: int, last_command: str):
+        """
+        Parses a legacy state string, for users that entered their
+        conversation before sessions were stored.
+
+        Return: ConversationSession or None if the string is not a session
+        """
+        parts = last_command.split("=")
+        transfer_to = None
+        transferring = parts[0] == TRANSFER
+        try:
+            if transferring:
+                parts = parts[1:]
+                if parts and parts[0] != IN_CONVERSATION:
+                    transfer_to, parts = int(parts[0]), parts[1:]
+            if len(parts) != 4 or parts[0] != IN_CONVERSATION:
+                return None
+            return ConversationSession(
+                chat_id,
+                int(parts[1]),
+                parts[2],
+                int(parts[3]),
+                transfer_to,
+                transferring,
+            )
+        except ValueError:
+            return None
+
+
+class SessionStore:
+    """
+    Reads and writes conversation sessions, with a per-chat cache of the
+    parsed session objects.
+
+    A session is only current while the chat's last_command is a
+    conversation or transfer routing key, so a handler resetting
+    last_command also ends the session. Cached entries are dropped by the
+    `update_user` listener whenever either field changes, and expire after
+    `ttl` seconds like the user cache they are read from.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> ConversationSession | None:
+        """
+        Return: the chat's current session, or None if it is not in one
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(chat_id)
+                return entry[1]
+            generation = self._generation
+
+        session = self._load(chat_id)
+        with self._lock:
+            # Not cached if the user was written to while loading
+            if generation != self._generation:
+                return session
+            self._entries[chat_id] = (time.monotonic() + self.ttl, session)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return session
+
+    @staticmethod
+    def _load(chat_id: int) -> ConversationSession | None:
+        user = get_user(chat_id)
+        if user is None:
+            return None
+        return SessionStore.from_user(user)
+
+    @staticmethod
+    def from_user(user: dict) -> ConversationSession | None:
+        """
+        Reads the session of an already fetched user document, e.g. one of
+        many loaded in bulk.
+
+        Return: the user's current session, or None if not in one
+        """
+        last_command = str(user.get("last_command") or "")
+        if not last_command.startswith((IN_CONVERSATION, TRANSFER)):
+            return None
+        if user.get("session"):
+            session = ConversationSession.from_dict(user["chat_id"], user["session"])
+            # Sessions stored before `transferring` was recorded
+            session.transferring |= last_command.startswith(TRANSFER)
+            return session
+        # State written before sessions were stored
+        return ConversationSession.from_last_command(user["chat_id"], last_command)
+
+    def _save(self, session: ConversationSession) -> None:
+        update_user(
+            session.chat_id,
+            {
+                "$set": {
+                    "session": session.to_dict(),
+                    "last_command": session.last_command,
+                }
+            },
+        )
+
+    def start(
+        self, chat_id: int, with_chat_id: int, role: str, request_message_id: int
+    ) -> ConversationSession:
+        """
+        Puts a chat in a conversation.
+
+        Keyword arguments:
+        chat_id -- int: the chat entering the conversation
+        with_chat_id -- int: the other participant
+        role -- str: role of the other participant, "pastor" or "user"
+        request_message_id -- int: the counseling request being served
+
+        Return: the new session
+        """
+        session = ConversationSession(chat_id, with_chat_id, role, request_message_id)
+        self._save(session)
+        return session
+
+    def begin_transfer(
+        self, session: ConversationSession, counselor_id: int | None = None
+    ) -> ConversationSession:
+        """
+        Moves a counselor's session into the transfer flow, optionally
+        with the counselor it is being transferred to.
+        """
+        session = ConversationSession(
+            session.chat_id,
+            session.with_chat_id,
+            session.role,
+            session.request_message_id,
+            counselor_id,
+            transferring=True,
+        )
+        self._save(session)
+        return session
+
+    def resume(self, session: ConversationSession) -> ConversationSession:
+        """
+        Returns a session from the transfer flow to the conversation.
+        """
+        session = ConversationSession(
+            session.chat_id,
+            session.with_chat_id,
+            session.role,
+            session.request_message_id,
+        )
+        self._save(session)
+        return session
+
+    def end(self, chat_id: int) -> None:
+        update_user(chat_id, {"$set": {"session": None, "last_command": None}})
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(chat_id, None)
+
+    def on_user_update(self, chat_id: int, update: dict) -> None:
+        fields = {
+            field.split(".")[0] for changes in update.values() for field in changes
+        }
+        if fields & {"session", "last_command"} or set(update) != {"$set"}:
+            self.invalidate(chat_id)
+
+
+sessions = SessionStore()
+user_update_listeners.append(sessions.on_user_update)
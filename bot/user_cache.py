@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    A bounded, TTL-evicting cache of user documents keyed by chat_id.
+
+    Entries are evicted least-recently-used once `maxsize` is reached and
+    expire `ttl` seconds after they were loaded. Writes made through
+    `bot.database.update_user` are applied to the cached copy so a handler
+    can read its own writes without another round-trip to MongoDB.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self) -> int:
+        """
+        Returns a counter that changes on every write or invalidation.
+
+        A loader records it before querying MongoDB and passes it to `set`,
+        so a document read before a concurrent write is not cached.
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, chat_id: int) -> dict | None:
+        """
+        Returns a copy of the cached user document, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[chat_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, chat_id: int, user: dict, generation: int | None = None) -> None:
+        """
+        Caches a user document loaded from the database.
+
+        Keyword arguments:
+        chat_id -- int: identifies a specific user
+        user -- dict: the user document
+        generation -- int: value of `generation()` taken before the load
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[chat_id] = (time.monotonic() + self.ttl, dict(user))
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def update(self, chat_id: int, fields: dict) -> None:
+        """
+        Applies `$set` style field updates to a cached user, if present.
+        """
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def invalidate(self, chat_id: int) -> None:
+        """
+        Drops a user from the cache so the next read goes to the database.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(chat_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
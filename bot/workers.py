@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import logger
+
+
+class ChatWorkerPool:
+    """
+    Runs tasks on a bounded thread pool while keeping them ordered per key.
+
+    Tasks submitted with the same key (a chat_id) run one at a time in
+    submission order; tasks for different keys run in parallel. Each pool
+    task runs a single queued item and then re-schedules its key behind
+    the other waiting keys, so one busy chat cannot hold a worker while
+    other chats wait.
+
+    With `max_workers` 0 tasks run inline in the caller, which is the
+    dispatcher's default synchronous behaviour.
+    """
+
+    def __init__(self, max_workers: int = 0, name: str = "updates") -> None:
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = (
+            ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+            if max_workers > 0
+            else None
+        )
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "depth": 0,
+            "max_depth": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def submit(self, key, fn, *args) -> None:
+        """
+        Queues fn(*args) behind earlier tasks for the same key.
+        """
+        with self._lock:
+            self._metrics["submitted"] += 1
+        if self._executor is None:
+            self._run(time.monotonic(), fn, args)
+            return
+
+        with self._lock:
+            self._metrics["depth"] += 1
+            self._metrics["max_depth"] = max(
+                self._metrics["max_depth"], self._metrics["depth"]
+            )
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([(time.monotonic(), fn, args)])
+                schedule = True
+            else:
+                queue.append((time.monotonic(), fn, args))
+                schedule = False
+        if schedule:
+            self._executor.submit(self._drain_one, key)
+
+    def _run(self, enqueued: float, fn, args: tuple) -> None:
+        wait = time.monotonic() - enqueued
+        failed = False
+        try:
+            fn(*args)
+        except Exception:
+            failed = True
+            logger.exception(f"WORKERS {self.name}: task {fn.__name__} failed")
+        with self._lock:
+            self._metrics["completed"] += 1
+            self._metrics["failed"] += failed
+            self._metrics["wait_total"] += wait
+            self._metrics["wait_max"] = max(self._metrics["wait_max"], wait)
+
+    def _drain_one(self, key) -> None:
+        # The item stays at the head of the queue while it runs, which is
+        # what keeps later submissions for the key from being scheduled.
+        with self._lock:
+            enqueued, fn, args = self._queues[key][0]
+        self._run(enqueued, fn, args)
+        with self._lock:
+            self._metrics["depth"] -= 1
+            queue = self._queues[key]
+            queue.popleft()
+            if not queue:
+                del self._queues[key]
+                if not self._queues:
+                    self._idle.notify_all()
+                return
+        self._executor.submit(self._drain_one, key)
+
+    def wrap(self, callback):
+        """
+        Wraps a dispatcher callback(update, context) so it runs on the pool,
+        serialised per chat.
+        """
+        if self._executor is None:
+            return callback
+
+        def run_in_pool(update, context):
+            chat = update.effective_chat
+            key = chat.id if chat is not None else update.update_id
+            self.submit(key, callback, update, context)
+
+        run_in_pool.__name__ = callback.__name__
+        return run_in_pool
+
+    def stats(self) -> dict:
+        """
+        Return: dict with workers, depth (queued or running tasks),
+            max_depth, active_chats, submitted, completed, failed and the
+            average and maximum queue wait in milliseconds
+        """
+        with self._lock:
+            m = dict(self._metrics)
+            active = len(self._queues)
+        return {
+            "workers": self.max_workers,
+            "depth": m["depth"],
+            "max_depth": m["max_depth"],
+            "active_chats": active,
+            "submitted": m["submitted"],
+            "completed": m["completed"],
+            "failed": m["failed"],
+            "wait_avg_ms": (
+                round(m["wait_total"] / m["completed"] * 1000, 2)
+                if m["completed"]
+                else 0.0
+            ),
+            "wait_max_ms": round(m["wait_max"] * 1000, 2),
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stops the pool; with `wait` every queued task runs first.
+        """
+        if self._executor is None:
+            return
+        if wait:
+            with self._idle:
+                self._idle.wait_for(lambda: not self._queues)
+        self._executor.shutdown(wait=wait)
+
+
+# Handlers for incoming updates. UPDATE_WORKERS sets the pool size; unset
+# or 0 keeps the dispatcher's synchronous processing.
+update_workers = ChatWorkerPool(int(os.getenv("UPDATE_WORKERS") or 0))
+
+# Counseling relay lanes, keyed by (counselor_id, user_chat_id). RELAY_WORKERS
+# sets the pool size and defaults to UPDATE_WORKERS.
+relay_lanes = ChatWorkerPool(
+    int(os.getenv("RELAY_WORKERS") or os.getenv("UPDATE_WORKERS") or 0),
+    name="relay",
+)
@@ -1,7 +1,8 @@
 from datetime import datetime
 import os
 from telegram import ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from bot import db, bot, config
+from pymongo import ReturnDocument
+from bot import db, bot, config, logger
 from bson.int64 import Int64
 from bot.keyboards import (
     validate_user_keyboard,
@@ -13,16 +14,28 @@ from bot.keyboards import (
 from bson import Int64
 from bot.database import (
     set_user_last_command,
-    get_user_last_command,
     get_active_counseling_requests,
     get_ongoing_counseling_requests,
     set_counseling_request_status,
+    claim_counseling_request,
+    release_counseling_request,
+    get_user,
+    get_counselor,
+    update_user,
 )
+from bot.router import command_router, state_router, callback_router
+from bot.workers import relay_lanes
+from bot.broadcast import BroadcastEngine
+from bot.helpers import MessageHelper
+from bot.counselor_index import counselor_index
+from bot.session_state import sessions
+from bot.assignment import assignment_scheduler
+from bot.conversation_manager import ConversationMessages, message_buffer
 
 
 def show_active_requests(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "role": "counselor"})
+    user = get_counselor(chat_id)
 
     if not user:
         keyboard = validate_user_keyboard(chat_id)
@@ -64,7 +77,7 @@ def show_active_requests(update, context):
     # Show all ongoing requests (up to 20)
     for request in ongoing_requests:
         # Get counselor name (first and last name)
-        counselor = db.users.find_one({"chat_id": request["counselor_chat_id"]})
+        counselor = get_user(request["counselor_chat_id"])
         if counselor:
             first_name = counselor.get("first_name", "")
             last_name = counselor.get("last_name", "")
@@ -122,8 +135,8 @@ def handle_active_requests_verification(update, context):
 
     if password == os.getenv("COUNSELOR_REQUEST_PASSWORD"):
         # Grant access and mark user as verified for active requests with timestamp
-        db.users.update_one(
-            {"chat_id": chat_id},
+        update_user(
+            chat_id,
             {
                 "$set": {
                     "active_requests_verified": True,
@@ -156,8 +169,8 @@ def reset_active_requests_verification(chat_id):
     Helper function to reset active requests verification for a user.
     This can be called when needed for security purposes or admin actions.
     """
-    db.users.update_one(
-        {"chat_id": chat_id},
+    update_user(
+        chat_id,
         {"$unset": {"active_requests_verified": "", "active_requests_verified_at": ""}},
     )
 
@@ -167,8 +180,8 @@ def grant_active_requests_access(chat_id):
     Helper function to grant active requests access to a counselor without password.
     This can be called by admins for onboarding or administrative purposes.
     """
-    db.users.update_one(
-        {"chat_id": chat_id},
+    update_user(
+        chat_id,
         {
             "$set": {
                 "active_requests_verified": True,
@@ -180,7 +193,7 @@ def grant_active_requests_access(chat_id):
 
 def show_new_requests(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "role": "counselor"})
+    user = get_counselor(chat_id)
 
     if not user:
         keyboard = validate_user_keyboard(chat_id)
@@ -196,10 +209,7 @@ def show_new_requests(update, context):
     if user.get("global") == True:
         topics = []  # Global access — allow all topics
     else:
-        associated_topics = db.counseling_topics.find(
-            {"counselors": chat_id}, {"topic": 1}
-        )
-        topics = [doc["topic"] for doc in associated_topics]
+        topics = counselor_index.topics_for(chat_id)
 
     # Step 2: Get active counseling requests for these topics
     active_requests = get_active_counseling_requests(topics=topics)
@@ -246,133 +256,180 @@ def show_new_requests(update, context):
         )
 
 
+def send_request_offer(counseling_request, chat_ids):
+    """
+    Sends a counseling request to counselors, in parallel through
+    BroadcastEngine so one blocked counselor does not stop the others, and
+    adds the chat_ids reached to the request's `notified` list. The sends
+    take priority over any broadcast in progress.
+
+    Return: list of chat_ids the message was delivered to
+    """
+    text = (
+        config["messages"]["active_request_notify"]
+        + "\n\n"
+        + config["messages"]["active_request"].format(
+            counseling_request["name"],
+            counseling_request["email"],
+            counseling_request["phone"],
+            counseling_request["topic"],
+            counseling_request["note"],
+        )
+    )
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "Start Conversation",
+                    callback_data="conv="
+                    + str(counseling_request["request_message_id"]),
+                )
+            ]
+        ],
+        resize_keyboard=True,
+    )
+    notified = []
+
+    def on_result(chat_id, status):
+        if status == "success":
+            notified.append(chat_id)
+
+    BroadcastEngine(priority=True).run(
+        ((chat_id, (text, keyboard)) for chat_id in chat_ids),
+        MessageHelper.send_text,
+        on_result,
+    )
+    db.counseling_requests.update_one(
+        {"request_message_id": counseling_request["request_message_id"]},
+        {
+            "$addToSet": {"notified": {"$each": notified}},
+            "$set": {"notified_at": datetime.now()},
+        },
+    )
+    return notified
+
+
 def notify_pastors(counseling_request):
-    # Step 1: Get topic document
-    topic_doc = db.counseling_topics.find_one({"topic": counseling_request["topic"]})
+    """
+    Offers a new counseling request to the counselors who can take it.
 
-    if not topic_doc or "counselors" not in topic_doc:
-        print("No counselors found for this topic.")
-        return
+    Eligible counselors (see offer_candidates) are ranked by
+    assignment_scheduler: the least loaded are offered the request first,
+    and everyone eligible again if it is still unclaimed after a while.
 
-    # Step 2: Filter out requesting user's chat_id
+    Return: chat_ids offered the request in the first wave
+    """
+    recipients, topic_counselors = offer_candidates(counseling_request)
+    if not recipients:
+        logger.warning(
+            f"COUNSELING: no eligible counselors for request "
+            f"{counseling_request['request_message_id']} "
+            f"({counseling_request['topic']})"
+        )
+        return []
 
-    counselor_ids = [cid for cid in topic_doc["counselors"]]
+    return assignment_scheduler.offer(
+        counseling_request, recipients, topic_counselors, send_request_offer
+    )
 
-    if not counselor_ids:
-        print("No eligible counselors to notify.")
-        return
 
-    # Step 3: Get counselors by chat_id
-    pastors = db.users.find(
-        {
-            "$or": [
-                {"chat_id": {"$in": counselor_ids}},
-                {"role": "counselor", "global": True},
-            ],
-            "chat_id": {"$ne": counseling_request["user_chat_id"]},
-        }
+def offer_candidates(counseling_request) -> tuple:
+    """
+    Return: (topic and global counselors other than the requester, whether
+        or not they are in a conversation, counselors assigned the topic)
+    """
+    topic = counseling_request["topic"]
+    candidates = counselor_index.eligible(
+        topic, exclude={counseling_request.get("user_chat_id")}
     )
+    return candidates, counselor_index.topic_counselors(topic)
 
-    # Step 4: Send notifications
-    for pastor in pastors:
-        if str(pastor.get("last_command", "")).startswith("in-conversation-with"):
-            continue
-        bot.send_message(
-            chat_id=pastor["chat_id"], text=config["messages"]["active_request_notify"]
-        )
 
-        bot.send_message(
-            chat_id=pastor["chat_id"],
-            text=config["messages"]["active_request"].format(
-                counseling_request["name"],
-                counseling_request["email"],
-                counseling_request["phone"],
-                counseling_request["topic"],
-                counseling_request["note"],
-            ),
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "Start Conversation",
-                            callback_data="conv="
-                            + str(counseling_request["request_message_id"]),
-                        )
-                    ]
-                ],
-                resize_keyboard=True,
-            ),
-        )
+def escalate_requests() -> int:
+    """
+    Re-offers counseling requests left unclaimed past their escalation
+    time; run by the scheduler.
+    """
+    return assignment_scheduler.escalate_due(offer_candidates, send_request_offer)
 
 
 def handle_initial_conversation_cb(update, context):
     chat_id = update.effective_chat.id
     q = update.callback_query.data
     q_head = q.split("=")
-    req = db.counseling_requests.find_one({"request_message_id": int(q_head[1])})
-    if req["user_chat_id"] == chat_id:
-        context.bot.send_message(
-            chat_id=chat_id,
-            text=config["messages"]["conversation_start_self_not_allowed"],
+    request_message_id = int(q_head[1])
+
+    # Claim the request: pending, and unassigned or transferred to this counselor
+    req = claim_counseling_request(
+        request_message_id,
+        chat_id,
+        {
+            "status": "pending",
+            "counselor_chat_id": {"$in": [None, chat_id]},
+            "user_chat_id": {"$ne": chat_id},
+        },
+    )
+    if req is None:
+        req = db.counseling_requests.find_one(
+            {"request_message_id": request_message_id}
         )
-    elif req["status"] == "pending":
-        pastor = db.users.find_one({"chat_id": chat_id})
-        user_chat_id = req["user_chat_id"]
-
-        user_last_command = get_user_last_command(user_chat_id)
-        if user_last_command is not None and user_last_command.startswith(
-            "in-conversation-with"
-        ):
+        if req is None:
+            context.bot.send_message(
+                chat_id=chat_id, text="❌ Counseling request not found."
+            )
+        elif req["user_chat_id"] == chat_id:
             context.bot.send_message(
                 chat_id=chat_id,
-                text=config["messages"]["user_in_separate_conversation"],
+                text=config["messages"]["conversation_start_self_not_allowed"],
             )
-            return
-        ## notify pastor that conversation has started
+        else:
+            notify_request_already_taken(context, chat_id, req)
+        return
+
+    pastor = get_user(chat_id)
+    user_chat_id = req["user_chat_id"]
+
+    if sessions.get(user_chat_id) is not None:
+        release_counseling_request(request_message_id, chat_id, req)
         context.bot.send_message(
             chat_id=chat_id,
-            text=config["messages"]["conversation_start"].format(req["name"]),
-        )
-        ## notify user that conversation has started
-        context.bot.send_message(
-            chat_id=req["user_chat_id"],
-            text=config["messages"]["conversation_start_user"].format(
-                pastor["first_name"]
-            ),
-            parse_mode="Markdown",
-        )
-        ## set pastor_id as counselor_id for request
-        db.counseling_requests.update_one(
-            {"request_message_id": req["request_message_id"]},
-            {"$set": {"counselor_chat_id": chat_id}},
+            text=config["messages"]["user_in_separate_conversation"],
         )
-        ## set user status as in-conversation with pastor
-        msg_id = req["request_message_id"]
+        return
+    assignment_scheduler.record_claim(req, chat_id)
 
-        set_user_last_command(
-            user_chat_id, f"in-conversation-with={chat_id}=pastor={msg_id}"
-        )
+    ## notify pastor that conversation has started
+    context.bot.send_message(
+        chat_id=chat_id,
+        text=config["messages"]["conversation_start"].format(req["name"]),
+    )
+    ## notify user that conversation has started
+    context.bot.send_message(
+        chat_id=user_chat_id,
+        text=config["messages"]["conversation_start_user"].format(pastor["first_name"]),
+        parse_mode="Markdown",
+    )
+    ## set user status as in-conversation with pastor
+    sessions.start(user_chat_id, chat_id, "pastor", request_message_id)
 
-        ## set pastor status as in-conversation with user
-        set_user_last_command(
-            chat_id, f"in-conversation-with={user_chat_id}=user={msg_id}"
-        )
+    ## set pastor status as in-conversation with user
+    sessions.start(chat_id, user_chat_id, "user", request_message_id)
 
-        ## start conversation
-        start_conversation(chat_id, req)
-        set_counseling_request_status(req["request_message_id"], "ongoing")
-    else:
-        counselor_chat_id = req.get("counselor_chat_id")
-        counselor_name = db.users.find_one({"chat_id": counselor_chat_id})["first_name"]
-        context.bot.send_message(
-            chat_id=chat_id,
-            text=config["messages"]["conversation_already_started"].format(
-                counselor_name
-            ),
-        )
+    ## start conversation
+    start_conversation(chat_id, req)
 
 
-def send_message_handler(msg, to, from_chat_id=None):
+def notify_request_already_taken(context, chat_id, req):
+    counselor = get_user(req.get("counselor_chat_id")) or {}
+    context.bot.send_message(
+        chat_id=chat_id,
+        text=config["messages"]["conversation_already_started"].format(
+            counselor.get("first_name", "")
+        ),
+    )
+
+
+def send_message_handler(msg, to, from_chat_id=None, sender=bot):
     ## Send message to the other user with "End Conversation" button
 
     # Create the "End Conversation" button
@@ -391,12 +448,12 @@ def send_message_handler(msg, to, from_chat_id=None):
         if msg.text in keyboard_commands:
             return "Error"
         else:
-            bot.send_message(
+            sender.send_message(
                 chat_id=to, text=msg.text, reply_markup=end_conversation_keyboard
             )
             return msg.text
     elif msg.photo:
-        bot.send_photo(
+        sender.send_photo(
             chat_id=to,
             photo=msg.photo[-1].file_id,
             caption=msg.caption or " ",
@@ -404,7 +461,7 @@ def send_message_handler(msg, to, from_chat_id=None):
         )
         return "photo=" + msg.photo[-1].file_id
     elif msg.voice:
-        bot.send_voice(
+        sender.send_voice(
             chat_id=to,
             voice=msg.voice.file_id,
             caption=msg.caption or " ",
@@ -412,7 +469,7 @@ def send_message_handler(msg, to, from_chat_id=None):
         )
         return "video=" + msg.voice.file_id
     elif msg.video:
-        bot.send_video(
+        sender.send_video(
             chat_id=to,
             video=msg.video.file_id,
             caption=msg.caption or " ",
@@ -420,7 +477,7 @@ def send_message_handler(msg, to, from_chat_id=None):
         )
         return msg.video.file_id
     elif msg.animation:
-        bot.send_animation(
+        sender.send_animation(
             chat_id=to,
             animation=msg.animation.file_id,
             caption=msg.caption or " ",
@@ -429,16 +486,18 @@ def send_message_handler(msg, to, from_chat_id=None):
         return "animation=" + msg.animation.file_id
 
 
-def conversation_handler(update, context):
-    chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id})
-    send_to = user["last_command"].split("=")
-    msg = update.message
+def relay_conversation_message(msg, chat_id, to, role, sender=bot):
+    """
+    Relays one message to the other party and appends it to the conversation.
 
-    message_value = send_message_handler(msg, int(send_to[1]), chat_id)
+    Runs on the conversation's relay lane, so the messages of one
+    (counselor, user) pair are sent and persisted in the order they arrived.
+    `sender` is the bot used for the Telegram calls.
+    """
+    message_value = send_message_handler(msg, to, chat_id, sender=sender)
     if message_value == "Error":
         keyboard = validate_user_keyboard(chat_id)
-        bot.send_message(
+        sender.send_message(
             chat_id=chat_id,
             text=config["messages"]["in_conversation"],
             reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
@@ -448,22 +507,46 @@ def conversation_handler(update, context):
             "message": message_value,
             "created": datetime.now(),
             "from": chat_id,
-            "to": int(send_to[1]),
+            "to": to,
         }
 
         ## Update conversation object in database.
-        if send_to[2] == "pastor":
-            update_conversation(message, int(send_to[1]), chat_id)
+        if role == "pastor":
+            update_conversation(message, to, chat_id)
         else:
-            update_conversation(message, chat_id, int(send_to[1]))
+            update_conversation(message, chat_id, to)
+
+
+def conversation_handler(update, context):
+    chat_id = update.effective_chat.id
+    session = sessions.get(chat_id)
+    if session is None:
+        logger.warning(f"CONVERSATION: no session for {chat_id}, message dropped")
+        return
+
+    # Both directions of a counseling session share one lane
+    lane = (session.counselor_id, session.user_chat_id)
+    relay_lanes.submit(
+        lane,
+        relay_conversation_message,
+        update.message,
+        chat_id,
+        session.with_chat_id,
+        session.role,
+    )
 
 
 def end_conversation_prompt(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id})
-    send_to = user["last_command"].split("=")
+    session = sessions.get(chat_id)
+    if session is None:
+        context.bot.send_message(
+            chat_id=chat_id, text="❌ You are not currently in an active conversation."
+        )
+        return
 
-    role = send_to[2]
+    role = session.role
+    other_id = str(session.with_chat_id)
 
     context.bot.send_message(
         chat_id=chat_id,
@@ -476,7 +559,7 @@ def end_conversation_prompt(update, context):
                         callback_data="end_conv=yes="
                         + str(chat_id)
                         + "="
-                        + send_to[1]
+                        + other_id
                         + "="
                         + role,
                     ),
@@ -485,7 +568,7 @@ def end_conversation_prompt(update, context):
                         callback_data="end_conv=no="
                         + str(chat_id)
                         + "="
-                        + send_to[1]
+                        + other_id
                         + "="
                         + role,
                     ),
@@ -497,9 +580,18 @@ def end_conversation_prompt(update, context):
 
 
 def set_conversation_status(counselor_id, user_id, active):
-    db.conversations.update_one(
-        {"counselor_id": counselor_id, "user_id": user_id}, {"$set": {"active": active}}
+    message_buffer.flush()
+    update = {"active": active}
+    if not active:
+        update["completed_at"] = datetime.now()
+    result = db.conversations.update_one(
+        {"counselor_id": counselor_id, "user_chat_id": user_id, "active": not active},
+        {"$set": update},
     )
+    if result.matched_count == 0:
+        logger.warning(
+            f"CONVERSATION: no conversation between {counselor_id} and {user_id} to set active={active}"
+        )
 
 
 def end_conversation_cb_handler(update, context):
@@ -507,20 +599,15 @@ def end_conversation_cb_handler(update, context):
     q = update.callback_query.data
     q_head = q.split("=")
 
-    user = db.users.find_one({"chat_id": chat_id})
-    last_command = user.get("last_command", "")
-
-    # Parse from "in-conversation-with={other_id}=user|pastor={request_message_id}"
-    try:
-        _, other_id_str, role_str, msg_id_str = last_command.split("=")
-        other_id = Int64(other_id_str)
-        request_message_id = int(msg_id_str)
-        role = "counselor" if role_str == "pastor" else "user"
-    except (ValueError, IndexError):
+    session = sessions.get(chat_id)
+    if session is None:
         context.bot.send_message(
-            chat_id=chat_id, text="⚠️ Could not parse conversation context."
+            chat_id=chat_id, text="❌ You are not currently in an active conversation."
         )
         return
+    other_id = Int64(session.with_chat_id)
+    request_message_id = session.request_message_id
+    role = "user" if session.is_counselor else "counselor"
 
     # Set roles accordingly
     if role == "counselor":
@@ -549,9 +636,9 @@ def end_conversation_cb_handler(update, context):
         )
 
         set_counseling_request_status(request_message_id, "completed")
-        set_conversation_status(user_id, counselor_id, False)
-        set_user_last_command(chat_id, None)
-        set_user_last_command(other_id, None)
+        set_conversation_status(counselor_id, user_id, False)
+        sessions.end(chat_id)
+        sessions.end(other_id)
 
         # Trigger feedback from the user about the counselor
         request_counseling_feedback_from_user(user_id, counselor_id)
@@ -568,26 +655,14 @@ def end_conversation_quick_cb_handler(update, context):
     q_head = q.split("=")
 
     # Verify this user is actually in a conversation
-    user = db.users.find_one({"chat_id": chat_id})
-    last_command = user.get("last_command", "") if user else ""
-
-    if not last_command or not last_command.startswith("in-conversation-with"):
+    session = sessions.get(chat_id)
+    if session is None:
         context.bot.send_message(
             chat_id=chat_id, text="❌ You are not currently in an active conversation."
         )
         return
-
-    # Parse the conversation context from last_command
-    try:
-        _, other_id_str, role_str, msg_id_str = last_command.split("=")
-        other_id = int(other_id_str)
-        request_message_id = int(msg_id_str)
-        role = "counselor" if role_str == "pastor" else "user"
-    except (ValueError, IndexError):
-        context.bot.send_message(
-            chat_id=chat_id, text="⚠️ Could not parse conversation context."
-        )
-        return
+    other_id = session.with_chat_id
+    role = "user" if session.is_counselor else "counselor"
 
     # Send confirmation prompt (same as /cancel command)
     context.bot.send_message(
@@ -619,7 +694,7 @@ def start_conversation(chat_id, counseling_request):
             {
                 "counselor_id": chat_id,
                 "user_chat_id": counseling_request["user_chat_id"],
-                "messages": [],
+                "message_count": 0,
                 "created": datetime.now(),
                 "from": counseling_request["request_message_id"],
                 "last_updated": datetime.now(),
@@ -629,14 +704,47 @@ def start_conversation(chat_id, counseling_request):
 
 
 def update_conversation(msg, counselor_id, user_id):
-    db.conversations.update_one(
-        {"counselor_id": counselor_id, "user_chat_id": user_id, "active": True},
-        {"$push": {"messages": msg}, "$set": {"last_updated": datetime.now()}},
+    # Written behind by message_buffer so the relay does not wait on MongoDB
+    message_buffer.append(
+        {"counselor_id": counselor_id, "user_chat_id": user_id, "active": True}, msg
     )
 
 
+def format_conversation_history(conversation, limit=10):
+    """
+    Formats the last `limit` messages of a conversation, one per line.
+
+    Return: (text, number of older messages not shown)
+    """
+    message_buffer.flush()
+    messages = ConversationMessages.recent(conversation, limit=limit)
+    lines = ""
+    for i, msg in enumerate(messages, 1):
+        sender = (
+            "👨‍💼 Counselor"
+            if msg["from"] == conversation["counselor_id"]
+            else "👤 User"
+        )
+        message_content = msg["message"]
+
+        # Handle different message types
+        if message_content.startswith("photo="):
+            message_content = "📷 [Photo]"
+        elif message_content.startswith("video="):
+            message_content = "🎥 [Video]"
+        elif message_content.startswith("animation="):
+            message_content = "🎬 [Animation]"
+
+        # Truncate long messages
+        if len(message_content) > 100:
+            message_content = message_content[:100] + "..."
+
+        lines += f"{i}. {sender}: {message_content}\n"
+    return lines, ConversationMessages.count(conversation) - len(messages)
+
+
 def request_counseling_feedback_from_user(user_chat_id, pastor_chat_id):
-    pastor_name = db.users.find_one({"chat_id": pastor_chat_id})["first_name"]
+    pastor_name = get_user(pastor_chat_id)["first_name"]
     bot.send_message(
         chat_id=user_chat_id,
         text=config["messages"]["counseling_feedback_prompt"].format(pastor_name),
@@ -688,7 +796,7 @@ def handle_counseling_feedback_cb(update, context):
 
 def follow_up_request_cb(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "role": "counselor"})
+    user = get_counselor(chat_id)
 
     if not user:
         keyboard = validate_user_keyboard(chat_id)
@@ -724,8 +832,8 @@ def follow_up_request_cb(update, context):
         return
 
     # Get counselor and user names
-    original_counselor = db.users.find_one({"chat_id": conversation["counselor_id"]})
-    user_info = db.users.find_one({"chat_id": conversation["user_chat_id"]})
+    original_counselor = get_user(conversation["counselor_id"])
+    user_info = get_user(conversation["user_chat_id"])
 
     counselor_name = "Unknown"
     if original_counselor:
@@ -736,35 +844,11 @@ def follow_up_request_cb(update, context):
     user_name = user_info.get("first_name", "Unknown") if user_info else "Unknown"
 
     # Format conversation history
-    messages = conversation.get("messages", [])
-    conversation_text = ""
-
-    if messages:
-        conversation_text = "\n\n📝 *Conversation History:*\n"
-        for i, msg in enumerate(messages[-10:], 1):  # Show last 10 messages
-            sender = (
-                "👨‍💼 Counselor"
-                if msg["from"] == conversation["counselor_id"]
-                else "👤 User"
-            )
-            message_content = msg["message"]
-
-            # Handle different message types
-            if message_content.startswith("photo="):
-                message_content = "📷 [Photo]"
-            elif message_content.startswith("video="):
-                message_content = "🎥 [Video]"
-            elif message_content.startswith("animation="):
-                message_content = "🎬 [Animation]"
-
-            # Truncate long messages
-            if len(message_content) > 100:
-                message_content = message_content[:100] + "..."
-
-            conversation_text += f"{i}. {sender}: {message_content}\n"
-
-        if len(messages) > 10:
-            conversation_text += f"\n... and {len(messages) - 10} more messages"
+    history, older = format_conversation_history(conversation)
+    if history:
+        conversation_text = "\n\n📝 *Conversation History:*\n" + history
+        if older > 0:
+            conversation_text += f"\n... and {older} more messages"
     else:
         conversation_text = "\n\n📝 *No conversation history available*"
 
@@ -804,7 +888,7 @@ def follow_up_request_cb(update, context):
 
 def continue_conversation_cb(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "role": "counselor"})
+    user = get_counselor(chat_id)
 
     if not user:
         return
@@ -813,41 +897,58 @@ def continue_conversation_cb(update, context):
     q_head = q.split("=")
     request_message_id = int(q_head[1])
 
-    # Get the counseling request and conversation
-    request = db.counseling_requests.find_one(
-        {"request_message_id": request_message_id}
-    )
+    # Check if counselor is already in conversation
+    if sessions.get(chat_id) is not None:
+        context.bot.send_message(
+            chat_id=chat_id,
+            text="❌ You are currently in another conversation. Please end that conversation first.",
+        )
+        return
+
     conversation = db.conversations.find_one({"from": request_message_id})
+    if not conversation:
+        context.bot.send_message(
+            chat_id=chat_id, text="❌ Request or conversation not found."
+        )
+        return
 
-    if not request or not conversation:
+    seen = db.counseling_requests.find_one({"request_message_id": request_message_id})
+    if seen is None:
         context.bot.send_message(
             chat_id=chat_id, text="❌ Request or conversation not found."
         )
         return
 
+    # Claim the request from the counselor it was listed under, unless
+    # another counselor has resumed it since
+    request = claim_counseling_request(
+        request_message_id,
+        chat_id,
+        {"status": "ongoing", "counselor_chat_id": seen.get("counselor_chat_id")},
+    )
+    if request is None:
+        request = (
+            db.counseling_requests.find_one({"request_message_id": request_message_id})
+            or seen
+        )
+        logger.info(
+            f"FOLLOW-UP: request {request_message_id} was taken before {chat_id} could resume it"
+        )
+        notify_request_already_taken(context, chat_id, request)
+        return
+
     user_chat_id = request["user_chat_id"]
 
     # Check if user is already in another conversation
-    user_last_command = get_user_last_command(user_chat_id)
-    if user_last_command and user_last_command.startswith("in-conversation-with"):
+    if sessions.get(user_chat_id) is not None:
+        release_counseling_request(request_message_id, chat_id, request)
         context.bot.send_message(
             chat_id=chat_id,
             text="❌ This user is currently in another conversation. Please try again later.",
         )
         return
 
-    # Check if counselor is already in conversation
-    counselor_last_command = get_user_last_command(chat_id)
-    if counselor_last_command and counselor_last_command.startswith(
-        "in-conversation-with"
-    ):
-        context.bot.send_message(
-            chat_id=chat_id,
-            text="❌ You are currently in another conversation. Please end that conversation first.",
-        )
-        return
-
-    # Update the conversation and request
+    # Update the conversation
     db.conversations.update_one(
         {"from": request_message_id},
         {
@@ -860,18 +961,9 @@ def continue_conversation_cb(update, context):
         },
     )
 
-    db.counseling_requests.update_one(
-        {"request_message_id": request_message_id},
-        {"$set": {"counselor_chat_id": chat_id, "status": "ongoing"}},
-    )
-
     # Set conversation states
-    set_user_last_command(
-        user_chat_id, f"in-conversation-with={chat_id}=pastor={request_message_id}"
-    )
-    set_user_last_command(
-        chat_id, f"in-conversation-with={user_chat_id}=user={request_message_id}"
-    )
+    sessions.start(user_chat_id, chat_id, "pastor", request_message_id)
+    sessions.start(chat_id, user_chat_id, "user", request_message_id)
 
     # Get counselor name for notifications
     counselor_name = (
@@ -907,7 +999,7 @@ def cancel_follow_up_cb(update, context):
 
 def mark_request_completed_cb(update, context):
     chat_id = update.effective_chat.id
-    user = db.users.find_one({"chat_id": chat_id, "role": "counselor"})
+    user = get_counselor(chat_id)
 
     if not user:
         keyboard = validate_user_keyboard(chat_id)
@@ -943,7 +1035,8 @@ def mark_request_completed_cb(update, context):
     # Mark the request as completed
     set_counseling_request_status(request_message_id, "completed")
 
-    # Mark any active conversation as inactive
+    # Mark any active conversation as inactive, after writing buffered messages
+    message_buffer.flush()
     db.conversations.update_one(
         {"from": request_message_id, "active": True},
         {"$set": {"active": False, "completed_at": datetime.now()}},
@@ -954,9 +1047,9 @@ def mark_request_completed_cb(update, context):
     counselor_chat_id = request.get("counselor_chat_id")
 
     # Clear states for both users
-    set_user_last_command(user_chat_id, None)
+    sessions.end(user_chat_id)
     if counselor_chat_id:
-        set_user_last_command(counselor_chat_id, None)
+        sessions.end(counselor_chat_id)
 
     context.bot.send_message(
         chat_id=chat_id,
@@ -990,7 +1083,7 @@ from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMa
 
 def counselor_transfer(update, context):
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
 
     if user.get("role") != "counselor":
         keyboard = validate_user_keyboard(chat_id)
@@ -1002,23 +1095,16 @@ def counselor_transfer(update, context):
         set_user_last_command(chat_id, None)
         return
 
-    last_command = user.get("last_command")
-    if not last_command or not last_command.startswith("in-conversation-with"):
+    session = sessions.get(chat_id)
+    if session is None or not session.is_counselor:
         context.bot.send_message(
             chat_id=chat_id, text=config["messages"]["counselor_transfer_invalid"]
         )
         return
 
-    try:
-        request_msg_id = int(last_command.split("=")[-1])
-    except (IndexError, ValueError):
-        context.bot.send_message(
-            chat_id=chat_id,
-            text="Could not extract request ID from your current session.",
-        )
-        return
-
-    req = db.counseling_requests.find_one({"request_message_id": request_msg_id})
+    req = db.counseling_requests.find_one(
+        {"request_message_id": session.request_message_id}
+    )
     if not req:
         context.bot.send_message(chat_id=chat_id, text="Counseling request not found.")
         return
@@ -1026,39 +1112,21 @@ def counselor_transfer(update, context):
     topic = req["topic"]
     user_chat_id = Int64(req["user_chat_id"])
 
-    # Step 1: Get counselors from the topic
-    topic_doc = db.counseling_topics.find_one({"topic": topic})
-    topic_counselors = topic_doc.get("counselors", []) if topic_doc else []
-
-    # Step 2: Get global counselors
-    global_counselors_cursor = db.users.find(
-        {"role": "counselor", "global": True}, {"chat_id": 1}
-    )
-    global_counselors = [Int64(p["chat_id"]) for p in global_counselors_cursor]
-
-    # Step 3: Combine and deduplicate
-    eligible_ids = list(set(topic_counselors + global_counselors))
-
-    # Step 4: Filter out current counselor and the user
-    eligible_ids = [
-        cid for cid in eligible_ids if cid != chat_id and cid != user_chat_id
-    ]
-
-    # Step 5: Query user info
-    pastors = db.users.find({"chat_id": {"$in": eligible_ids}})
+    # Topic and global counselors other than this counselor and the user
+    eligible_ids = counselor_index.eligible(topic, exclude={chat_id, user_chat_id})
 
     # Save transfer state
-    set_user_last_command(chat_id, f"transfer_req={last_command}")
+    sessions.begin_transfer(session)
 
     # Create buttons
     buttons = [
         [
             InlineKeyboardButton(
-                f"Counselor {pastor.get('first_name', '')}",
-                callback_data=f"transfer={pastor['chat_id']}",
+                f"Counselor {counselor_index.name(cid)}",
+                callback_data=f"transfer={cid}",
             )
         ]
-        for pastor in pastors
+        for cid in sorted(eligible_ids)
     ]
 
     if not buttons:
@@ -1080,8 +1148,13 @@ def counselor_transfer_callback_handler(update, context):
     q_head = q.split("=")
     new_counselor_id = Int64(q_head[1])
 
-    user = db.users.find_one({"chat_id": chat_id})
-    new_pastor = db.users.find_one({"chat_id": new_counselor_id})
+    session = sessions.get(chat_id)
+    if session is None:
+        context.bot.send_message(
+            chat_id=chat_id, text=config["messages"]["counselor_transfer_invalid"]
+        )
+        return
+    new_pastor = get_user(new_counselor_id)
 
     context.bot.send_message(
         chat_id=chat_id,
@@ -1090,19 +1163,17 @@ def counselor_transfer_callback_handler(update, context):
         ),
     )
 
-    last_command = "=".join(user["last_command"].split("=")[-4:])
-    set_user_last_command(chat_id, f"transfer_req={new_counselor_id}={last_command}")
+    sessions.begin_transfer(session, new_counselor_id)
 
 
 def counselor_transfer_msg_handler(update, context):
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
-    msg = update.message.text.strip()
+    session = sessions.get(chat_id)
+    msg = (update.message.text or "").strip()
 
-    try:
-        parts = user["last_command"].split("=")
-        new_counselor_id = Int64(parts[1])
-        user_id = Int64(parts[-3])
+    if session is not None and session.transfer_to is not None and msg:
+        new_counselor_id = Int64(session.transfer_to)
+        user_id = Int64(session.with_chat_id)
 
         db.conversations.update_one(
             {"counselor_id": chat_id, "user_chat_id": user_id, "active": True},
@@ -1130,10 +1201,9 @@ def counselor_transfer_msg_handler(update, context):
             ),
         )
 
-    except Exception:
-        # Retry by re-setting the last_command
-        last_command = "=".join(user["last_command"].split("=")[2:])
-        set_user_last_command(chat_id, f"transfer_req={last_command}")
+    else:
+        # No counselor picked yet, or not a text message: ask again. The
+        # session is left as is, keeping any counselor already picked.
         context.bot.send_message(
             chat_id=chat_id, text=config["messages"]["counselor_transfer_msg_prompt"]
         )
@@ -1141,13 +1211,14 @@ def counselor_transfer_msg_handler(update, context):
 
 def counselor_transfer_msg_confirm_cb_handler(update, context):
     chat_id = Int64(update.effective_chat.id)
-    user = db.users.find_one({"chat_id": chat_id})
+    user = get_user(chat_id)
+    session = sessions.get(chat_id)
     callback_data = update.callback_query.data
     q_head = callback_data.split("=")
     new_counselor_id = Int64(q_head[2])
-    new_pastor = db.users.find_one({"chat_id": new_counselor_id})
+    new_pastor = get_user(new_counselor_id)
 
-    if not user or not user.get("last_command"):
+    if not user or session is None:
         context.bot.send_message(
             chat_id=chat_id,
             text=config["messages"]["counseling_request_transferred"],
@@ -1157,23 +1228,17 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
         )
         return
 
-    parts = user["last_command"].split("=")
     transfer_confirmed = q_head[1] == "true"
-    original_request_msg_id = int(parts[-1])
-    original_user_chat_id = Int64(parts[-3])
+    original_request_msg_id = session.request_message_id
+    original_user_chat_id = Int64(session.with_chat_id)
 
     if transfer_confirmed:
-        # ✅ Step 1: Confirm transfer to user
-        context.bot.send_message(
-            chat_id=chat_id,
-            text=config["messages"]["counselor_transfer_confirm"].format(
-                new_pastor["first_name"]
-            ),
-        )
-
-        # ✅ Step 2: Update the counseling request
-        db.counseling_requests.update_one(
-            {"request_message_id": original_request_msg_id},
+        # ✅ Step 1: Hand the request over, only if this counselor still holds it
+        counseling_request = db.counseling_requests.find_one_and_update(
+            {
+                "request_message_id": original_request_msg_id,
+                "counselor_chat_id": chat_id,
+            },
             {
                 "$set": {
                     "counselor_chat_id": new_counselor_id,
@@ -1181,12 +1246,25 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
                     "status": "pending",
                 }
             },
+            return_document=ReturnDocument.AFTER,
         )
-        counseling_request = db.counseling_requests.find_one(
-            {"request_message_id": original_request_msg_id}
+        if counseling_request is None:
+            context.bot.send_message(
+                chat_id=chat_id,
+                text=config["messages"]["counseling_request_transferred"],
+            )
+            return
+
+        # ✅ Step 2: Confirm transfer to the counselor
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=config["messages"]["counselor_transfer_confirm"].format(
+                new_pastor["first_name"]
+            ),
         )
 
-        # ✅ Step 3: Update the conversation
+        # ✅ Step 3: Update the conversation, after writing buffered messages
+        message_buffer.flush()
         db.conversations.update_one(
             {
                 "counselor_id": chat_id,
@@ -1199,19 +1277,25 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
             {"counselor_id": new_counselor_id, "transfer_from": chat_id, "active": True}
         )
 
-        # ✅ Step 4: Notify the new counselor
+        # ✅ Step 4: Notify the new counselor, with the latest messages
+        notify_text = config["messages"]["counselor_transfer_notify"].format(
+            user["first_name"],
+            counseling_request["name"],
+            counseling_request["email"],
+            counseling_request["phone"],
+            counseling_request["topic"],
+            counseling_request["note"],
+            user["first_name"],
+            conv.get("counselor_transfer_msg", "No message provided."),
+        )
+        history, _ = format_conversation_history(conv)
+        if history:
+            notify_text += config["messages"]["counselor_transfer_history"].format(
+                history
+            )
         context.bot.send_message(
             chat_id=new_counselor_id,
-            text=config["messages"]["counselor_transfer_notify"].format(
-                user["first_name"],
-                counseling_request["name"],
-                counseling_request["email"],
-                counseling_request["phone"],
-                counseling_request["topic"],
-                counseling_request["note"],
-                user["first_name"],
-                conv.get("counselor_transfer_msg", "No message provided."),
-            ),
+            text=notify_text,
             reply_markup=InlineKeyboardMarkup(
                 [
                     [
@@ -1238,8 +1322,8 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
         )
 
         # ✅ Step 6: Reset states
-        set_user_last_command(original_user_chat_id, None)
-        set_user_last_command(chat_id, None)
+        sessions.end(original_user_chat_id)
+        sessions.end(chat_id)
 
     else:
         # ❌ Transfer was not confirmed – show alternative counselors again
@@ -1250,23 +1334,9 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
         topic = request_doc["topic"]
         user_chat_id = request_doc["user_chat_id"]
 
-        topic_doc = db.counseling_topics.find_one({"topic": topic})
-        topic_ids = topic_doc.get("counselors", []) if topic_doc else []
+        eligible_ids = counselor_index.eligible(topic, exclude={chat_id, user_chat_id})
 
-        global_cursor = db.users.find(
-            {"role": "counselor", "global": True}, {"chat_id": 1}
-        )
-        global_ids = [Int64(p["chat_id"]) for p in global_cursor]
-
-        eligible_ids = list(set(topic_ids + global_ids))
-        eligible_ids = [
-            cid for cid in eligible_ids if cid != chat_id and cid != user_chat_id
-        ]
-
-        pastors = db.users.find({"chat_id": {"$in": eligible_ids}})
-
-        last_command = "=".join(user["last_command"].split("=")[-4:])
-        set_user_last_command(chat_id, f"transfer_req={last_command}")
+        sessions.begin_transfer(session)
 
         context.bot.send_message(
             chat_id=chat_id,
@@ -1275,12 +1345,32 @@ def counselor_transfer_msg_confirm_cb_handler(update, context):
                 [
                     [
                         InlineKeyboardButton(
-                            f"Counselor {pastor.get('first_name', '')}",
-                            callback_data=f"transfer={pastor['chat_id']}",
+                            f"Counselor {counselor_index.name(cid)}",
+                            callback_data=f"transfer={cid}",
                         )
                     ]
-                    for pastor in pastors
+                    for cid in sorted(eligible_ids)
                 ],
                 resize_keyboard=True,
             ),
         )
+
+
+command_router.register("view active requests", show_active_requests)
+command_router.register("view new requests", show_new_requests)
+state_router.register("in-conversation-with", conversation_handler, prefix=True)
+state_router.register("verify_active_requests", handle_active_requests_verification)
+state_router.register("transfer_req", counselor_transfer_msg_handler, prefix=True)
+for head, handler in {
+    "conv": handle_initial_conversation_cb,
+    "mark_complete": mark_request_completed_cb,
+    "follow_up": follow_up_request_cb,
+    "continue_conv": continue_conversation_cb,
+    "cancel_follow_up": cancel_follow_up_cb,
+    "end_conv": end_conversation_cb_handler,
+    "end_conv_quick": end_conversation_quick_cb_handler,
+    "counseling_feedback": handle_counseling_feedback_cb,
+    "transfer": counselor_transfer_callback_handler,
+    "transfer_req_confirm": counselor_transfer_msg_confirm_cb_handler,
+}.items():
+    callback_router.register(head, handler)
@@ -12,6 +12,8 @@ from bot.database import (
     update_counseling_topics,
     get_all_counseling_topics,
     set_user_last_command,
+    get_user,
+    update_user,
 )
 from telegram import (
     Update,
@@ -19,6 +21,7 @@ from telegram import (
     InlineKeyboardMarkup,
 )
 from telegram.ext import CallbackContext
+from bot.router import command_router, state_router, callback_router
 
 
 def counseling(update: Update, context: CallbackContext):
@@ -176,9 +179,7 @@ def handle_counseling_info_confirm(update, context):
     query = update.callback_query.data.split("=")
 
     if query[1] == "yes":
-        user_local_church = db.users.find_one(
-            {"chat_id": chat_id}, {"location": 1, "_id": 0}
-        ).get("location")
+        user_local_church = get_user(chat_id).get("location")
 
         if user_local_church:
             branch = user_local_church.capitalize()
@@ -229,8 +230,8 @@ def handle_counseling_location_confirm(update, context):
         PromptHelper.location_prompt(
             chat_id, config["messages"]["lc_prompt_counseling"]
         )
-        db.users.update_one(
-            {"chat_id": chat_id},
+        update_user(
+            chat_id,
             {"$set": {"last_command": "location_counseling=" + str(query[-1])}},
         )
 
@@ -312,3 +313,20 @@ def add_request_to_queue(counseling_request: dict):
             "location": counseling_request["location"],
         }
     )
+
+
+def counselor_request_response(update, context):
+    last_command = get_user(update.effective_chat.id)["last_command"]
+    handle_counselor_request_yes(update, context, last_command.split("=")[-1])
+
+
+command_router.register("counseling", counseling)
+state_router.register("counselor_request", counselor_request_response, prefix=True)
+for head, handler in {
+    "counsel": handle_counseling,
+    "qa_or_c": handle_ask_question_or_request_counselor,
+    "confirm_info": handle_counseling_info_confirm,
+    "confirm_loc": handle_counseling_location_confirm,
+    "faq": handle_get_faq_callback,
+}.items():
+    callback_router.register(head, handler)
@@ -1,18 +1,31 @@
 import requests
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from bot import bot, db, config, logger
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from apscheduler.schedulers.blocking import BlockingScheduler
 from bot.commands import notify_new_sermon
-from bot.database import insert_sermon
+from bot.database import stream_recipients
 from bot.scrapers import WebScrapers
+from bot.sermon_ingest import SermonIngester
+from bot.devotional_cache import devotional_cache
 from bot.helpers import MessageHelper, BroadcastHandlers
+from bot.broadcast import BroadcastEngine
+from bot.broadcast_jobs import BroadcastJobManager
+from bot.job_lease import JobLeaseManager
+from chat.chat_callback_handlers import escalate_requests
 
 sched = BlockingScheduler()
 
+# Both app.py and the scheduler service run this scheduler; the leases make
+# each occurrence of a job run in one process only.
+job_leases = JobLeaseManager(db.job_leases)
+DAY = 24 * 60 * 60
+PREFETCH_INTERVAL = 15 * 60
+
 
 @sched.scheduled_job("cron", day_of_week="mon-sun", hour=23, minute=0)
-def birthday_notifier():
+@job_leases.exclusive(DAY)
+def birthday_notifier(lease):
     """
     This function sends out daily notifications to users on their birthdays.
     """
@@ -21,37 +34,32 @@ def birthday_notifier():
     date_str = f"{tomorrow.month}-{tomorrow.day}"
 
     # Find users whose birthdays match tomorrow's date
-    birthday_users = db.users.find({"birthday": date_str})
-    users_with_birthdays = list(birthday_users)
+    users_with_birthdays = stream_recipients({"birthday": date_str}, ["first_name"])
 
-    # Prepare the message and photo for each user
+    # The media cache uploads the photo with the first send and every other
+    # recipient reuses its Telegram file_id instead of re-uploading the file.
     photo_path = "img/birthday.jpg"
-    messages = [
-        {
-            "chat_id": user["chat_id"],
-            "photo": photo_path,
-            "caption": config["messages"]["birthday_message1"].format(
-                user["first_name"]
-            ),
-        }
+    messages = (
+        (
+            user["chat_id"],
+            photo_path,
+            config["messages"]["birthday_message1"].format(user["first_name"]),
+        )
         for user in users_with_birthdays
-    ]
+    )
 
-    # Use BroadcastHandlers to send the messages
-    for message in messages:
-        BroadcastHandlers.broadcast_message(
-            [message["chat_id"]],  # List containing one user's chat ID
-            message["photo"],
-            MessageHelper.send_photo,
-            message["caption"],
-        )
+    # Use BroadcastHandlers to send the messages concurrently
+    result = BroadcastHandlers.broadcast_personalised(
+        lease.fenced(messages), MessageHelper.send_photo
+    )
 
     # Log the number of birthday wishes sent
-    logger.info(f"BIRTHDAY: Sent {len(users_with_birthdays)} birthday wishes")
+    logger.info(f"BIRTHDAY: Sent {result['success']} birthday wishes")
 
 
 @sched.scheduled_job("cron", day_of_week="mon-sun", hour=6)
-def new_sermons():
+@job_leases.exclusive(DAY)
+def new_sermons(lease):
     """
     This functions updates the latest sermon and notifies users about the new sermon
 
@@ -61,11 +69,8 @@ def new_sermons():
     Return: None
     """
 
-    sermons = WebScrapers.cci_sermons()
-    titles = []
-    for sermon in sermons:
-        if insert_sermon(sermon) is True:
-            titles.append(sermon)
+    titles = SermonIngester.run()
+    lease.check()
     if len(titles) > 0:
         lsermon = titles[0]
         lsermon["latest_sermon"] = True
@@ -73,15 +78,46 @@ def new_sermons():
         db.temporary.insert_one(lsermon)
         logger.info("Updated latest Sermon to {}".format(lsermon["title"]))
         t = [i["title"] for i in titles]
-        for user in db.users.find({}):
-            notify_new_sermon(user["chat_id"], t)
+        result = notify_new_sermon(t)
+        logger.info(f"SERMON: Notified {result['success']} users about new sermons")
+
+
+@sched.scheduled_job("cron", day_of_week="mon-sun", hour="0-6", minute="*/15")
+@job_leases.exclusive(PREFETCH_INTERVAL)
+def prefetch_devotional(lease):
+    """
+    This stores the day's devotional from midnight on, retrying every
+    quarter of an hour until t30.org has published it; until it lands,
+    users are served the previous day's.
+    """
+    if db.devotionals.find_one({"date": str(date.today())}, {"_id": 1}):
+        return
+    if devotional_cache.refresh() is None:
+        logger.info("DEVOTIONAL: not published yet, retrying in 15 minutes")
+
+
+@sched.scheduled_job("interval", minutes=10)
+def resume_broadcasts():
+    """
+    This picks up broadcast jobs left unfinished by a crashed or restarted worker.
+    """
+    BroadcastJobManager.resume_jobs()
+
+
+@sched.scheduled_job("interval", minutes=1)
+def escalate_counseling_requests():
+    """
+    This re-offers counseling requests nobody has claimed in time.
+    """
+    escalate_requests()
 
 
 numbers = {1: "first", 2: "second", 3: "third"}
 
 
 @sched.scheduled_job("cron", day_of_week="sat", hour=6)
-def check_feedback():
+@job_leases.exclusive(7 * DAY)
+def check_feedback(lease):
     feedback = db.feedback.find({"status": "pending"})
     if feedback:
         bot.send_message(
@@ -112,7 +148,9 @@ def notify_tickets():
         ]
         for service in ticket[0:2]
     ]
-    users = db.users.find(
+    if not ticket:
+        return
+    users = stream_recipients(
         {
             "$or": [
                 {"location": {"$in": ["Ikeja", "Lekki", "Online", "None"]}},
@@ -120,16 +158,14 @@ def notify_tickets():
             ]
         }
     )
-    for user in users:
-        try:
-            bot.send_photo(
-                chat_id=user["chat_id"],
-                photo=ticket[0]["image"],
-                caption=config["messages"]["tickets"],
-                reply_markup=InlineKeyboardMarkup(buttons),
-            )
-        except Exception as e:
-            pass
+    args = (
+        ticket[0]["image"],
+        config["messages"]["tickets"],
+        InlineKeyboardMarkup(buttons),
+    )
+    BroadcastEngine().run(
+        ((user["chat_id"], args) for user in users), MessageHelper.send_photo
+    )
 
 
 # @sched.scheduled_job('cron', day_of_week='mon-sat', hour=5)
@@ -143,29 +179,24 @@ def send_devotional():
 
     Return: None
     """
-    d = WebScrapers.t30()
+    d = devotional_cache.get(allow_stale=False)
+    if d is None:
+        logger.error("DEVOTIONAL: no devotional for today, nothing sent")
+        return
     button = [[InlineKeyboardButton("Read more", url=d["link"])]]
-    for user in db.users.find({"mute": False}):
-        try:
-            bot.send_photo(
-                chat_id=user["chat_id"],
-                photo=d["image"],
-                caption=config["messages"]["t30_caption"].format(
-                    d["title"], d["excerpt"].split("\n")[0]
-                ),
-                reply_markup=InlineKeyboardMarkup(button),
-            )
-        except Exception as e:
-            # sets the user as inactive if telegram throws an exception.
-            if str(e) == "Forbidden: bot was blocked by the user":
-                db.users.update_one(
-                    {"chat_id": user["chat_id"]}, {"$set": {"active": False}}
-                )
-            pass
-    u = db.users.count_documents({"mute": False, "active": True})
-    db.devotionals.insert_one(d)
-    logger.info(f"DEVOTIONAL: Sent devotional to {u} users")
-
+    args = (
+        d["image"],
+        config["messages"]["t30_caption"].format(
+            d["title"], d["excerpt"].split("\n")[0]
+        ),
+        InlineKeyboardMarkup(button),
+    )
+    # The engine marks users who blocked the bot as inactive.
+    result = BroadcastEngine().run(
+        ((user["chat_id"], args) for user in stream_recipients({"mute": False})),
+        MessageHelper.send_photo,
+    )
+    logger.info(f"DEVOTIONAL: Sent devotional to {result['success']} users")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""
+Checks bot/job_lease.py with several scheduler processes against one local
+mongod.
+
+    python scripts/check_job_lease.py [--processes N] [--occurrences N]
+
+Each process fires every occurrence of a demo job at the same moment (a
+barrier stands in for the shared cron slot), and each run is recorded in
+a `runs` collection; every occurrence must have run exactly once. Then a
+holder is stalled past its lease expiry to check that the lease is taken
+over with a higher fencing token and that the stale holder can no longer
+renew or release it. Exits 1 on any failure.
+
+LEASE_CHECK_URI sets the server (default mongodb://localhost:27017). The
+check drops and recreates its own database, `job_lease_check`, and never
+reads MONGO_URI.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import importlib.util
+import multiprocessing
+from pymongo import MongoClient
+
+URI = os.getenv("LEASE_CHECK_URI") or "mongodb://localhost:27017"
+DB_NAME = "job_lease_check"
+
+# Loaded by path: importing it through the bot package would run
+# bot/__init__.py, which needs the bot's secrets.
+_spec = importlib.util.spec_from_file_location(
+    "job_lease",
+    os.path.join(os.path.dirname(__file__), os.pardir, "bot", "job_lease.py"),
+)
+job_lease = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(job_lease)
+
+
+def scheduler_process(index: int, occurrences: int, barrier) -> None:
+    db = MongoClient(URI)[DB_NAME]
+    leases = job_lease.JobLeaseManager(db.job_leases, ttl=3, holder=f"proc-{index}")
+
+    def demo_job(lease):
+        db.runs.insert_one(
+            {
+                "occurrence": lease.occurrence,
+                "holder": lease.holder,
+                "token": lease.token,
+            }
+        )
+        time.sleep(random.uniform(0, 0.05))
+
+    for occurrence in range(occurrences):
+        barrier.wait()
+        leases.run("demo", occurrence, demo_job)
+
+
+def check_exactly_once(processes: int, occurrences: int) -> list:
+    barrier = multiprocessing.Barrier(processes)
+    workers = [
+        multiprocessing.Process(
+            target=scheduler_process, args=(i, occurrences, barrier)
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    db = MongoClient(URI)[DB_NAME]
+    failures = [
+        f"occurrence {doc['_id']} ran {doc['count']} times"
+        for doc in db.runs.aggregate(
+            [{"$group": {"_id": "$occurrence", "count": {"$sum": 1}}}]
+        )
+        if doc["count"] != 1
+    ]
+    ran = len(db.runs.distinct("occurrence"))
+    if ran != occurrences:
+        failures.append(f"{occurrences - ran} occurrences never ran")
+    holders = db.runs.distinct("holder")
+    print(
+        f"exactly-once: {occurrences} occurrences x {processes} processes, "
+        f"{db.runs.count_documents({})} runs, won by {len(holders)} processes"
+    )
+    return failures
+
+
+def check_takeover() -> list:
+    db = MongoClient(URI)[DB_NAME]
+    stalled = job_lease.JobLeaseManager(db.job_leases, ttl=1, holder="stalled")
+    other = job_lease.JobLeaseManager(db.job_leases, ttl=1, holder="other")
+    failures = []
+
+    first = stalled.acquire("takeover", 0)
+    if first is None:
+        return ["stalled holder could not acquire a free lease"]
+    if other.acquire("takeover", 0) is not None:
+        failures.append("a held lease was acquired by a second holder")
+
+    time.sleep(1.5)  # past the expiry, with no heartbeat
+    second = other.acquire("takeover", 0)
+    if second is None:
+        return failures + ["an expired lease could not be taken over"]
+    if second.token <= first.token:
+        failures.append("fencing token did not increase on takeover")
+    if stalled.renew(first):
+        failures.append("the stale holder renewed a lease it lost")
+    if first.valid():
+        failures.append("the stale lease was not marked lost")
+    stalled.release(first)
+    doc = db.job_leases.find_one({"_id": "takeover"})
+    if doc["holder"] != "other" or doc.get("done") == 0:
+        failures.append("the stale holder's release changed the lease")
+
+    other.release(second)
+    if other.acquire("takeover", 0) is not None:
+        failures.append("a completed occurrence was acquired again")
+    print(f"takeover: token {first.token} -> {second.token}")
+    return failures
+
+
+def main() -> int:
+    args = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    args.add_argument("--processes", type=int, default=4)
+    args.add_argument("--occurrences", type=int, default=50)
+    args = args.parse_args()
+
+    MongoClient(URI).drop_database(DB_NAME)
+    failures = check_exactly_once(args.processes, args.occurrences)
+    failures += check_takeover()
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    print("ok" if not failures else f"{len(failures)} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
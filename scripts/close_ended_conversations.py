@@ -0,0 +1,51 @@
+"""
+Clears the `active` flag of conversations whose counseling request has
+been completed.
+
+Ending a conversation with the End Conversation button used to leave its
+record active, so those conversations still count towards their
+counselor's load when requests are ranked. Run this once against the
+bot's database after deploying the fix; running it again does nothing.
+
+    python scripts/close_ended_conversations.py [--dry-run]
+
+Reads MONGO_URI and DB_NAME like the bot.
+"""
+
+import os
+import sys
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bot import db, logger
+
+
+def main() -> int:
+    args = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    args.add_argument("--dry-run", action="store_true")
+    args = args.parse_args()
+
+    active = db.conversations.distinct("from", {"active": True})
+    completed = db.counseling_requests.distinct(
+        "request_message_id",
+        {"request_message_id": {"$in": active}, "status": "completed"},
+    )
+    logger.info(
+        f"CONVERSATION: {len(completed)} of {len(active)} active conversations "
+        "belong to completed requests"
+    )
+    if args.dry_run or not completed:
+        return 0
+
+    result = db.conversations.update_many(
+        {"from": {"$in": completed}, "active": True},
+        {"$set": {"active": False, "completed_at": datetime.now()}},
+    )
+    logger.info(f"CONVERSATION: closed {result.modified_count} conversations")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
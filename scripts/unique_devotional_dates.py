@@ -0,0 +1,65 @@
+"""
+Prepares `devotionals` for its unique date index.
+
+Before the index was unique, two processes storing the same day's
+devotional could both insert it. This keeps the first document of each
+date, deletes the others and drops the old non-unique `date_1` index, so
+the next start of the bot can build the unique one. Run it once against
+the bot's database after deploying that change; running it again does
+nothing.
+
+    python scripts/unique_devotional_dates.py [--dry-run]
+
+Reads MONGO_URI and DB_NAME like the bot.
+"""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bot import db, logger
+
+
+def main() -> int:
+    args = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    args.add_argument("--dry-run", action="store_true")
+    args = args.parse_args()
+
+    index = db.devotionals.index_information().get("date_1")
+    if index is not None and index.get("unique"):
+        logger.info("DEVOTIONAL: date index is already unique")
+        return 0
+
+    duplicates = [
+        group["ids"][1:]
+        for group in db.devotionals.aggregate(
+            [
+                {"$sort": {"_id": 1}},
+                {"$group": {"_id": "$date", "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+            ]
+        )
+    ]
+    logger.info(
+        f"DEVOTIONAL: {sum(map(len, duplicates))} duplicate devotionals "
+        f"over {len(duplicates)} dates"
+    )
+    if args.dry_run:
+        return 0
+
+    removed = 0
+    for ids in duplicates:
+        removed += db.devotionals.delete_many({"_id": {"$in": ids}}).deleted_count
+    if index is not None:
+        db.devotionals.drop_index("date_1")
+    logger.info(
+        f"DEVOTIONAL: removed {removed} duplicates; the unique date index is "
+        "built on the bot's next start"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())